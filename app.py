@@ -2,16 +2,26 @@
 # ============================================================
 # AI Prompts Generator (AR/EN) — Production-grade single file
 # Features:
-# 1) Smart Hash Cache (exact + partial similarity) with Redis + local LRU
-# 2) Token scaling by (language + type) + dynamic complexity
-# 3) PreGPT Quick Rules (returns ready prompts w/o calling OpenAI)
+# 1) Smart Hash Cache (exact + n-gram LSH similarity) with Redis + host-shared L2 + local LRU (TinyLFU admission), compressed packed entries, decayed-frequency eviction
+#    + stale-while-revalidate: soft/hard TTL with budgeted background refresh
+# 2) Token scaling by (language + type) + dynamic complexity, learned from observed completion usage
+# 3) PreGPT Quick Rules (returns ready prompts w/o calling OpenAI), hot-reloadable rule table
 # 4) Compact "Symbol" System Prompts to minimize tokens
 # 5) Heuristic intent detection (AR/EN) if type is missing
-# 6) Rate limiting + CORS + Health endpoint
+# 6) Distributed per-client quotas (Redis token bucket, API key or IP, weighted by outcome) + CORS + Health endpoint
+# 7) SSE streaming endpoint (/generate/stream)
+# 8) Batch endpoint with dedup + bounded model concurrency (/generate/batch)
+# 9) Prometheus metrics: per-stage latency, outcomes, similarity scores, tokens (/metrics)
+# 10) Model backend: complexity-based tiers, deadlines, jittered retries, hedged requests, local stub
+# 11) Admission control: capped in-flight model calls, bounded queue, fast 503 + Retry-After
+# 12) Async serving path for /generate + /health under ASGI (asgi.py: redis.asyncio + async model calls)
+# 13) Request log (buffered JSONL) -> mine_log.py -> candidate quick rules + cache seeds (CACHE_SEED_FILE)
 # ------------------------------------------------------------
 # Env:
-#   OPENAI_API_KEY  (required)
+#   OPENAI_API_KEY  (required unless MODEL_BACKEND=stub)
 #   REDIS_URL       (optional, defaults to redis://localhost:6379)
+#   MODEL_TIERS     (optional JSON; see "Model Backend")
+#   RATE_LIMIT_KEYS (optional JSON; per-API-key quotas, see "Quotas")
 # ============================================================
 
 import os
@@ -19,19 +29,32 @@ import re
 import time
 import json
 import math
+import asyncio
+import random
+import zlib
+import struct
+import bisect
 import hashlib
 import logging
+import queue
+import sqlite3
+import threading
 import unicodedata
+from abc import ABC, abstractmethod
 from difflib import SequenceMatcher
-from collections import deque
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeout
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 import redis
 import openai
+import requests
+from requests.adapters import HTTPAdapter
 
 # ------------ Basic Setup ------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -46,36 +69,350 @@ openai.api_key = OPENAI_API_KEY
 app = Flask(__name__)
 CORS(app)
 
-# Rate limiting (عدلها حسب احتياجك)
-limiter = Limiter(get_remote_address, app=app, default_limits=["60 per minute"])
+# Rate limiting (عدلها حسب احتياجك) — حد خشن لكل IP؛ حصص /generate الفعلية في "Quotas" أدناه.
+# RATE_LIMIT_STORAGE=redis://... يجعل هذا الحد مشتركًا بين العمليات أيضًا
+limiter = Limiter(get_remote_address, app=app, default_limits=["60 per minute"],
+                  storage_uri=os.getenv("RATE_LIMIT_STORAGE", "memory://"), in_memory_fallback_enabled=True)
 
-# Redis (اختياري)
+# Redis (اختياري) — see "Redis Backend" below for pooling, timeouts and the breaker
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-cache = None
-try:
-    cache = redis.from_url(REDIS_URL)
-    cache.ping()
-    logging.info("✅ Redis connected")
-except Exception as e:
-    logging.warning(f"⚠️ Redis not available: {e}")
-    cache = None
 
 # ------------ Cache Controls ------------
 CACHE_NS = "pg"  # namespace
-CACHE_KEYS_LIST = f"{CACHE_NS}:keys"     # list of recent cache keys
-CACHE_META_PREFIX = f"{CACHE_NS}:meta:"  # meta per key (stores norm text/type/lang)
-CACHE_VAL_PREFIX = f"{CACHE_NS}:val:"    # value per key (the prompt)
-CACHE_KEYS_MAX = 2000                    # scan window for similarity
-CACHE_TTL_DEFAULT = 7 * 24 * 3600        # 7 days
-
-# In-memory micro LRU booster
-LOCAL_LRU_MAX = 256
-local_lru = deque(maxlen=LOCAL_LRU_MAX)
-local_map = {}
+CACHE_KEYS_LIST = f"{CACHE_NS}:keys"     # legacy: list of recent cache keys (replaced by CACHE_POP_ZSET)
+CACHE_POP_ZSET = f"{CACHE_NS}:pop"       # zset: cache key -> log2 of its decayed hit frequency
+CACHE_META_PREFIX = f"{CACHE_NS}:meta:"  # legacy: meta per key (JSON norm text/type/lang); see CACHE_ENTRY_PREFIX
+CACHE_VAL_PREFIX = f"{CACHE_NS}:val:"    # legacy: value per key (the prompt)
+CACHE_KEYS_MAX = 2000                    # most popular keys re-indexed on rebuilds
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "100000"))        # least popular beyond this are evicted
+CACHE_POP_HALF_LIFE = float(os.getenv("CACHE_POP_HALF_LIFE", "86400"))   # a hit counts half after this (s)
+CACHE_TTL_DEFAULT = 7 * 24 * 3600        # 7 days (hard TTL: Redis expiry)
+CACHE_SOFT_TTL = int(os.getenv("CACHE_SOFT_TTL", str(24 * 3600)))  # older entries are served stale + refreshed
+CACHE_LSH_PREFIX = f"{CACHE_NS}:lsh3:"   # LSH buckets: zset of cache keys per band hash, scored by popularity
+CACHE_LSH_READY = f"{CACHE_NS}:lsh3:ready"
+CACHE_LSH_SIZES = f"{CACHE_NS}:lsh3:n"   # hash: type|lang partition -> entries tracked in CACHE_POP_ZSET
+CACHE_LOCK_PREFIX = f"{CACHE_NS}:lock:"  # single-flight leases across workers/nodes
+
+# Similarity index (char n-gram MinHash + LSH banding, partitioned by type|lang)
+SIM_NGRAM = 3
+SIM_BANDS = 16
+SIM_ROWS = 3                             # SIM_BANDS * SIM_ROWS MinHash slots
+SIM_BUCKET_MIN = 64                      # most popular keys kept per bucket (at least) ...
+SIM_BUCKET_SHARE = 0.005                 # ... or this share of the bucket's type|lang partition
+SIM_RERANK_TOP = 8                       # candidates re-ranked with SequenceMatcher
+
+# In-memory L1 tier (per process): byte-bounded LRU with the same TTL as Redis
+LOCAL_CACHE_BYTES = int(os.getenv("LOCAL_CACHE_BYTES", str(8 * 1024 * 1024)))
+LOCAL_CACHE_TTL = min(CACHE_TTL_DEFAULT, CACHE_SOFT_TTL)  # L1 never outlives freshness; Redis decides staleness
+LOCAL_CACHE_ADMISSION = os.getenv("LOCAL_CACHE_ADMISSION", "1") == "1"   # TinyLFU admission when full
+
+# Host-local L2 tier shared by all workers (SQLite WAL + mmap); empty path = disabled
+L2_PATH = os.getenv("L2_PATH", "")
+L2_MAX_BYTES = int(os.getenv("L2_MAX_BYTES", str(256 * 1024 * 1024)))
+L2_MMAP_BYTES = int(os.getenv("L2_MMAP_BYTES", str(256 * 1024 * 1024)))
+L2_TOUCH_SECS = 300                      # refresh an entry's access time at most this often
 
 # Forbidden brand words in outputs
 FORBIDDEN = ["chatgpt", "openai", "midjourney", "dall", "google", "bard", "claude", "gpt"]
 
+# ------------ Metrics (Prometheus text format, no extra deps) ------------
+# عدّادات وهيستوغرامات خفيفة: قفل واحد لكل مقياس، وbisect لاختيار الحاوية
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SCORE_BUCKETS = (0.5, 0.6, 0.7, 0.75, 0.8, 0.84, 0.86, 0.88, 0.9, 0.95, 0.99, 1.0)
+KNOWN_TYPES = ("text", "image", "video", "code")
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0.0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for lv, v in items:
+            yield f"{self.name}{_label_str(self.labels, lv)} {v}"
+
+class Gauge(Counter):
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        for line in super().render():
+            yield line.replace(" counter", " gauge") if line.startswith("# TYPE") else line
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(label_values)
+            if s is None:
+                s = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1  # العدّ تراكمي عند العرض فقط
+            s[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(lv, list(s)) for lv, s in self._series.items()]
+        for lv, s in items:
+            acc = 0
+            for b, c in zip(self.buckets, s):
+                acc += c
+                yield f"{self.name}_bucket{_label_str(self.labels + ('le',), lv + (repr(float(b)),))} {acc}"
+            acc += s[len(self.buckets)]
+            yield f"{self.name}_bucket{_label_str(self.labels + ('le',), lv + ('+Inf',))} {acc}"
+            yield f"{self.name}_sum{_label_str(self.labels, lv)} {s[-1]}"
+            yield f"{self.name}_count{_label_str(self.labels, lv)} {acc}"
+
+def _label_str(names, values) -> str:
+    if not names:
+        return ""
+    esc = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, esc)) + "}"
+
+def metric_type(ptype: str) -> str:
+    """Bound label cardinality: free-form request types collapse to "other"."""
+    return ptype if ptype in KNOWN_TYPES else "other"
+
+STAGE_SECONDS = Histogram("pg_stage_seconds", "Latency of each /generate stage.", ("stage", "ptype", "lang"))
+REQUEST_SECONDS = Histogram("pg_request_seconds", "End-to-end latency by endpoint and outcome.", ("endpoint", "outcome"))
+OUTCOMES = Counter("pg_outcomes_total", "Requests by resolution path (rule/l1/redis_exact/similarity/coalesced/miss).",
+                   ("outcome", "ptype", "lang"))
+SIMILARITY_SCORE = Histogram("pg_similarity_score",
+                             "SequenceMatcher ratio of re-ranked candidates that passed the cheap prefilter.",
+                             ("decision",), SCORE_BUCKETS)
+SIMILARITY_PREFILTERED = Counter("pg_similarity_prefiltered_total",
+                                 "Re-rank candidates dropped by the length/quick_ratio bound before a full ratio.",
+                                 ("bound",))
+MODEL_TOKENS = Counter("pg_model_tokens_total", "Model token usage.", ("kind", "ptype", "lang"))
+REDIS_ERRORS = Counter("pg_redis_errors_total", "Redis errors by operation.", ("op",))
+CACHE_ENTRY_BYTES = Counter("pg_cache_entry_bytes_total",
+                            "Bytes of cache entries written, packed vs. what the legacy val+meta layout would use.",
+                            ("format",))
+CACHE_LEGACY_READS = Counter("pg_cache_legacy_reads_total", "Cache hits served from the legacy val/meta layout.")
+METRICS = [STAGE_SECONDS, REQUEST_SECONDS, OUTCOMES, SIMILARITY_SCORE, SIMILARITY_PREFILTERED, MODEL_TOKENS,
+           REDIS_ERRORS, CACHE_ENTRY_BYTES, CACHE_LEGACY_READS]
+
+def observe_stage(stage: str, ptype: str, lang: str, t0: float) -> float:
+    """Record perf_counter() - t0 for a stage; returns the new perf_counter() for chaining."""
+    t1 = time.perf_counter()
+    STAGE_SECONDS.observe(t1 - t0, stage, metric_type(ptype), lang)
+    return t1
+
+def redis_error(op: str, e: Exception):
+    REDIS_ERRORS.inc(op)
+    backend.failure()
+    logging.warning(f"⚠️ Redis {op} failed: {e}")
+
+def render_metrics() -> str:
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+# ------------ Redis Backend (pool + timeouts + circuit breaker + async writes) ------------
+# Redis اختياري: عند البطء أو الانقطاع يفتح القاطع ونعمل على الطبقة المحلية فقط،
+# وخيط خلفي يعيد الاتصال. الكتابات تُرسل عبر طابور وتُنفَّذ دفعةً واحدة في pipeline.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.25"))          # per command (s)
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.25"))
+REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", "5"))           # failures in window => open
+REDIS_BREAKER_WINDOW = float(os.getenv("REDIS_BREAKER_WINDOW", "10"))
+REDIS_RECONNECT_SECS = float(os.getenv("REDIS_RECONNECT_SECS", "2"))
+REDIS_WRITE_QUEUE_MAX = int(os.getenv("REDIS_WRITE_QUEUE_MAX", "10000"))
+REDIS_WRITE_BATCH = 64
+
+REDIS_BREAKER_OPEN = Gauge("pg_redis_breaker_open", "1 while the Redis circuit breaker is open.")
+REDIS_WRITES = Counter("pg_redis_writes_total", "Queued Redis writes by result (flushed/dropped/failed).", ("result",))
+METRICS.extend([REDIS_BREAKER_OPEN, REDIS_WRITES])
+
+class CacheBackend:
+    """
+    Owns the Redis connection pool. Readers call client() (None while the breaker
+    is open) and report errors through failure(); writers call submit(fn) where
+    fn(pipe) queues commands, flushed in batches by one background thread so
+    request threads never wait on Redis writes. FIFO order is preserved.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self._client = None
+        self._lock = threading.Lock()
+        self._failures = deque()
+        self.state = "open"  # حتى أول ping ناجح
+        self.opened_at = time.time()
+        self.trips = 0
+        self._wake = threading.Event()
+        self._on_connect = []
+        self._queue = queue.Queue(maxsize=REDIS_WRITE_QUEUE_MAX)
+        self._threads_started = False
+
+    # ----- connection lifecycle -----
+    def start(self):
+        try:
+            pool = redis.ConnectionPool.from_url(
+                self.url,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                health_check_interval=30,
+            )
+            self._client = redis.Redis(connection_pool=pool)
+        except Exception as e:
+            logging.warning(f"⚠️ Redis not available: {e}")
+            return
+        self._try_connect()
+        if not self._threads_started:
+            self._threads_started = True
+            threading.Thread(target=self._reconnect_loop, name="redis-reconnect", daemon=True).start()
+            threading.Thread(target=self._writer_loop, name="redis-writer", daemon=True).start()
+
+    def attach(self, client):
+        """Use an existing client (tests/benchmarks); marks the backend healthy."""
+        self._client = client
+        if not self._threads_started:
+            self._threads_started = True
+            threading.Thread(target=self._reconnect_loop, name="redis-reconnect", daemon=True).start()
+            threading.Thread(target=self._writer_loop, name="redis-writer", daemon=True).start()
+        self._try_connect()
+
+    def _try_connect(self) -> bool:
+        try:
+            self._client.ping()
+        except Exception as e:
+            if self.state != "open":
+                self._open()
+            logging.warning(f"⚠️ Redis not available: {e}")
+            return False
+        with self._lock:
+            self._failures.clear()
+            was_open, self.state = self.state == "open", "closed"
+        REDIS_BREAKER_OPEN.set(0)
+        if was_open:
+            logging.info("✅ Redis connected")
+            for fn in list(self._on_connect):
+                try:
+                    fn()
+                except Exception as e:
+                    logging.warning(f"⚠️ Redis on-connect hook failed: {e}")
+        return True
+
+    def _reconnect_loop(self):
+        while True:
+            self._wake.wait(REDIS_RECONNECT_SECS)
+            self._wake.clear()
+            if self.state == "open" and self._client is not None:
+                self._try_connect()
+
+    def on_connect(self, fn):
+        """Run fn after every (re)connect, and now if already connected."""
+        self._on_connect.append(fn)
+        if self.state == "closed":
+            fn()
+
+    # ----- circuit breaker -----
+    def client(self):
+        """The Redis client, or None while Redis is unavailable."""
+        return self._client if self.state == "closed" else None
+
+    def failure(self):
+        now = time.time()
+        with self._lock:
+            self._failures.append(now)
+            while self._failures and self._failures[0] < now - REDIS_BREAKER_WINDOW:
+                self._failures.popleft()
+            trip = self.state == "closed" and len(self._failures) >= REDIS_BREAKER_FAILURES
+        if trip:
+            self._open()
+
+    def _open(self):
+        with self._lock:
+            if self.state == "open":
+                return
+            self.state, self.opened_at = "open", time.time()
+            self.trips += 1
+        REDIS_BREAKER_OPEN.set(1)
+        logging.warning("⚠️ Redis circuit breaker opened; serving from local cache only")
+        self._wake.set()
+
+    # ----- async writes -----
+    def submit(self, fn) -> bool:
+        """Queue fn(pipe) for the writer thread; False if dropped (breaker open or queue full)."""
+        if self.state != "closed":
+            REDIS_WRITES.inc("dropped")
+            return False
+        try:
+            self._queue.put_nowait(fn)
+            return True
+        except queue.Full:
+            REDIS_WRITES.inc("dropped")
+            return False
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < REDIS_WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                c = self.client()
+                if c is None:
+                    REDIS_WRITES.inc("dropped", amount=len(batch))
+                    continue
+                pipe = c.pipeline(transaction=False)
+                for fn in batch:
+                    fn(pipe)
+                pipe.execute()
+                REDIS_WRITES.inc("flushed", amount=len(batch))
+            except Exception as e:
+                REDIS_WRITES.inc("failed", amount=len(batch))
+                redis_error("write", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until queued writes are executed (tests/benchmarks/shutdown)."""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.002)
+        return not self._queue.unfinished_tasks
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "trips": self.trips,
+            "recent_failures": len(self._failures),
+            "opened_at": self.opened_at if self.state == "open" else None,
+            "write_queue": self._queue.qsize(),
+            "write_queue_max": REDIS_WRITE_QUEUE_MAX,
+        }
+
+backend = CacheBackend(REDIS_URL)
+backend.start()
+
+def redis_client():
+    return backend.client()
+
 # ------------ Text Normalization (AR/EN) ------------
 AR_DIACRITICS = re.compile(r'[\u064B-\u0652]')
 PUNCT = re.compile(r'[^\w\s\u0600-\u06FF]')  # احتفظ بحروف العربية
@@ -96,90 +433,1187 @@ def is_arabic_text(t: str) -> bool:
 def sha1(s: str) -> str:
     return hashlib.sha1(s.encode("utf-8")).hexdigest()
 
-# ------------ Smart Cache: exact + partial similarity ------------
-def _local_lru_get(lk: str):
-    if lk in local_map:
+# ------------ Cache Entry Encoding (one packed record per key) ------------
+# سجل واحد لكل مدخل بدل val + meta(JSON): ترويسة ثنائية (إصدار، أعلام، وقت، طول النص المطبَّع)
+# ثم الجسم (النص المطبَّع + البرومبت) مضغوطًا بقاموس zlib مسبق مضبوط على برومبتات AR/EN.
+# النوع واللغة موجودان في المفتاح أصلًا فلا نكررهما.
+CACHE_ENTRY_PREFIX = f"{CACHE_NS}:e:"    # packed record per key
+CACHE_FMT_MARKER = f"{CACHE_NS}:fmt:1"   # legacy val/meta entries migrated for this dataset
+CACHE_LEGACY_READ = os.getenv("CACHE_LEGACY_READ", "1") == "1"  # also read pg:val/pg:meta until migrated
+CACHE_ZLIB_LEVEL = int(os.getenv("CACHE_ZLIB_LEVEL", "6"))
+
+_ENTRY_V1 = 1
+_ENTRY_HEADER = struct.Struct(">BBII")   # version, flags, ts (epoch s), len(norm utf-8)
+_ENTRY_ZLIB = 0x01                       # body is raw deflate with _ZDICT_V1
+
+# القاموس جزء من الصيغة: أي تعديل عليه يحتاج إصدارًا جديدًا، لا تعديل هذا.
+# zlib يفضّل العبارات الأكثر تكرارًا في آخر القاموس.
+_ZDICT_V1 = "\n".join((
+    "architecture, documentation, performance, accessibility, responsive layout, error handling, unit tests",
+    "function, class, module, input validation, edge cases, example usage, expected output, comments",
+    "Python, JavaScript, HTML, CSS, SQL, API, JSON, clean code, best practices, step by step",
+    "cinematic, slow motion, tracking shot, drone shot, close-up, wide angle, shallow depth of field",
+    "golden hour, soft lighting, dramatic lighting, neon lights, volumetric light, reflections, rain",
+    "highly detailed, photorealistic, ultra realistic, 8k, 4k, sharp focus, vibrant colors, color palette",
+    "background, foreground, atmosphere, mood, composition, texture, style, scene, camera angle",
+    "tone, audience, format, structure, length, headline, introduction, conclusion, call to action",
+    "كود نظيف، لغة البرمجة، دالة، مثال للاستخدام، معالجة الأخطاء، تعليقات مختصرة، المدخلات والمخرجات",
+    "لقطة سينمائية، حركة بطيئة، زاوية الكاميرا، لقطة قريبة، لقطة واسعة، إضاءة درامية، الغروب، المطر",
+    "تفاصيل دقيقة، ألوان زاهية، إضاءة ناعمة، خلفية، الأسلوب، المزاج، الأجواء، التكوين، واقعية عالية",
+    "اكتب نصًا واضحًا ومختصرًا، الجمهور المستهدف، النبرة، الهيكل، مقدمة، خاتمة، دعوة لاتخاذ إجراء",
+    "في من على إلى عن مع هذا هذه التي الذي كل بين حول عند بعد قبل أن أو ثم مع وصف مشهد صورة فيديو",
+    "the a an of in on at with and for to from by as is are that this your into over under while",
+    "Create a detailed prompt for Write a clear Describe a scene of Generate an image of a video of",
+)).encode("utf-8")
+
+_encode_stats_lock = threading.Lock()
+_encode_stats = {"entries": 0, "stored_bytes": 0, "legacy_bytes": 0}
+# طول meta القديم بلا نصوص متغيرة (ts عشري كما يكتبه time.time())
+_LEGACY_META_FIXED = len(json.dumps({"norm": "", "type": "", "lang": "", "ts": 1700000000.123456}))
+
+def encode_entry(norm_text: str, prompt: str, ts: float = None) -> bytes:
+    """Pack one cache entry; the body is compressed only when that makes it smaller."""
+    norm_b = norm_text.encode("utf-8")
+    body = norm_b + prompt.encode("utf-8")
+    flags = 0
+    c = zlib.compressobj(CACHE_ZLIB_LEVEL, zlib.DEFLATED, -15, zdict=_ZDICT_V1)
+    packed = c.compress(body) + c.flush()
+    if len(packed) < len(body):
+        body, flags = packed, _ENTRY_ZLIB
+    ts = int(time.time() if ts is None else ts)
+    return _ENTRY_HEADER.pack(_ENTRY_V1, flags, ts, len(norm_b)) + body
+
+def decode_entry(raw: bytes):
+    """Unpack a record from encode_entry -> (norm, prompt, ts); ValueError on unknown/corrupt data."""
+    if len(raw) < _ENTRY_HEADER.size:
+        raise ValueError("short cache entry")
+    ver, flags, ts, norm_len = _ENTRY_HEADER.unpack_from(raw)
+    if ver != _ENTRY_V1:
+        raise ValueError(f"unknown cache entry version {ver}")
+    body = raw[_ENTRY_HEADER.size:]
+    if flags & _ENTRY_ZLIB:
         try:
-            local_lru.remove(lk)
-        except ValueError:
-            pass
-        local_lru.append(lk)
-        return local_map[lk]
-    return None
+            d = zlib.decompressobj(-15, zdict=_ZDICT_V1)
+            body = d.decompress(body) + d.flush()
+        except zlib.error as e:
+            raise ValueError(f"corrupt cache entry: {e}")
+    return body[:norm_len].decode("utf-8"), body[norm_len:].decode("utf-8"), ts
 
-def _local_lru_put(lk: str, val: str):
-    if lk in local_map:
+def legacy_entry(meta_raw, val_raw, norm_text: str = None, pttl_ms: int = None):
+    """
+    Read the old pg:meta (JSON) + pg:val layout -> (norm, prompt, ts), or None.
+    Without a meta timestamp, ts is recovered from the val key's remaining TTL (written with CACHE_TTL_DEFAULT).
+    """
+    if not val_raw:
+        return None
+    meta = {}
+    if meta_raw:
         try:
-            local_lru.remove(lk)
-        except ValueError:
-            pass
-    elif len(local_lru) >= LOCAL_LRU_MAX:
-        oldest = local_lru.popleft()
-        local_map.pop(oldest, None)
-    local_lru.append(lk)
-    local_map[lk] = val
+            meta = json.loads(meta_raw.decode("utf-8"))
+        except Exception:
+            meta = {}
+    norm = meta.get("norm", norm_text)
+    if norm is None:
+        return None
+    ts = meta.get("ts")
+    if ts is None:
+        ts = time.time()
+        if pttl_ms is not None and pttl_ms > 0:
+            ts -= CACHE_TTL_DEFAULT - min(pttl_ms / 1000.0, CACHE_TTL_DEFAULT)
+    return norm, val_raw.decode("utf-8"), ts
+
+def record_entry_bytes(key: str, norm_text: str, ptype: str, lang: str, prompt: str, blob: bytes):
+    """
+    Track packed vs. legacy (val + JSON meta) key+value bytes per entry for /health and /metrics.
+    The legacy meta size is worked out from lengths instead of serialising it: normalized text has
+    no quotes or backslashes, and json.dumps writes each non-ASCII (2-byte Arabic) char as \\uXXXX.
+    """
+    stored = len(CACHE_ENTRY_PREFIX + key) + len(blob)
+    norm_bytes = _ENTRY_HEADER.unpack_from(blob)[3]
+    norm_json = len(norm_text) + 5 * (norm_bytes - len(norm_text))
+    legacy = (len(CACHE_VAL_PREFIX + key) + len(prompt.encode("utf-8"))
+              + len(CACHE_META_PREFIX + key) + _LEGACY_META_FIXED + norm_json + len(ptype) + len(lang))
+    with _encode_stats_lock:
+        _encode_stats["entries"] += 1
+        _encode_stats["stored_bytes"] += stored
+        _encode_stats["legacy_bytes"] += legacy
+    CACHE_ENTRY_BYTES.inc("packed", amount=stored)
+    CACHE_ENTRY_BYTES.inc("legacy", amount=legacy)
+
+def encoding_stats() -> dict:
+    with _encode_stats_lock:
+        s = dict(_encode_stats)
+    n = s["entries"] or 1
+    return {
+        "entries_written": s["entries"],
+        "bytes_per_entry": round(s["stored_bytes"] / n, 1),
+        "legacy_bytes_per_entry": round(s["legacy_bytes"] / n, 1),
+        "ratio": round(s["stored_bytes"] / (s["legacy_bytes"] or 1), 3),
+    }
+
+def read_entries(cache, keys, norms=None):
+    """
+    Fetch cache entries in one round trip -> {key: (norm, prompt, ts)} for hits.
+    With CACHE_LEGACY_READ, the old val/meta pair (and the val PTTL) is read in the same
+    pipeline and migrated to a packed record in the background. `norms` (key -> normalized text)
+    lets exact lookups skip the legacy meta read; the age then comes from the PTTL.
+    """
+    pipe = cache.pipeline(transaction=False)
+    queue_entry_reads(pipe, keys, norms)
+    return parse_entries(keys, pipe.execute(), norms)
+
+def queue_entry_reads(pipe, keys, norms=None):
+    """Queue the reads of read_entries on a pipeline (sync or asyncio client)."""
+    for k in keys:
+        pipe.get(CACHE_ENTRY_PREFIX + k)
+        if CACHE_LEGACY_READ:
+            pipe.get(CACHE_VAL_PREFIX + k)
+            pipe.pttl(CACHE_VAL_PREFIX + k)
+            if norms is None:
+                pipe.get(CACHE_META_PREFIX + k)
+
+def parse_entries(keys, res, norms=None):
+    """Decode the pipeline results of queue_entry_reads -> {key: (norm, prompt, ts)}."""
+    step = 1 + CACHE_LEGACY_READ * (2 + (norms is None))
+    out = {}
+    for i, k in enumerate(keys):
+        raw = res[i * step]
+        if raw:
+            try:
+                out[k] = decode_entry(raw)
+                continue
+            except ValueError as e:
+                logging.warning(f"⚠️ Bad cache entry {k}: {e}")
+        if CACHE_LEGACY_READ:
+            meta_raw = res[i * step + 3] if norms is None else None
+            ent = legacy_entry(meta_raw, res[i * step + 1], norms.get(k) if norms else None, res[i * step + 2])
+            if ent is not None:
+                out[k] = ent
+                CACHE_LEGACY_READS.inc()
+                _migrate_entry(k, *ent)
+    return out
+
+def _migrate_entry(key: str, norm_text: str, prompt: str, ts: float):
+    """Rewrite one legacy entry as a packed record (keeping its remaining TTL) and drop the old keys."""
+    ttl = int(ts + CACHE_TTL_DEFAULT - time.time())
+    blob = encode_entry(norm_text, prompt, ts) if ttl > 0 else None
+
+    def write(pipe):
+        if blob is not None:
+            pipe.setex(CACHE_ENTRY_PREFIX + key, ttl, blob)
+        pipe.delete(CACHE_VAL_PREFIX + key, CACHE_META_PREFIX + key)
+
+    backend.submit(write)
+
+def migrate_legacy_cache():
+    """
+    Convert entries listed in the legacy recent-keys list (runs once per Redis dataset):
+    packed records for val/meta pairs, popularity seeded from how often each key was listed,
+    then the list is dropped. Returns live entries seen.
+    """
+    cache = redis_client()
+    if not cache or not cache.set(CACHE_FMT_MARKER, "1", nx=True):
+        return 0
+    listed = {}
+    for raw in cache.lrange(CACHE_KEYS_LIST, 0, CACHE_KEYS_MAX - 1):
+        k = raw.decode("utf-8")
+        listed[k] = listed.get(k, 0) + 1
+    keys = list(listed)
+    n = 0
+    for i in range(0, len(keys), 200):
+        found = read_entries(cache, keys[i:i + 200]) if CACHE_LEGACY_READ else dict.fromkeys(keys[i:i + 200])
+        for k, ent in found.items():
+            cache_touch(k, listed[k], ent[0] if ent else None)
+        n += len(found)
+    backend.submit(lambda pipe: pipe.delete(CACHE_KEYS_LIST))
+    return n
+
+# ------------ Cache Popularity (decayed frequency, bounded) ------------
+# بدل قائمة آخر N مفتاح (مع تكرارات): zset واحد بلا تكرار، درجته log2 لتكرار الاستخدام المتضائل زمنيًا.
+# كل استخدام يضيف 2^(now/half_life) — نجمعها في فضاء اللوغاريتم فلا يفيض الرقم — فالترتيب يعكس
+# الشعبية الحديثة. ما زاد عن CACHE_MAX_ENTRIES يُحذف الأقل شعبية أولًا مع سجله.
+# نفس الدرجة تُكتب في حزم LSH الخاصة بالمدخل (KEYS[3..]) فتبقى الحزم مرتبة بالشعبية لا بالأحدث،
+# وسعة الحزمة تكبر مع حجم قسمها (type|lang) المحفوظ في KEYS[2].
+_POP_TOUCH_LUA = """
+local x = tonumber(ARGV[2])
+local part = string.match(ARGV[1], '^([^|]*|[^|]*)|') or ''
+local s = redis.call('zscore', KEYS[1], ARGV[1])
+if s then
+  s = tonumber(s)
+  local hi, lo = math.max(s, x), math.min(s, x)
+  x = hi + math.log(1 + 2 ^ (lo - hi)) / math.log(2)
+else
+  redis.call('hincrby', KEYS[2], part, 1)
+end
+redis.call('zadd', KEYS[1], x, ARGV[1])
+if #KEYS > 2 then
+  local n = tonumber(redis.call('hget', KEYS[2], part)) or 0
+  local cap = math.max(tonumber(ARGV[5]), math.ceil(n * tonumber(ARGV[6])))
+  for i = 3, #KEYS do
+    redis.call('zadd', KEYS[i], x, ARGV[1])
+    redis.call('zremrangebyrank', KEYS[i], 0, -(cap + 1))
+    redis.call('expire', KEYS[i], ARGV[7])
+  end
+end
+local over = redis.call('zcard', KEYS[1]) - tonumber(ARGV[3])
+if over > 0 then
+  local gone = redis.call('zpopmin', KEYS[1], over)
+  for i = 1, #gone, 2 do
+    redis.call('del', ARGV[4] .. gone[i])
+    redis.call('hincrby', KEYS[2], string.match(gone[i], '^([^|]*|[^|]*)|') or '', -1)
+  end
+end
+return tostring(x)
+"""
+
+_pop_lock = threading.Lock()
+_pop_pending = {}  # cache key -> [uses not yet sent to Redis, normalized text or None]
+
+def popularity_score(uses: float, now: float = None) -> float:
+    """log2 of `uses` weighted at time `now` (what one touch adds in _POP_TOUCH_LUA)."""
+    return (time.time() if now is None else now) / CACHE_POP_HALF_LIFE + math.log2(uses)
+
+def _pop_touch(pipe, key: str, uses: float = 1, norm_text: str = None):
+    """Queue a popularity update; with norm_text the entry's LSH buckets get the same score."""
+    buckets = []
+    if norm_text:
+        ptype, lang, _ = key.split("|", 2)
+        buckets = lsh_bucket_keys(norm_text, ptype, lang)
+    pipe.eval(_POP_TOUCH_LUA, 2 + len(buckets), CACHE_POP_ZSET, CACHE_LSH_SIZES, *buckets,
+              key, repr(popularity_score(uses)), CACHE_MAX_ENTRIES, CACHE_ENTRY_PREFIX,
+              SIM_BUCKET_MIN, SIM_BUCKET_SHARE, CACHE_TTL_DEFAULT)
+
+def cache_touch(key: str, uses: float = 1, norm_text: str = None):
+    """
+    Count a use of a cached entry; bursts on the same key collapse into one queued write.
+    Pass norm_text when known so the entry also moves up in its similarity buckets.
+    """
+    with _pop_lock:
+        pending = _pop_pending.get(key)
+        if pending is None:
+            _pop_pending[key] = [uses, norm_text]
+        else:
+            pending[0] += uses
+            pending[1] = pending[1] or norm_text
+    if pending is not None:
+        return
+
+    def write(pipe):
+        with _pop_lock:
+            n, norm = _pop_pending.pop(key, (0, None))
+        if n:
+            _pop_touch(pipe, key, n, norm)
+
+    if not backend.submit(write):
+        with _pop_lock:
+            _pop_pending.pop(key, None)
+
+def window_keys(cache, n: int = CACHE_KEYS_MAX):
+    """Most popular cache keys (plus any still in the legacy recent-keys list), deduplicated."""
+    keys = [raw.decode("utf-8") for raw in cache.zrevrange(CACHE_POP_ZSET, 0, n - 1)]
+    keys += [raw.decode("utf-8") for raw in cache.lrange(CACHE_KEYS_LIST, 0, n - 1)]
+    return list(dict.fromkeys(keys))[:n]
+
+# ------------ Similarity Index (n-gram MinHash / LSH) ------------
+# كل مدخل يُقسَّم إلى n-grams، ثم توقيع MinHash يُقطَّع إلى حزم (bands).
+# المدخلات المتشابهة تقع في نفس الحزمة، فنعيد ترتيب عدد صغير فقط بدل مسح كل المفاتيح.
+_MASK64 = (1 << 64) - 1
+SIM_SLOTS = SIM_BANDS * SIM_ROWS
+
+def _shingles(norm_text: str):
+    t = f" {norm_text} "
+    if len(t) <= SIM_NGRAM:
+        return {t}
+    return {t[i:i + SIM_NGRAM] for i in range(len(t) - SIM_NGRAM + 1)}
+
+def minhash_signature(norm_text: str):
+    """
+    One-permutation MinHash: each shingle is hashed once into one of SIM_SLOTS bins
+    (min per bin), empty bins borrow from the next filled bin (rotation densification).
+    O(shingles) instead of O(shingles * permutations); deterministic across processes.
+    """
+    sig = [None] * SIM_SLOTS
+    for g in _shingles(norm_text):
+        h = (zlib.crc32(g.encode("utf-8")) * 0x9E3779B97F4A7C15) & _MASK64
+        b, v = h % SIM_SLOTS, h >> 8
+        cur = sig[b]
+        if cur is None or v < cur:
+            sig[b] = v
+    if None in sig:
+        dense = list(sig)
+        for j in range(SIM_SLOTS):
+            if sig[j] is None:
+                d = 1
+                while sig[(j + d) % SIM_SLOTS] is None:
+                    d += 1
+                dense[j] = sig[(j + d) % SIM_SLOTS] + d * 0x9E3779B9
+        sig = dense
+    return sig
+
+def lsh_bucket_keys(norm_text: str, ptype: str, lang: str):
+    """Redis keys of the LSH buckets this text falls into (one per band)."""
+    sig = minhash_signature(norm_text)
+    part = f"{CACHE_LSH_PREFIX}{ptype}|{lang}:"
+    out = []
+    for b in range(SIM_BANDS):
+        band = sig[b * SIM_ROWS:(b + 1) * SIM_ROWS]
+        h = zlib.crc32(",".join(map(str, band)).encode("ascii"))
+        out.append(f"{part}{b}:{h:08x}")
+    return out
+
+def _sim_index_add(pipe, key: str, norm_text: str, ptype: str, lang: str, score: float, cap: int):
+    """Queue index writes for one cache key (at its popularity score) on an open Redis pipeline."""
+    for bk in lsh_bucket_keys(norm_text, ptype, lang):
+        pipe.zadd(bk, {key: score})
+        pipe.zremrangebyrank(bk, 0, -(cap + 1))
+        pipe.expire(bk, CACHE_TTL_DEFAULT)
+
+def bucket_cap(partition_size: int) -> int:
+    return max(SIM_BUCKET_MIN, math.ceil(partition_size * SIM_BUCKET_SHARE))
+
+def similarity_lookup(norm_text: str, ptype: str, lang: str, similarity_threshold: float = 0.86):
+    """Best cached prompt with SequenceMatcher ratio >= threshold, or None."""
+    cache = redis_client()
+    if not cache:
+        return None
+    pipe = cache.pipeline()
+    queue_bucket_reads(pipe, norm_text, ptype, lang)
+    top = similarity_candidates(pipe.execute())
+    if not top:
+        return None
+    return similarity_pick(norm_text, ptype, lang, top, read_entries(cache, top), similarity_threshold)
+
+def queue_bucket_reads(pipe, norm_text: str, ptype: str, lang: str):
+    for bk in lsh_bucket_keys(norm_text, ptype, lang):
+        pipe.zrevrange(bk, 0, -1)  # محدودة بـ bucket_cap عند الكتابة
+
+def similarity_candidates(bucket_members):
+    """Cache keys seen in the most LSH buckets (at most SIM_RERANK_TOP)."""
+    hits = {}
+    for members in bucket_members:
+        for raw in members:
+            hits[raw] = hits.get(raw, 0) + 1
+    # أكثر المرشحين تصادمًا في الحزم = أعلى تشابه تقديري
+    return [raw.decode("utf-8") for raw in sorted(hits, key=hits.get, reverse=True)[:SIM_RERANK_TOP]]
+
+def similarity_pick(norm_text: str, ptype: str, lang: str, top, entries, similarity_threshold: float):
+    """Re-rank candidate entries with SequenceMatcher; touches/refreshes the winner. Returns prompt or None."""
+    best_k, best_v, best_sim = None, None, 0.0
+    best_norm, best_ts = "", 0
+    scores = []
+    dropped_len = dropped_quick = 0
+    n = len(norm_text)
+    for k in top:
+        ent = entries.get(k)
+        if ent is None:
+            continue
+        prev_norm, val = ent[0], ent[1]
+        # حد أعلى رخيص لنسبة SequenceMatcher قبل الحساب الكامل
+        if 2.0 * min(n, len(prev_norm)) / ((n + len(prev_norm)) or 1) < max(similarity_threshold, best_sim):
+            dropped_len += 1
+            continue
+        sm = SequenceMatcher(a=norm_text, b=prev_norm)
+        if sm.quick_ratio() < similarity_threshold:
+            dropped_quick += 1
+            continue
+        sim = sm.ratio()
+        scores.append(sim)
+        if sim > best_sim:
+            best_sim, best_v, best_k = sim, val, k
+            best_norm, best_ts = prev_norm, ent[2]
+    accepted = best_v is not None and best_sim >= similarity_threshold
+    for sim in scores:
+        SIMILARITY_SCORE.observe(sim, "accepted" if accepted and sim == best_sim else "rejected")
+    if dropped_len:
+        SIMILARITY_PREFILTERED.inc("length", amount=dropped_len)
+    if dropped_quick:
+        SIMILARITY_PREFILTERED.inc("quick_ratio", amount=dropped_quick)
+    if accepted:
+        cache_touch(best_k, norm_text=best_norm)
+        if time.time() - best_ts >= CACHE_SOFT_TTL:
+            CACHE_STALE_SERVED.inc("similarity")
+            schedule_refresh(best_k, best_norm, ptype, lang)
+        return best_v
+    return None
 
-def cache_store(norm_text: str, ptype: str, lang: str, prompt: str):
-    """Store prompt in Redis (if available) and local LRU."""
-    key = f"{ptype}|{lang}|{sha1(norm_text)}"
-    _local_lru_put(key, prompt)
-    if cache:
+def rebuild_similarity_index():
+    """
+    Index entries from the popularity window at their popularity scores (runs once per Redis dataset);
+    partition sizes are recounted from the whole popularity zset first.
+    """
+    cache = redis_client()
+    if not cache or not cache.set(CACHE_LSH_READY, "1", nx=True):
+        return 0
+    sizes, scores = {}, {}
+    for raw, score in cache.zscan_iter(CACHE_POP_ZSET, count=1000):
+        k = raw.decode("utf-8")
+        part = k.rsplit("|", 1)[0]
+        sizes[part] = sizes.get(part, 0) + 1
+        scores[k] = score
+    cache.delete(CACHE_LSH_SIZES)
+    if sizes:
+        cache.hset(CACHE_LSH_SIZES, mapping=sizes)
+    keys = window_keys(cache)
+    n = 0
+    for i in range(0, len(keys), 200):
+        entries = read_entries(cache, keys[i:i + 200])
         pipe = cache.pipeline()
-        pipe.setex(CACHE_VAL_PREFIX + key, CACHE_TTL_DEFAULT, prompt)
-        meta = json.dumps({"norm": norm_text, "type": ptype, "lang": lang, "ts": time.time()})
-        pipe.setex(CACHE_META_PREFIX + key, CACHE_TTL_DEFAULT, meta)
-        pipe.lpush(CACHE_KEYS_LIST, key)
-        pipe.ltrim(CACHE_KEYS_LIST, 0, CACHE_KEYS_MAX - 1)
+        for k, (norm, _, _) in entries.items():
+            ptype, lang, _ = k.split("|", 2)
+            _sim_index_add(pipe, k, norm, ptype, lang, scores.get(k, 0.0),
+                           bucket_cap(sizes.get(f"{ptype}|{lang}", 0)))
         pipe.execute()
+        n += len(entries)
+    return n
+
+def _rebuild_similarity_index_hook():
+    try:
+        rebuild_similarity_index()
+        migrate_legacy_cache()
+    except Exception as e:
+        logging.warning(f"⚠️ Similarity index rebuild skipped: {e}")
+
+backend.on_connect(_rebuild_similarity_index_hook)
+
+# ------------ Smart Cache: exact + partial similarity ------------
+class FrequencySketch:
+    """
+    Count-min sketch of recent access counts (4 rows, 4-bit style cap of 15) for TinyLFU.
+    All counters are halved every `sample` increments so old popularity fades.
+    """
+    DEPTH = 4
+    CAP = 15
+
+    def __init__(self, width: int):
+        self.width = 1 << max(4, (width - 1).bit_length())
+        self.mask = self.width - 1
+        self.rows = [[0] * self.width for _ in range(self.DEPTH)]
+        self.sample = 10 * self.width
+        self.added = 0
+
+    def _slots(self, key: str):
+        h = hash(key) & _MASK64
+        h2 = (h >> 32) | 1
+        return [(h + i * h2) & self.mask for i in range(self.DEPTH)]
+
+    def increment(self, key: str):
+        for row, i in zip(self.rows, self._slots(key)):
+            if row[i] < self.CAP:
+                row[i] += 1
+        self.added += 1
+        if self.added >= self.sample:
+            self.added //= 2
+            for row in self.rows:
+                row[:] = [c >> 1 for c in row]
+
+    def estimate(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self.rows, self._slots(key)))
+
+class LocalCache:
+    """
+    Thread-safe LRU with O(1) get/put, per-entry expiry and a byte budget.
+    Size is accounted as UTF-8 bytes of key + value plus a fixed per-entry overhead.
+    With admission on (TinyLFU), a new key is only let in over a full budget if it has been
+    requested at least as often as the LRU victim, so one-off inputs do not flush popular entries.
+    """
+    ENTRY_OVERHEAD = 64
+    AVG_ENTRY_BYTES = 512  # sizes the frequency sketch
+
+    def __init__(self, max_bytes: int, ttl: float, admission: bool = True):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._lock = threading.Lock()
+        self.sketch = FrequencySketch(max(16, max_bytes // self.AVG_ENTRY_BYTES)) if admission else None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+
+    def get(self, key: str):
+        with self._lock:
+            if self.sketch is not None:
+                self.sketch.increment(key)
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[1] <= time.time():
+                del self._data[key]
+                self.bytes -= item[2]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: str, val: str, ttl: float = None):
+        size = len(key.encode("utf-8")) + len(val.encode("utf-8")) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            elif self.sketch is not None and self.bytes + size > self.max_bytes and self._data:
+                victim = next(iter(self._data))
+                if self.sketch.estimate(key) < self.sketch.estimate(victim):
+                    self.rejections += 1
+                    return
+            self._data[key] = (val, expires, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, sz) = self._data.popitem(last=False)
+                self.bytes -= sz
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "admission_rejections": self.rejections,
+        }
+
+local_cache = LocalCache(LOCAL_CACHE_BYTES, LOCAL_CACHE_TTL, LOCAL_CACHE_ADMISSION)
+
+class SharedCache:
+    """
+    Host-local L2 shared by every worker process: one SQLite file in WAL mode (readers never
+    block the writer) with mmap'd reads, holding the same packed records as Redis.
+    Bounded by max_bytes: expired entries go first, then the least recently read.
+    Survives worker restarts, so a recycled worker starts warm; works while Redis is down.
+    Eviction runs on a background thread (every EVICT_EVERY puts, or EVICT_SECS when idle), never in put().
+    """
+    EVICT_EVERY = 64        # puts between size checks
+    EVICT_SECS = 60.0       # idle sweep for expired rows
+    EVICT_FRACTION = 0.1    # share of rows dropped when over budget
+
+    def __init__(self, path: str, max_bytes: int, mmap_bytes: int = L2_MMAP_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mmap_bytes = mmap_bytes
+        self._local = threading.local()
+        self._puts = 0
+        self._evict_lock = threading.Lock()
+        self._evict_wake = None
+        self._evict_pid = None
+        self.rows = None  # row count as of the last evict(), so stats() stays cheap
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, blob BLOB NOT NULL, expires REAL NOT NULL, atime REAL NOT NULL)")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries(atime)")
+        self.rows = self._conn().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _conn(self):
+        # اتصال لكل خيط ولكل عملية (لا نشارك اتصالات SQLite عبر fork)
+        c = getattr(self._local, "conn", None)
+        if c is None or self._local.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=0.05, isolation_level=None, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.execute(f"PRAGMA mmap_size={int(self.mmap_bytes)}")
+            self._local.conn, self._local.pid = c, os.getpid()
+        return c
+
+    def _error(self, op: str, e: Exception):
+        self.errors += 1
+        logging.warning(f"⚠️ L2 {op} failed: {e}")
+
+    def get_many(self, keys):
+        """{key: (norm, prompt, ts)} for live entries among keys."""
+        if not keys:
+            return {}
+        now = time.time()
+        out, touch = {}, []
+        try:
+            c = self._conn()
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = c.execute(
+                    f"SELECT key, blob, atime FROM entries WHERE key IN ({','.join('?' * len(part))}) AND expires > ?",
+                    (*part, now)).fetchall()
+                for k, blob, atime in rows:
+                    try:
+                        out[k] = decode_entry(blob)
+                    except ValueError:
+                        continue
+                    if now - atime > L2_TOUCH_SECS:
+                        touch.append((now, k))
+            if touch:
+                c.executemany("UPDATE entries SET atime = ? WHERE key = ?", touch)
+        except sqlite3.Error as e:
+            self._error("get", e)
+        self.hits += len(out)
+        self.misses += len(keys) - len(out)
+        return out
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def put(self, key: str, blob: bytes, expires: float):
+        try:
+            now = time.time()
+            self._conn().execute("INSERT OR REPLACE INTO entries (key, blob, expires, atime) VALUES (?, ?, ?, ?)",
+                                 (key, blob, expires, now))
+            self._puts += 1
+            if self._puts % self.EVICT_EVERY == 0:
+                self._wake_evictor()
+        except sqlite3.Error as e:
+            self._error("put", e)
+
+    def _wake_evictor(self):
+        # خيط التنظيف لا ينجو من fork؛ نبدأ واحدًا لكل عملية عند أول حاجة
+        with self._evict_lock:
+            if self._evict_pid != os.getpid():
+                self._evict_pid, self._evict_wake = os.getpid(), threading.Event()
+                threading.Thread(target=self._evict_loop, args=(self._evict_wake,), name="l2-evict",
+                                 daemon=True).start()
+        self._evict_wake.set()
+
+    def _evict_loop(self, wake: threading.Event):
+        while True:
+            wake.wait(self.EVICT_SECS)
+            wake.clear()
+            try:
+                self.evict()
+            except sqlite3.Error as e:
+                self._error("evict", e)
+
+    def used_bytes(self) -> int:
+        c = self._conn()
+        pages = c.execute("PRAGMA page_count").fetchone()[0] - c.execute("PRAGMA freelist_count").fetchone()[0]
+        return pages * c.execute("PRAGMA page_size").fetchone()[0]
+
+    def evict(self):
+        """Drop expired rows; while over budget, drop the least recently read EVICT_FRACTION. Refreshes rows."""
+        c = self._conn()
+        n = c.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),)).rowcount
+        rows = c.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        while rows and self.used_bytes() > self.max_bytes:
+            gone = c.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY atime LIMIT ?)",
+                             (max(1, int(rows * self.EVICT_FRACTION)),)).rowcount
+            n, rows = n + gone, rows - gone
+        self.rows = rows
+        self.evictions += n
+        return n
+
+    def clear(self):
+        try:
+            self._conn().execute("DELETE FROM entries")
+            self.rows = 0
+        except sqlite3.Error as e:
+            self._error("clear", e)
+
+    def stats(self) -> dict:
+        """Counters plus size as of the last evict() (no table scan; /health calls this)."""
+        try:
+            used = self.used_bytes()
+        except sqlite3.Error:
+            used = None
+        return {
+            "path": self.path,
+            "size": self.rows,
+            "bytes": used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
+
+def _open_l2():
+    if not L2_PATH:
+        return None
+    try:
+        return SharedCache(L2_PATH, L2_MAX_BYTES)
+    except sqlite3.Error as e:
+        logging.warning(f"⚠️ L2 cache disabled ({L2_PATH}): {e}")
+        return None
+
+l2_cache = _open_l2()
+
+def cache_key(norm_text: str, ptype: str, lang: str) -> str:
+    return f"{ptype}|{lang}|{sha1(norm_text)}"
+
+def cache_store(norm_text: str, ptype: str, lang: str, prompt: str):
+    """Store prompt in local LRU and host L2 now, and in Redis via the async write queue."""
+    key = cache_key(norm_text, ptype, lang)
+    local_cache.put(key, prompt)
+    blob = encode_entry(norm_text, prompt)
+    record_entry_bytes(key, norm_text, ptype, lang, prompt, blob)
+    if l2_cache is not None:
+        l2_cache.put(key, blob, time.time() + CACHE_TTL_DEFAULT)
+
+    def write(pipe):
+        pipe.setex(CACHE_ENTRY_PREFIX + key, CACHE_TTL_DEFAULT, blob)
+        _pop_touch(pipe, key, norm_text=norm_text)
+
+    backend.submit(write)
     return key
 
-def cache_lookup(norm_text: str, ptype: str, lang: str, similarity_threshold: float = 0.86):
-    """Lookup exact/partial similar prompt from cache."""
-    key = f"{ptype}|{lang}|{sha1(norm_text)}"
+def cache_lookup_ex(norm_text: str, ptype: str, lang: str, similarity_threshold: float = 0.86):
+    """
+    Lookup exact/partial similar prompt from cache.
+    Returns (prompt_or_None, tier) with tier in l1/l2/redis_exact/similarity/miss; records stage timings.
+    """
+    key = cache_key(norm_text, ptype, lang)
+    t = time.perf_counter()
     # 1) local exact
-    v = _local_lru_get(key)
+    v = local_cache.get(key)
+    t = observe_stage("l1", ptype, lang, t)
     if v is not None:
-        return v
-
-    # 2) redis exact
+        cache_touch(key, norm_text=norm_text)
+        return v, "l1"
+
+    # 2) host-shared L2 exact (كل العمليات على نفس الجهاز)
+    stale = None
+    if l2_cache is not None:
+        ent = l2_cache.get(key)
+        t = observe_stage("l2", ptype, lang, t)
+        if ent is not None:
+            age = time.time() - ent[2]
+            if age < CACHE_SOFT_TTL:
+                local_cache.put(key, ent[1], ttl=CACHE_SOFT_TTL - age)
+                cache_touch(key, norm_text=norm_text)
+                return ent[1], "l2"
+            stale = ent[1]  # Redis يقرر التجديد؛ نستخدمه كما هو إن لم يكن في Redis أو كان Redis متوقفًا
+
+    # 3) redis exact
+    cache = redis_client()
     if cache:
-        v = cache.get(CACHE_VAL_PREFIX + key)
-        if v:
-            v = v.decode("utf-8")
-            _local_lru_put(key, v)
+        try:
+            ent = read_entries(cache, [key], {key: norm_text}).get(key)
+        except redis.RedisError as e:
+            redis_error("get", e)
+            return (stale, "l2") if stale is not None else (None, "miss")
+        t = observe_stage("redis_exact", ptype, lang, t)
+        if ent is not None:
+            v, age = ent[1], time.time() - ent[2]
+            if age >= CACHE_SOFT_TTL:
+                # قديم لكنه صالح: أعِده الآن وجدّده في الخلفية (لا يُحفظ في L1)
+                CACHE_STALE_SERVED.inc("redis_exact")
+                schedule_refresh(key, norm_text, ptype, lang)
+            else:
+                local_cache.put(key, v, ttl=CACHE_SOFT_TTL - age)
+            if l2_cache is not None:
+                l2_cache.put(key, encode_entry(norm_text, v, ent[2]), ent[2] + CACHE_TTL_DEFAULT)
+            cache_touch(key, norm_text=norm_text)
+            return v, "redis_exact"
+
+        if stale is not None:
+            CACHE_STALE_SERVED.inc("l2")
+            schedule_refresh(key, norm_text, ptype, lang)
+            return stale, "l2"
+
+        # 4) partial similarity via the n-gram LSH index (top candidates only)
+        try:
+            v2 = similarity_lookup(norm_text, ptype, lang, similarity_threshold)
+        except redis.RedisError as e:
+            redis_error("similarity", e)
+            v2 = None
+        observe_stage("similarity", ptype, lang, t)
+        if v2 is not None:
+            # خزنه محليًا تحت هاش هذا الإدخال لتحسين السرعة لاحقًا
+            local_cache.put(key, v2)
+            return v2, "similarity"
+
+    # 5) Redis متوقف: القديم من L2 أفضل من لا شيء
+    if stale is not None:
+        CACHE_STALE_SERVED.inc("l2")
+        return stale, "l2"
+    return None, "miss"
+
+def cache_lookup(norm_text: str, ptype: str, lang: str, similarity_threshold: float = 0.86):
+    """Lookup exact/partial similar prompt from cache."""
+    return cache_lookup_ex(norm_text, ptype, lang, similarity_threshold)[0]
+
+def cache_lookup_many(keys, norms=None):
+    """
+    Exact lookups for many cache keys: L1 first, then one L2 query, then one pipelined Redis round trip.
+    Returns {key: (prompt, tier)} for hits only; tier is l1, l2 or redis_exact.
+    `norms` (key -> normalized text) avoids reading legacy metadata.
+    """
+    found = {}
+    missing = []
+    for k in keys:
+        v = local_cache.get(k)
+        if v is not None:
+            found[k] = (v, "l1")
+            cache_touch(k, norm_text=(norms or {}).get(k))
+        else:
+            missing.append(k)
+    stale = {}
+    if l2_cache is not None and missing:
+        for k, (norm, v, ts) in l2_cache.get_many(missing).items():
+            age = time.time() - ts
+            if age < CACHE_SOFT_TTL:
+                local_cache.put(k, v, ttl=CACHE_SOFT_TTL - age)
+                found[k] = (v, "l2")
+                cache_touch(k, norm_text=norm)
+            else:
+                stale[k] = (norm, v)
+        missing = [k for k in missing if k not in found]
+    cache = redis_client()
+    if cache and missing:
+        try:
+            entries = read_entries(cache, missing, norms)
+        except redis.RedisError as e:
+            redis_error("mget", e)
+            entries = {}
+        for k, (norm, v, ts) in entries.items():
+            age = time.time() - ts
+            if age >= CACHE_SOFT_TTL:
+                CACHE_STALE_SERVED.inc("redis_exact")
+                ptype, lang, _ = k.split("|", 2)
+                schedule_refresh(k, norm, ptype, lang)
+            else:
+                local_cache.put(k, v, ttl=CACHE_SOFT_TTL - age)
+            if l2_cache is not None:
+                l2_cache.put(k, encode_entry(norm, v, ts), ts + CACHE_TTL_DEFAULT)
+            found[k] = (v, "redis_exact")
+            cache_touch(k, norm_text=norm)
+    for k, (norm, v) in stale.items():
+        if k not in found:
+            CACHE_STALE_SERVED.inc("l2")
+            if cache:
+                ptype, lang, _ = k.split("|", 2)
+                schedule_refresh(k, norm, ptype, lang)
+            found[k] = (v, "l2")
+    return found
+
+# ------------ Single-flight (coalesce concurrent identical misses) ------------
+# طلب واحد فقط يولّد لكل مفتاح كاش؛ البقية ينتظرون نتيجته (داخل العملية وعبر Redis)
+# القائد قد ينتظر مقعد القبول ثم كل محاولات النموذج؛ القفل يجب أن يعيش أطول من ذلك وإلا بدأ عامل آخر استدعاءً مكررًا
+SF_LEASE_MS = int(os.getenv("SF_LEASE_MS", "0"))          # Redis lock lease; 0 = ADMIT_WAIT_MAX + MODEL_DEADLINE + margin
+SF_WAIT_MAX = float(os.getenv("SF_WAIT_MAX", "0"))        # max seconds a follower waits; 0 = the lease
+SF_MARGIN_SECS = 5.0                                      # cache write + lock release after the model returns
+SF_POLL_SECS = 0.05
+
+_sf_lock = threading.Lock()
+_sf_inflight = {}  # cache key -> _Flight
+
+# حذف القفل فقط إذا كان ما زال ملكنا (لم تنتهِ مدته ويأخذه غيرنا)
+_SF_RELEASE_LUA = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+class _Flight:
+    __slots__ = ("event", "value")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+def sf_lease_ms() -> int:
+    return SF_LEASE_MS or int((ADMIT_WAIT_MAX + MODEL_DEADLINE + SF_MARGIN_SECS) * 1000)
+
+def sf_wait_max() -> float:
+    return SF_WAIT_MAX or sf_lease_ms() / 1000.0
+
+def _sf_get(cache, key: str):
+    raw = cache.get(CACHE_ENTRY_PREFIX + key)
+    try:
+        return decode_entry(raw)[1] if raw else None
+    except ValueError:
+        return None
+
+def _sf_wait_remote(cache, key: str, lock_key: str):
+    """Poll for another worker's result until it lands or the lease goes away."""
+    deadline = time.time() + sf_wait_max()
+    while time.time() < deadline:
+        v = _sf_get(cache, key)
+        if v is not None:
             return v
+        if not cache.exists(lock_key):
+            return _sf_get(cache, key)
+        time.sleep(SF_POLL_SECS)
+    return None
 
-        # 3) partial similarity scan (على آخر N مفاتيح فقط)
-        keys = cache.lrange(CACHE_KEYS_LIST, 0, CACHE_KEYS_MAX - 1)
-        best_k = None
-        best_sim = 0.0
-        for raw in keys:
-            k = raw.decode("utf-8")
-            # نفس النوع واللغة فقط
-            if not k.startswith(f"{ptype}|{lang}|"):
-                continue
-            meta_raw = cache.get(CACHE_META_PREFIX + k)
-            if not meta_raw:
-                continue
+def single_flight(key: str, fn):
+    """
+    Run fn() once per key across threads and workers.
+    Returns (value, coalesced) where coalesced=True means another request produced it.
+    fn is expected to store its result under `key` (via cache_store) before returning;
+    the lock release is queued behind that write so remote followers find the value.
+    """
+    with _sf_lock:
+        flight = _sf_inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _sf_inflight[key] = _Flight()
+
+    if not leader:
+        flight.event.wait(sf_wait_max())
+        if flight.value is not None:
+            return flight.value, True
+        return fn(), False  # القائد فشل أو تأخر كثيرًا
+
+    try:
+        token, lock_key = None, CACHE_LOCK_PREFIX + key
+        cache = redis_client()
+        if cache:
             try:
-                meta = json.loads(meta_raw.decode("utf-8"))
-                prev_norm = meta.get("norm", "")
-            except Exception:
+                token = sha1(f"{os.getpid()}:{threading.get_ident()}:{time.time()}")
+                if not cache.set(lock_key, token, nx=True, px=sf_lease_ms()):
+                    token = None
+                    v = _sf_wait_remote(cache, key, lock_key)
+                    if v is not None:
+                        flight.value = v
+                        return v, True
+            except redis.RedisError as e:
+                redis_error("lock", e)
+                token = None
+        try:
+            flight.value = fn()
+        finally:
+            if token:
+                # عبر طابور الكتابة: يُحرَّر القفل بعد أن تصل كتابة القيمة (نفس الترتيب).
+                # إن أُسقطت الكتابة ينتهي القفل وحده بعد sf_lease_ms()
+                backend.submit(lambda pipe: pipe.eval(_SF_RELEASE_LUA, 1, lock_key, token))
+        return flight.value, False
+    finally:
+        with _sf_lock:
+            _sf_inflight.pop(key, None)
+        flight.event.set()
+
+# ------------ Keyword Rule Table (declarative, compiled once) ------------
+# كل القواعد والكلمات المفتاحية في جدول واحد؛ تُترجم إلى regex واحد يمر على النص مرة واحدة.
+# RULES_FILE (JSON بنفس الشكل) يُعاد تحميله تلقائيًا عند تغييره دون إعادة تشغيل.
+# "types"/"languages" اختياريان: يقصران القاعدة على نوع الطلب ولغته، ويكفي عندها نص إجابة تلك اللغات فقط.
+RULES_FILE = os.getenv("RULES_FILE", "")
+RULES_RELOAD_SECS = float(os.getenv("RULES_RELOAD_SECS", "5"))
+
+INTENT_KEYWORDS = {
+    # الترتيب = أولوية كسر التعادل
+    "code":  ["كود", "برمجة", "بايثون", "جافاسكربت", "html", "css", "sql", "javascript", "python", "code", "function", "script"],
+    "video": ["فيديو", "مشهد سينمائي", "لقطة", "موشن", "video", "cinematic", "clip", "short"],
+    "image": ["صورة", "ارسم", "لوحة", "مشهد", "image", "picture", "render", "art", "photo"],
+}
+
+_JS_SUM_CODE = "function add(a, b){ return a + b; }\nconsole.log(add(3, 5));"
+_PY_QUADRATIC_CODE = (
+    "import math\n"
+    "def solve_quadratic(a,b,c):\n"
+    "    d=b*b-4*a*c\n"
+    "    if d<0: return None\n"
+    "    r=math.sqrt(d)\n"
+    "    return ((-b+r)/(2*a), (-b-r)/(2*a))\n"
+    "print(solve_quadratic(1,-3,2))"
+)
+_HTML_DROPDOWN_CODE = (
+    "<label for=\"color\">Choose color:</label>\n"
+    "<select id=\"color\">\n"
+    "  <option>Red</option>\n"
+    "  <option>Green</option>\n"
+    "  <option>Blue</option>\n"
+    "</select>"
+)
+
+# match: قائمة مجموعات؛ يجب أن تظهر كلمة واحدة على الأقل من كل مجموعة. أول قاعدة مطابقة تفوز.
+# topic: يستبدل {topic} في القالب بالموضوع المستخرج من النص.
+QUICK_RULES = [
+    # -------- Quotes / Motivational --------
+    {"name": "quote", "type": "text",
+     "match": [["quote", "اقتباس", "قول", "حكمة", "motivational", "inspire"]],
+     "ar": "\"لا تنتظر الفرصة، اصنعها.\" — مجهول",
+     "en": "\"Don’t wait for opportunity. Create it.\" — Unknown"},
+    {"name": "motivation", "type": "text",
+     "match": [["حفزني", "تحفيز", "motivate", "motivation", "inspire me"]],
+     "ar": "تذكّر: خطوة صغيرة يوميًا أقوى من انفجار حماس عابر. 👊",
+     "en": "Remember: tiny daily steps beat occasional bursts of motivation. 👊"},
+    # -------- Tweet about ... --------
+    {"name": "tweet", "type": "text", "topic": True,
+     "match": [["اكتب تغريدة", "اكتب تويت", "write a tweet", "tweet about"]],
+     "ar": "تغريدة عن {topic}:\n"
+           "الفكرة ليست أن تعرف كل شيء، بل أن تبدأ بما تعرفه الآن. #تعلم #تطوير_ذاتي",
+     "en": "Tweet about {topic}:\n"
+           "You don’t need to know everything to start—begin with what you have. #learning #building"},
+    # -------- Common code snippets --------
+    {"name": "js_sum", "type": "code",
+     "match": [["js", "javascript"], ["sum", "جمع", "add numbers", "جمع رقمين"]],
+     "ar": "اكتب كود JavaScript لجمع رقمين وطباعتهما:\n\n" + _JS_SUM_CODE,
+     "en": "Write a JavaScript snippet to add two numbers and print the result:\n\n" + _JS_SUM_CODE},
+    {"name": "python_quadratic", "type": "code",
+     "match": [["python", "بايثون"], ["quadratic", "تربيعية"]],
+     "ar": "اكتب دالة بايثون لحل معادلة تربيعية ax^2+bx+c=0:\n\n" + _PY_QUADRATIC_CODE,
+     "en": "Write a Python function to solve a quadratic equation ax^2+bx+c=0:\n\n" + _PY_QUADRATIC_CODE},
+    {"name": "html_dropdown", "type": "code",
+     "match": [["html"], ["dropdown", "قائمة منسدلة"]],
+     "ar": "أنشئ قائمة منسدلة بسيطة بـ HTML:\n\n" + _HTML_DROPDOWN_CODE,
+     "en": "Create a simple HTML dropdown component:\n\n" + _HTML_DROPDOWN_CODE},
+    # -------- Email apology --------
+    {"name": "email_apology", "type": "text",
+     "match": [["email apology", "اعتذار عبر الايميل", "ايميل اعتذار", "رسالة اعتذار"]],
+     "ar": "اكتب قالب بريد إلكتروني اعتذاري احترافي:\n"
+           "العنوان: اعتذار عن التأخير\n"
+           "المتن: مرحبًا [الاسم]، أعتذر عن التأخير في الرد بسبب [السبب]. أقدّر وقتك وسأضمن عدم تكرار ذلك. شكرًا لتفهمك.\n"
+           "التوقيع: [اسمك]",
+     "en": "Write a professional apology email template:\n"
+           "Subject: Apology for the delay\n"
+           "Body: Hi [Name], I apologize for my delayed response due to [reason]. I appreciate your time and will ensure this won’t happen again. Thank you for understanding.\n"
+           "Signature: [Your Name]"},
+    # -------- Job interview question --------
+    {"name": "job_interview", "type": "text",
+     "match": [["job interview", "سؤال مقابلة", "مقابلة عمل"]],
+     "ar": "سؤال مقابلة عمل: احك لي عن تحدٍ واجهته وكيف تعاملت معه.\n"
+           "نموذج إجابة: عرّف التحدي، اذكر دورك، الإجراءات، والنتيجة القابلة للقياس.",
+     "en": "Job interview question: Tell me about a challenge you faced and how you handled it.\n"
+           "Model answer: define the challenge, your role, actions, and measurable outcome."},
+    # -------- YouTube title ideas --------
+    {"name": "youtube_titles", "type": "text", "topic": True,
+     "match": [["youtube title", "عنوان يوتيوب", "عنوان فيديو"]],
+     "ar": "عناوين يوتيوب مقترحة عن {topic}:\n"
+           "1) {topic}: السرّ الذي لا يخبرك به أحد\n"
+           "2) {topic} في 10 دقائق — دليل عملي\n"
+           "3) لماذا يفشل معظم الناس في {topic}؟",
+     "en": "YouTube title ideas about {topic}:\n"
+           "1) {topic}: The Untold Secret\n"
+           "2) {topic} in 10 Minutes — A Practical Guide\n"
+           "3) Why Most People Fail at {topic}?"},
+]
+
+TOPIC_RE = re.compile(r".*عن|about", flags=re.IGNORECASE)
+
+def _trie_regex(words) -> str:
+    """Prefix-trie alternation: fails on the first char at most positions, longest match first."""
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        if "" in node:
+            return "(?:" + body + ")?"  # greedy: try the longer keyword first
+        return body
+
+    return build(trie)
+
+class KeywordEngine:
+    """
+    Immutable compiled form of QUICK_RULES + INTENT_KEYWORDS.
+    scan() is one left-to-right pass of a trie-shaped regex, resuming one char after
+    each match start (overlapping matches, longest keyword per position); each match
+    expands to every keyword it contains, so hits == {k for k in keywords if k in text}.
+    A rule with "types"/"languages" only matches requests of those types/languages.
+    """
+
+    def __init__(self, rules: list, intents: dict):
+        for r in rules:
+            if not r.get("match") or not all(r.get(f) for f in ("type", *(r.get("languages") or ("ar", "en")))):
+                raise ValueError(f"invalid quick rule: {r.get('name') or r}")
+        self.rules = [dict(r, match=[frozenset(k.lower() for k in g) for g in r["match"]],
+                           types=frozenset(r["types"]) if r.get("types") else None,
+                           languages=frozenset(r["languages"]) if r.get("languages") else None)
+                      for r in rules]
+        self.intents = {t: frozenset(k.lower() for k in kws) for t, kws in intents.items()}
+
+        kws = set().union(*(g for r in self.rules for g in r["match"]), *self.intents.values())
+        self._re = re.compile(_trie_regex(kws))
+        self._implied = {k: frozenset(o for o in kws if o in k) for k in kws}
+        # keyword -> indices of rules that mention it (only those rules are checked)
+        self._kw_rules = {}
+        for i, r in enumerate(self.rules):
+            for g in r["match"]:
+                for k in g:
+                    self._kw_rules.setdefault(k, set()).add(i)
+
+    def scan(self, low: str) -> frozenset:
+        hits = set()
+        search, implied, pos = self._re.search, self._implied, 0
+        while True:
+            m = search(low, pos)
+            if m is None:
+                return frozenset(hits)
+            hits |= implied[m.group()]
+            pos = m.start() + 1  # إعادة البحث من الحرف التالي تلتقط الكلمات المتداخلة
+
+    def match_rule(self, hits, ptype: str = None, lang: str = None):
+        cand = set()
+        for k in hits:
+            rs = self._kw_rules.get(k)
+            if rs:
+                cand |= rs
+        for i in sorted(cand):
+            r = self.rules[i]
+            if r["types"] is not None and ptype not in r["types"]:
                 continue
-            sim = SequenceMatcher(a=norm_text, b=prev_norm).ratio()
-            if sim > best_sim:
-                best_sim = sim
-                best_k = k
-        if best_k and best_sim >= similarity_threshold:
-            v2 = cache.get(CACHE_VAL_PREFIX + best_k)
-            if v2:
-                v2 = v2.decode("utf-8")
-                # خزنه محليًا تحت هاش هذا الإدخال لتحسين السرعة لاحقًا
-                _local_lru_put(key, v2)
-                return v2
-
-    # 4) local partial fallback (لا يوجد ميتاداتا محلية كافية لدقة عالية)
-    return None
+            if r["languages"] is not None and lang not in r["languages"]:
+                continue
+            if not any(g.isdisjoint(hits) for g in r["match"]):
+                return r
+        return None
+
+    def intent(self, hits):
+        """Type with the most keyword hits (ties -> table order), or None."""
+        best, best_score = None, 0
+        for t, kws in self.intents.items():
+            score = len(kws & hits)
+            if score > best_score:
+                best, best_score = t, score
+        return best
+
+def _load_rules_file(path: str) -> KeywordEngine:
+    with open(path, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+    return KeywordEngine(spec.get("quick_rules", QUICK_RULES), spec.get("intent_keywords", INTENT_KEYWORDS))
+
+keyword_engine = KeywordEngine(QUICK_RULES, INTENT_KEYWORDS)
+_rules_mtime = None
+
+def reload_rules(force: bool = False) -> bool:
+    """Swap in RULES_FILE if it changed. The old engine stays active on any error."""
+    global keyword_engine, _rules_mtime
+    if not RULES_FILE:
+        return False
+    try:
+        mtime = os.path.getmtime(RULES_FILE)
+        if not force and mtime == _rules_mtime:
+            return False
+        _rules_mtime = mtime  # لا تعيد المحاولة على نفس الملف المعطوب كل دورة
+        engine = _load_rules_file(RULES_FILE)
+    except Exception as e:
+        logging.warning(f"⚠️ rules reload failed ({RULES_FILE}): {e}")
+        return False
+    keyword_engine = engine  # مرجع واحد: تبديل ذري بين الخيوط
+    logging.info(f"✅ Loaded {len(engine.rules)} quick rules from {RULES_FILE}")
+    return True
+
+def _rules_watcher():
+    while True:
+        time.sleep(RULES_RELOAD_SECS)
+        reload_rules()
+
+if RULES_FILE:
+    reload_rules(force=True)
+    threading.Thread(target=_rules_watcher, name="rules-watcher", daemon=True).start()
+
+def keyword_hits(user_text: str) -> frozenset:
+    return keyword_engine.scan(user_text.strip().lower())
 
 # ------------ Heuristic Intent Detection (no extra API call) ------------
 TYPE_ALIASES = {
@@ -187,24 +1621,13 @@ TYPE_ALIASES = {
     "text": "text", "image": "image", "video": "video", "code": "code"
 }
 
-def heuristic_intent(user_input: str):
-    t = normalize_text(user_input)
-    # كلمات مفتاحية بسيطة (AR/EN)
-    image_kw = ["صورة", "ارسم", "لوحة", "مشهد", "image", "picture", "render", "art", "photo"]
-    video_kw = ["فيديو", "مشهد سينمائي", "لقطة", "موشن", "video", "cinematic", "clip", "short"]
-    code_kw  = ["كود", "برمجة", "بايثون", "جافاسكربت", "html", "css", "sql", "javascript", "python", "code", "function", "script"]
-
-    low = user_input.lower()
-    score_img = sum(1 for k in image_kw if k in low)
-    score_vid = sum(1 for k in video_kw if k in low)
-    score_cod = sum(1 for k in code_kw  if k in low)
-
-    if score_cod >= max(score_img, score_vid) and score_cod > 0:
-        return "code"
-    if score_vid >= max(score_img, score_cod) and score_vid > 0:
-        return "video"
-    if score_img >= max(score_vid, score_cod) and score_img > 0:
-        return "image"
+def heuristic_intent(user_input: str, hits=None):
+    # كلمات مفتاحية بسيطة (AR/EN) من INTENT_KEYWORDS
+    if hits is None:
+        hits = keyword_hits(user_input)
+    intent = keyword_engine.intent(hits)
+    if intent:
+        return intent
 
     # fallback
     if user_input.strip().endswith((".py", ".js", ".html", ".css")):
@@ -225,140 +1648,209 @@ BASE_MAX_TOKENS = {
     ("en", "code"):  250,
 }
 
-def estimate_complexity(user_text: str) -> float:
+def estimate_complexity(user_text: str, low: str = None) -> float:
     """درجة تعقيد تقريبية [0..1] حسب الطول والبنية."""
     words = len(user_text.strip().split())
     punct = sum(1 for c in user_text if c in ",.;:!؟?!-()[]{}")
     score = 0.0
     score += min(words / 60.0, 0.5)         # 0..0.5
     score += min(punct / 8.0, 0.3)          # 0..0.3
-    score += 0.2 if (" and " in user_text.lower() or " و " in user_text) else 0.0
+    low = user_text.lower() if low is None else low
+    score += 0.2 if (" and " in low or " و " in user_text) else 0.0
     return min(score, 1.0)
 
-def pick_max_tokens(language: str, ptype: str, user_text: str) -> int:
-    lang = "ar" if language.lower().startswith("ar") or is_arabic_text(user_text) else "en"
-    ptype = TYPE_ALIASES.get(ptype, ptype).lower()
-    if ptype not in ["text", "image", "video", "code"]:
-        ptype = heuristic_intent(user_text)
-
+def scaled_max_tokens(lang: str, ptype: str, complexity: float) -> int:
     base = BASE_MAX_TOKENS.get((lang, ptype), 120)
-    c = estimate_complexity(user_text)
     # سماح +/- 25% بناءً على التعقيد (حول نقطة 0.5)
-    delta = int(base * (0.25 * (c - 0.5)))  # c=1 => +12.5%, c=0 => -12.5%
-    mt = max(60, base + delta)
-    return mt
+    delta = int(base * (0.25 * (complexity - 0.5)))  # c=1 => +12.5%, c=0 => -12.5%
+    return max(60, base + delta)
+
+def pick_max_tokens(language: str, ptype: str, user_text: str) -> int:
+    a = analyze_request(user_text, ptype, language)
+    return adaptive_max_tokens(a)
+
+# ------------ Request Analysis (computed once per request) ------------
+class RequestAnalysis:
+    """
+    Everything the pipeline derives from one input, computed once and shared by
+    rules, cache, token scaling and generation so the stages cannot disagree.
+    lang is the language we generate, cache and answer in: "ar" if requested
+    or if the text contains Arabic letters, else "en".
+    """
+    __slots__ = ("text", "low", "is_arabic", "lang", "ptype", "hits", "tokens", "_norm", "_complexity")
+
+    def __init__(self, text: str, req_type: str = "", language: str = ""):
+        self.text = text.strip()
+        self.low = self.text.lower()
+        self.is_arabic = is_arabic_text(self.text)
+        self.lang = "ar" if (language.lower().startswith("ar") or self.is_arabic) else "en"
+        self.hits = keyword_engine.scan(self.low)
+
+        # Canonicalize type or infer (unknown types fall back to intent detection)
+        ptype = TYPE_ALIASES.get(req_type, req_type.lower()) if req_type else ""
+        self.ptype = ptype if ptype in KNOWN_TYPES else heuristic_intent(self.text, self.hits)
+        self.tokens = 0  # model tokens this request spent (request log)
+        self._norm = None
+        self._complexity = None
+
+    @property
+    def norm(self) -> str:
+        # كسول: نتائج القواعد لا تحتاج التطبيع
+        if self._norm is None:
+            self._norm = normalize_text(self.text)
+        return self._norm
+
+    @property
+    def complexity(self) -> float:
+        if self._complexity is None:
+            self._complexity = estimate_complexity(self.text, self.low)
+        return self._complexity
+
+    @property
+    def key(self) -> str:
+        return cache_key(self.norm, self.ptype, self.lang)
+
+def analyze_request(user_text: str, req_type: str = "", language: str = "") -> RequestAnalysis:
+    return RequestAnalysis(user_text, (req_type or "").strip(), (language or "").strip().lower())
+
+# ------------ Adaptive max_tokens (learned from observed completions) ------------
+# نسجّل عدد توكنز الإكمال الفعلي وسبب الانتهاء لكل (lang, ptype, شريحة تعقيد) في هيستوغرام داخل Redis
+# (HINCRBY يُجمَع عبر كل العمليات ويبقى بعد إعادة التشغيل)، ثم max_tokens = الكمّية q × (1 + هامش).
+# بلا بيانات كافية أو Redis => الجدول الثابت. TOKENS_PIN_STATIC=1 يثبّت الجدول دائمًا.
+TOKENS_PIN_STATIC = os.getenv("TOKENS_PIN_STATIC", "0") == "1"
+TOKENS_QUANTILE = float(os.getenv("TOKENS_QUANTILE", "0.95"))
+TOKENS_MARGIN = float(os.getenv("TOKENS_MARGIN", "0.15"))
+TOKENS_MIN_SAMPLES = int(os.getenv("TOKENS_MIN_SAMPLES", "50"))
+TOKENS_WINDOW = int(os.getenv("TOKENS_WINDOW", "5000"))       # counts are halved past this (forgets old usage)
+TOKENS_BIN = 16                                               # histogram bin width (tokens)
+TOKENS_COMPLEXITY_BUCKETS = 4
+TOKENS_LENGTH_BUMP = 1.5      # truncated replies are recorded at max_tokens × this (the true need is higher)
+TOKENS_REFRESH_SECS = 30      # how long a worker reuses an estimate before re-reading Redis
+CACHE_TOKENS_PREFIX = f"{CACHE_NS}:tok:"
+
+MODEL_FINISH = Counter("pg_model_finish_total", "Model completions by finish reason.", ("reason", "ptype", "lang"))
+MAX_TOKENS_SOURCE = Counter("pg_max_tokens_source_total", "Where max_tokens came from (learned/static/pinned).",
+                            ("source",))
+METRICS.extend([MODEL_FINISH, MAX_TOKENS_SOURCE])
+
+# تسجيل ذري: HINCRBY للحاوية والعدّاد، وتنصيف الكل عند تجاوز النافذة
+_TOKENS_RECORD_LUA = """
+redis.call('hincrby', KEYS[1], ARGV[1], 1)
+if ARGV[2] == '1' then redis.call('hincrby', KEYS[1], 'length', 1) end
+if redis.call('hincrby', KEYS[1], 'n', 1) > tonumber(ARGV[3]) then
+  local kv = redis.call('hgetall', KEYS[1])
+  for i = 1, #kv, 2 do
+    local v = math.floor(tonumber(kv[i + 1]) / 2)
+    if v > 0 then redis.call('hset', KEYS[1], kv[i], v) else redis.call('hdel', KEYS[1], kv[i]) end
+  end
+end
+return 1
+"""
+
+_tokens_lock = threading.Lock()
+_tokens_est = {}  # stats key -> (max_tokens or None, loaded_at)
+
+def _tokens_key(a: RequestAnalysis) -> str:
+    b = min(int(a.complexity * TOKENS_COMPLEXITY_BUCKETS), TOKENS_COMPLEXITY_BUCKETS - 1)
+    return f"{CACHE_TOKENS_PREFIX}{a.lang}|{metric_type(a.ptype)}|{b}"
+
+def histogram_quantile(hist: dict, q: float):
+    """q-quantile (upper bin edge, tokens) of {bin: count}; None when empty."""
+    total = sum(hist.values())
+    if not total:
+        return None
+    acc, want = 0, q * total
+    for b in sorted(hist):
+        acc += hist[b]
+        if acc >= want:
+            return (b + 1) * TOKENS_BIN
+    return (max(hist) + 1) * TOKENS_BIN
+
+def _learned_max_tokens(key: str, static: int):
+    cache = redis_client()
+    if cache is None:
+        return None
+    return tokens_estimate(cache.hgetall(key), static)
+
+def tokens_estimate(raw: dict, static: int):
+    """max_tokens from a raw usage histogram (HGETALL result), or None with too few samples."""
+    hist = {}
+    for f, v in raw.items():
+        f = f.decode("utf-8")
+        if f.isdigit():
+            hist[int(f)] = int(v)
+    if sum(hist.values()) < TOKENS_MIN_SAMPLES:
+        return None
+    est = histogram_quantile(hist, TOKENS_QUANTILE)
+    # حدود أمان: لا أقل من 60 ولا أكثر من ضعف الجدول
+    return max(60, min(int(est * (1 + TOKENS_MARGIN)), 2 * static))
+
+def tokens_stale(key: str) -> bool:
+    with _tokens_lock:
+        return time.time() - _tokens_est.get(key, (None, 0.0))[1] > TOKENS_REFRESH_SECS
+
+def tokens_set(key: str, est):
+    with _tokens_lock:
+        _tokens_est[key] = (est, time.time())
+
+def adaptive_max_tokens(a: RequestAnalysis, reload: bool = True) -> int:
+    """
+    max_tokens for this input: learned quantile + margin, else the static table.
+    reload=False never touches Redis (the caller refreshes stale estimates itself).
+    """
+    static = scaled_max_tokens(a.lang, a.ptype, a.complexity)
+    if TOKENS_PIN_STATIC:
+        MAX_TOKENS_SOURCE.inc("pinned")
+        return static
+    key = _tokens_key(a)
+    now = time.time()
+    with _tokens_lock:
+        est, loaded = _tokens_est.get(key, (None, 0.0))
+    if reload and now - loaded > TOKENS_REFRESH_SECS:
+        try:
+            est = _learned_max_tokens(key, static)
+        except redis.RedisError as e:
+            redis_error("tokens", e)
+            est = None
+        tokens_set(key, est)
+    MAX_TOKENS_SOURCE.inc("learned" if est else "static")
+    return est or static
+
+def record_completion(a: RequestAnalysis, max_tokens: int, completion_tokens: int, finish_reason: str):
+    """Feed one completion into the shared usage histogram (async, via the write queue)."""
+    reason = finish_reason or "unknown"
+    MODEL_FINISH.inc(reason, metric_type(a.ptype), a.lang)
+    truncated = reason == "length"
+    used = int(max_tokens * TOKENS_LENGTH_BUMP) if truncated else completion_tokens
+    if used <= 0:
+        return
+    key, b = _tokens_key(a), used // TOKENS_BIN
+    backend.submit(lambda pipe: pipe.eval(_TOKENS_RECORD_LUA, 1, key, b, "1" if truncated else "0", TOKENS_WINDOW))
+
+def token_stats() -> dict:
+    with _tokens_lock:
+        est = {k[len(CACHE_TOKENS_PREFIX):]: v for k, (v, _) in _tokens_est.items()}
+    return {"pinned_static": TOKENS_PIN_STATIC, "quantile": TOKENS_QUANTILE, "margin": TOKENS_MARGIN,
+            "learned": est}
 
 # ------------ PreGPT Quick Rules (zero-token generation) ------------
-def quick_rules(user_text: str, language: str):
+def apply_quick_rules(a: RequestAnalysis):
     """
     Return (prompt_text, inferred_type) or (None, None) if no rule matched.
-    Covers:
-      - Quotes
-      - Motivational lines
-      - Tweet about ...
-      - Common code snippets (JS/Python/HTML)
-      - Email apology
-      - Job interview question
-      - YouTube title prompt
-    """
-    txt = user_text.strip()
-    low = txt.lower()
-    is_ar = (language.lower().startswith("ar") or is_arabic_text(txt))
-
-    # -------- Quotes / Motivational --------
-    if any(k in low for k in ["quote", "اقتباس", "قول", "حكمة", "motivational", "inspire"]):
-        if is_ar:
-            return ("\"لا تنتظر الفرصة، اصنعها.\" — مجهول", "text")
-        else:
-            return ("\"Don’t wait for opportunity. Create it.\" — Unknown", "text")
-
-    if any(k in low for k in ["حفزني", "تحفيز", "motivate", "motivation", "inspire me"]):
-        if is_ar:
-            return ("تذكّر: خطوة صغيرة يوميًا أقوى من انفجار حماس عابر. 👊", "text")
-        else:
-            return ("Remember: tiny daily steps beat occasional bursts of motivation. 👊", "text")
-
-    # -------- Tweet about ... --------
-    if any(k in low for k in ["اكتب تغريدة", "اكتب تويت", "write a tweet", "tweet about"]):
-        topic = re.sub(r".*عن|about", "", txt, flags=re.IGNORECASE).strip() or "your topic"
-        if is_ar:
-            return (f"تغريدة عن {topic}:\n"
-                    f"الفكرة ليست أن تعرف كل شيء، بل أن تبدأ بما تعرفه الآن. #تعلم #تطوير_ذاتي", "text")
-        else:
-            return (f"Tweet about {topic}:\n"
-                    f"You don’t need to know everything to start—begin with what you have. #learning #building", "text")
-
-    # -------- Common code snippets --------
-    # JS sum two numbers
-    if any(k in low for k in ["js", "javascript"]) and any(k in low for k in ["sum", "جمع", "add numbers", "جمع رقمين"]):
-        code = "function add(a, b){ return a + b; }\nconsole.log(add(3, 5));"
-        prompt = ("Write a JavaScript snippet to add two numbers and print the result:\n\n" + code)
-        return (prompt if not is_ar else ("اكتب كود JavaScript لجمع رقمين وطباعتهما:\n\n" + code), "code")
-
-    # Python quadratic solver
-    if any(k in low for k in ["python", "بايثون"]) and ("quadratic" in low or "تربيعية" in low):
-        code = (
-            "import math\n"
-            "def solve_quadratic(a,b,c):\n"
-            "    d=b*b-4*a*c\n"
-            "    if d<0: return None\n"
-            "    r=math.sqrt(d)\n"
-            "    return ((-b+r)/(2*a), (-b-r)/(2*a))\n"
-            "print(solve_quadratic(1,-3,2))"
-        )
-        prompt = ("Write a Python function to solve a quadratic equation ax^2+bx+c=0:\n\n" + code)
-        return (prompt if not is_ar else ("اكتب دالة بايثون لحل معادلة تربيعية ax^2+bx+c=0:\n\n" + code), "code")
-
-    # HTML dropdown
-    if "html" in low and any(k in low for k in ["dropdown", "قائمة منسدلة"]):
-        code = (
-            "<label for=\"color\">Choose color:</label>\n"
-            "<select id=\"color\">\n"
-            "  <option>Red</option>\n"
-            "  <option>Green</option>\n"
-            "  <option>Blue</option>\n"
-            "</select>"
-        )
-        prompt = ("Create a simple HTML dropdown component:\n\n" + code)
-        return (prompt if not is_ar else ("أنشئ قائمة منسدلة بسيطة بـ HTML:\n\n" + code), "code")
-
-    # -------- Email apology --------
-    if any(k in low for k in ["email apology", "اعتذار عبر الايميل", "ايميل اعتذار", "رسالة اعتذار"]):
-        if is_ar:
-            return ("اكتب قالب بريد إلكتروني اعتذاري احترافي:\n"
-                    "العنوان: اعتذار عن التأخير\n"
-                    "المتن: مرحبًا [الاسم]، أعتذر عن التأخير في الرد بسبب [السبب]. أقدّر وقتك وسأضمن عدم تكرار ذلك. شكرًا لتفهمك.\n"
-                    "التوقيع: [اسمك]", "text")
-        else:
-            return ("Write a professional apology email template:\n"
-                    "Subject: Apology for the delay\n"
-                    "Body: Hi [Name], I apologize for my delayed response due to [reason]. I appreciate your time and will ensure this won’t happen again. Thank you for understanding.\n"
-                    "Signature: [Your Name]", "text")
-
-    # -------- Job interview question --------
-    if any(k in low for k in ["job interview", "سؤال مقابلة", "مقابلة عمل"]):
-        if is_ar:
-            return ("سؤال مقابلة عمل: احك لي عن تحدٍ واجهته وكيف تعاملت معه.\n"
-                    "نموذج إجابة: عرّف التحدي، اذكر دورك، الإجراءات، والنتيجة القابلة للقياس.", "text")
-        else:
-            return ("Job interview question: Tell me about a challenge you faced and how you handled it.\n"
-                    "Model answer: define the challenge, your role, actions, and measurable outcome.", "text")
+    Rules come from QUICK_RULES (or RULES_FILE); see the Keyword Rule Table above.
+    """
+    rule = keyword_engine.match_rule(a.hits, a.ptype, a.lang)
+    if rule is None:
+        return (None, None)
 
-    # -------- YouTube title ideas --------
-    if any(k in low for k in ["youtube title", "عنوان يوتيوب", "عنوان فيديو"]):
-        topic = re.sub(r".*عن|about", "", txt, flags=re.IGNORECASE).strip() or "your topic"
-        if is_ar:
-            return (f"عناوين يوتيوب مقترحة عن {topic}:\n"
-                    f"1) {topic}: السرّ الذي لا يخبرك به أحد\n"
-                    f"2) {topic} في 10 دقائق — دليل عملي\n"
-                    f"3) لماذا يفشل معظم الناس في {topic}؟", "text")
-        else:
-            return (f"YouTube title ideas about {topic}:\n"
-                    f"1) {topic}: The Untold Secret\n"
-                    f"2) {topic} in 10 Minutes — A Practical Guide\n"
-                    f"3) Why Most People Fail at {topic}?", "text")
+    out = rule["ar"] if a.lang == "ar" else rule["en"]
+    if rule.get("topic"):
+        topic = TOPIC_RE.sub("", a.text).strip() or "your topic"
+        out = out.replace("{topic}", topic)
+    return (out, rule["type"])
 
-    return (None, None)
+def quick_rules(user_text: str, language: str):
+    return apply_quick_rules(analyze_request(user_text, "text", language))
 
 # ------------ Compact System Prompts (Symbols) ------------
 SYS = {
@@ -382,34 +1874,1086 @@ FORBIDDEN_RE = re.compile("|".join(re.escape(w) for w in FORBIDDEN), flags=re.IG
 def sanitize_output(s: str) -> str:
     return FORBIDDEN_RE.sub("AI tool", s).strip()
 
-# ------------ Core Prompt Generation ------------
-def generate_with_openai(user_text: str, language: str, ptype: str) -> str:
-    if not OPENAI_API_KEY:
-        return "Server misconfigured: OPENAI_API_KEY is missing."
+class StreamSanitizer:
+    """
+    Incremental sanitize_output for streamed chunks.
+    Holds back the last (longest forbidden word - 1) chars, plus any trailing
+    whitespace, so words split across chunk boundaries are still rewritten;
+    joined output == sanitize_output(full text).
+    """
+    HOLD = max(len(w) for w in FORBIDDEN) - 1
+
+    def __init__(self):
+        self._buf = ""
+        self._started = False
+
+    def feed(self, chunk: str) -> str:
+        self._buf += chunk
+        cut = len(self._buf) - self.HOLD
+        if cut <= 0:
+            return ""
+        # لا تقطع داخل كلمة محظورة مكتملة تعبر نقطة القطع
+        for m in FORBIDDEN_RE.finditer(self._buf):
+            if m.start() >= cut:
+                break
+            if m.end() > cut:
+                cut = m.end()
+        # المسافات في النهاية تُحجز حتى نعرف أنها ليست آخر النص (strip)
+        cut = len(self._buf[:cut].rstrip())
+        return self._emit(cut)
+
+    def flush(self) -> str:
+        return self._emit(len(self._buf)).rstrip()
+
+    def _emit(self, cut: int) -> str:
+        out = FORBIDDEN_RE.sub("AI tool", self._buf[:cut])
+        self._buf = self._buf[cut:]
+        if not self._started:
+            out = out.lstrip()
+            self._started = bool(out)
+        return out
+
+# ------------ Model Backend (tiers, deadlines, retries, hedging) ------------
+# طبقة واحدة لكل استدعاءات النموذج: توجيه حسب التعقيد والنوع إلى طبقات قابلة للضبط، مهلة لكل استدعاء،
+# إعادة محاولة بتراجع عشوائي للأخطاء العابرة، وطلب ثانٍ (hedge) إن تأخر الأول عن نسبة مئوية من الكمون.
+# MODEL_BACKEND=stub يستبدل OpenAI بمولّد محلي للاختبارات وقياس الأداء.
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "openai")
+# أول طبقة مطابقة تُستخدم: max_complexity (افتراضي 1.0) و types (افتراضي: الكل)، مثال:
+# [{"name":"fast","model":"gpt-3.5-turbo","max_complexity":0.5},{"name":"strong","model":"gpt-4o-mini","timeout":40}]
+MODEL_TIERS = json.loads(os.getenv("MODEL_TIERS", "") or "[]") or [{"name": "default", "model": "gpt-3.5-turbo"}]
+MODEL_TIMEOUT = float(os.getenv("MODEL_TIMEOUT", "30"))          # per call (s); a tier's "timeout" overrides
+MODEL_DEADLINE = float(os.getenv("MODEL_DEADLINE", "45"))        # all attempts of one generation (s)
+MODEL_RETRIES = int(os.getenv("MODEL_RETRIES", "2"))
+MODEL_BACKOFF = float(os.getenv("MODEL_BACKOFF", "0.25"))        # full-jitter exponential backoff base (s)
+MODEL_HEDGE = os.getenv("MODEL_HEDGE", "0") == "1"               # costs tokens twice for hedged calls
+MODEL_HEDGE_PERCENTILE = float(os.getenv("MODEL_HEDGE_PERCENTILE", "95"))
+MODEL_HEDGE_MIN_SAMPLES = 20
+MODEL_POOL_SIZE = int(os.getenv("MODEL_POOL_SIZE", "32"))        # pooled HTTP connections / hedge threads
+MODEL_ASYNC_POOL_SIZE = int(os.getenv("MODEL_ASYNC_POOL_SIZE", "1000"))  # aiohttp connections (asgi.py)
+
+MODEL_CALL_SECONDS = Histogram("pg_model_call_seconds", "Latency of single model calls.", ("tier", "result"))
+MODEL_RETRIES_TOTAL = Counter("pg_model_retries_total", "Model call retries by error type.", ("tier", "error"))
+MODEL_HEDGES = Counter("pg_model_hedges_total", "Hedged model requests (sent/won/lost).", ("tier", "outcome"))
+METRICS.extend([MODEL_CALL_SECONDS, MODEL_RETRIES_TOTAL, MODEL_HEDGES])
+
+_TRANSIENT_ERRORS = (openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                     openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+def _transient(e: Exception) -> bool:
+    if isinstance(e, _TRANSIENT_ERRORS):
+        return True
+    return isinstance(e, openai.error.APIError) and (getattr(e, "http_status", None) or 500) >= 500
+
+class ModelBackend(ABC):
+    """
+    complete(req, timeout) -> (text, usage, finish_reason); stream(req, timeout) yields (piece, finish_reason).
+    acomplete is the asyncio form used by asgi.py (defaults to complete() on a worker thread).
+    """
+    name = "base"
+    requires_api_key = False
 
-    lang = "ar" if (language.lower().startswith("ar") or is_arabic_text(user_text)) else "en"
-    ptype = TYPE_ALIASES.get(ptype, ptype).lower()
-    if ptype not in ["text", "image", "video", "code"]:
-        ptype = heuristic_intent(user_text)
+    @abstractmethod
+    def complete(self, req: dict, timeout: float):
+        ...
 
-    sys_msg = pick_sys_prompt(lang, ptype)
-    max_toks = pick_max_tokens(lang, ptype, user_text)
+    async def acomplete(self, req: dict, timeout: float):
+        return await asyncio.to_thread(self.complete, req, timeout)
+
+    @abstractmethod
+    def stream(self, req: dict, timeout: float):
+        ...
+
+class _SharedSession(requests.Session):
+    """
+    The pooled session every thread uses. openai 0.28 close()s a thread's session after
+    MAX_SESSION_LIFETIME_SECS (180s) and builds a new one, which would tear down the pool under
+    the other threads; here close() is a no-op and the pool lives as long as the process.
+    """
+
+    def close(self):
+        pass
+
+class OpenAIBackend(ModelBackend):
+    """openai.ChatCompletion over one pooled requests.Session shared by all threads."""
+    name = "openai"
+    requires_api_key = True
+
+    def __init__(self, pool_size: int = MODEL_POOL_SIZE):
+        session = _SharedSession()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        openai.requestssession = session
+        self._aio = None
+
+    def complete(self, req: dict, timeout: float):
+        return self._unpack(openai.ChatCompletion.create(request_timeout=timeout, **req))
+
+    async def acomplete(self, req: dict, timeout: float):
+        # جلسة aiohttp واحدة لكل حلقة أحداث؛ openai 0.28 يقرأها من متغير سياقي لكل مهمة
+        if self._aio is None or self._aio.closed:
+            import aiohttp
+            self._aio = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MODEL_ASYNC_POOL_SIZE))
+        openai.aiosession.set(self._aio)
+        return self._unpack(await openai.ChatCompletion.acreate(request_timeout=timeout, **req))
+
+    @staticmethod
+    def _unpack(resp):
+        choice = resp.choices[0]
+        return choice.message["content"], getattr(resp, "usage", None) or {}, getattr(choice, "finish_reason", None)
+
+    def stream(self, req: dict, timeout: float):
+        for chunk in openai.ChatCompletion.create(stream=True, request_timeout=timeout, **req):
+            choice = chunk.choices[0]
+            yield choice.delta.get("content") or "", getattr(choice, "finish_reason", None)
+
+class StubBackend(ModelBackend):
+    """
+    Local stand-in for tests/benchmarks: sleeps latency ± jitter, echoes a prompt,
+    honours max_tokens (one word ≈ one token) and can fail a share of calls.
+    """
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, fail_rate: float = 0.0):
+        self.latency, self.jitter, self.fail_rate = latency, jitter, fail_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _delay(self) -> float:
+        with self._lock:
+            self.calls += 1
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def _reply(self, req: dict, timeout: float):
+        delay = self._delay()
+        if delay > timeout:
+            time.sleep(timeout)
+            raise openai.error.Timeout("stub: request timed out")
+        time.sleep(delay)
+        return self._text(req)
+
+    def _text(self, req: dict):
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise openai.error.ServiceUnavailableError("stub: unavailable")
+        user = req["messages"][-1]["content"]
+        words = f"Detailed prompt for: {user}. Include setting, mood, style and constraints.".split()
+        finish = "stop"
+        if len(words) > req.get("max_tokens", len(words)):
+            words, finish = words[:req["max_tokens"]], "length"
+        return " ".join(words), finish
+
+    def complete(self, req: dict, timeout: float):
+        return self._usage(*self._reply(req, timeout))
+
+    async def acomplete(self, req: dict, timeout: float):
+        delay = self._delay()
+        if delay > timeout:
+            await asyncio.sleep(timeout)
+            raise openai.error.Timeout("stub: request timed out")
+        await asyncio.sleep(delay)
+        return self._usage(*self._text(req))
+
+    @staticmethod
+    def _usage(text: str, finish: str):
+        n = len(text.split())
+        return text, {"prompt_tokens": 40, "completion_tokens": n, "total_tokens": 40 + n}, finish
+
+    def stream(self, req: dict, timeout: float):
+        text, finish = self._reply(req, timeout)
+        parts = [text[i:i + 12] for i in range(0, len(text), 12)] or [""]
+        for i, p in enumerate(parts):
+            yield p, finish if i == len(parts) - 1 else None
+
+def _make_model_backend():
+    if MODEL_BACKEND == "stub":
+        return StubBackend(float(os.getenv("MODEL_STUB_LATENCY", "0.05")))
+    return OpenAIBackend()
+
+model_backend = _make_model_backend()
+_model_pool = ThreadPoolExecutor(max_workers=MODEL_POOL_SIZE, thread_name_prefix="pg-model")
+_model_latency = {}  # tier name -> deque of recent successful call latencies (s)
+_model_latency_lock = threading.Lock()
+
+def model_ready() -> bool:
+    return bool(OPENAI_API_KEY) or not model_backend.requires_api_key
+
+def route_model(a: RequestAnalysis) -> dict:
+    """First tier whose max_complexity and types admit this input (last tier otherwise)."""
+    for tier in MODEL_TIERS:
+        if a.complexity <= tier.get("max_complexity", 1.0) and (not tier.get("types") or a.ptype in tier["types"]):
+            return tier
+    return MODEL_TIERS[-1]
+
+def _tier_name(tier: dict) -> str:
+    return tier.get("name") or tier["model"]
+
+def _latency_percentile(tier: dict, pct: float):
+    with _model_latency_lock:
+        samples = sorted(_model_latency.get(_tier_name(tier), ()))
+    if len(samples) < MODEL_HEDGE_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+def record_model_call(tier: dict, dt: float, ok: bool):
+    MODEL_CALL_SECONDS.observe(dt, _tier_name(tier), "ok" if ok else "error")
+    if ok:
+        with _model_latency_lock:
+            _model_latency.setdefault(_tier_name(tier), deque(maxlen=200)).append(dt)
+
+def _timed_complete(req: dict, tier: dict, timeout: float):
+    t = time.perf_counter()
+    try:
+        out = model_backend.complete(req, timeout)
+    except Exception:
+        record_model_call(tier, time.perf_counter() - t, False)
+        raise
+    record_model_call(tier, time.perf_counter() - t, True)
+    return out
+
+def _hedged_complete(req: dict, tier: dict, timeout: float):
+    """One call; if it outlives the tier's latency percentile, race a second identical call."""
+    hedge_after = _latency_percentile(tier, MODEL_HEDGE_PERCENTILE) if MODEL_HEDGE else None
+    if hedge_after is None or hedge_after >= timeout:
+        return _timed_complete(req, tier, timeout)
+    first = _model_pool.submit(_timed_complete, req, tier, timeout)
+    try:
+        return first.result(timeout=hedge_after)
+    except FutureTimeout:
+        pass
+    name = _tier_name(tier)
+    MODEL_HEDGES.inc(name, "sent")
+    second = _model_pool.submit(_timed_complete, req, tier, timeout - hedge_after)
+    pending, err = {first, second}, None
+    while pending:
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for f in done:
+            if f.exception() is None:
+                MODEL_HEDGES.inc(name, "won" if f is second else "lost")
+                return f.result()
+            err = f.exception()
+    raise err or openai.error.Timeout("model call timed out")
+
+def model_complete(req: dict, tier: dict, background: bool = False):
+    """
+    Blocking completion with per-call timeouts, hedging and jittered retries within MODEL_DEADLINE.
+    background=True (cache refreshes) makes exactly one unhedged call, so it costs at most one completion.
+    """
+    if background:
+        return _timed_complete(req, tier, min(tier.get("timeout", MODEL_TIMEOUT), MODEL_DEADLINE))
+    deadline = time.monotonic() + MODEL_DEADLINE
+    for attempt in range(MODEL_RETRIES + 1):
+        timeout = min(tier.get("timeout", MODEL_TIMEOUT), deadline - time.monotonic())
+        if timeout <= 0:
+            raise openai.error.Timeout("model deadline exceeded")
+        try:
+            return _hedged_complete(req, tier, timeout)
+        except Exception as e:
+            if not _transient(e) or attempt == MODEL_RETRIES:
+                raise
+            MODEL_RETRIES_TOTAL.inc(_tier_name(tier), type(e).__name__)
+            logging.warning(f"⚠️ Model call failed ({type(e).__name__}), retrying: {e}")
+            time.sleep(min(random.uniform(0, MODEL_BACKOFF * 2 ** attempt), max(0.0, deadline - time.monotonic())))
+
+def model_stream(req: dict, tier: dict):
+    """Streaming completion; retries only until the first piece arrives (no hedging)."""
+    deadline = time.monotonic() + MODEL_DEADLINE
+    for attempt in range(MODEL_RETRIES + 1):
+        timeout = min(tier.get("timeout", MODEL_TIMEOUT), deadline - time.monotonic())
+        if timeout <= 0:
+            raise openai.error.Timeout("model deadline exceeded")
+        try:
+            it = model_backend.stream(req, timeout)
+            first = next(it, None)
+        except Exception as e:
+            if not _transient(e) or attempt == MODEL_RETRIES:
+                raise
+            MODEL_RETRIES_TOTAL.inc(_tier_name(tier), type(e).__name__)
+            time.sleep(min(random.uniform(0, MODEL_BACKOFF * 2 ** attempt), max(0.0, deadline - time.monotonic())))
+            continue
+        if first is not None:
+            yield first
+        yield from it
+        return
+
+def model_stats() -> dict:
+    return {
+        "backend": model_backend.name,
+        "tiers": [{"name": _tier_name(t), "model": t["model"],
+                   "p50_s": _latency_percentile(t, 50), "p95_s": _latency_percentile(t, 95)} for t in MODEL_TIERS],
+        "hedge": MODEL_HEDGE,
+        "retries": MODEL_RETRIES,
+        "timeout_s": MODEL_TIMEOUT,
+    }
 
-    resp = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
+# ------------ Core Prompt Generation ------------
+def _chat_request(a: RequestAnalysis, tier: dict = None, max_tokens: int = None) -> dict:
+    """ChatCompletion kwargs for this input (shared by blocking, streaming and async calls)."""
+    return dict(
+        model=(tier or route_model(a))["model"],
         messages=[
-            {"role": "system", "content": sys_msg},
-            {"role": "user", "content": user_text.strip()}
+            {"role": "system", "content": pick_sys_prompt(a.lang, a.ptype)},
+            {"role": "user", "content": a.text}
         ],
-        max_tokens=max_toks,
+        max_tokens=max_tokens or adaptive_max_tokens(a),
         temperature=0.7,
     )
-    out = resp.choices[0].message["content"].strip()
-    return sanitize_output(out)
+
+def generate_with_openai(a: RequestAnalysis, background: bool = False) -> str:
+    if not model_ready():
+        return "Server misconfigured: OPENAI_API_KEY is missing."
+
+    tier = route_model(a)
+    req = _chat_request(a, tier)
+    return finish_completion(a, req, *model_complete(req, tier, background))
+
+def finish_completion(a: RequestAnalysis, req: dict, text: str, usage: dict, finish: str) -> str:
+    """Account tokens and usage for one completion and return the cleaned prompt."""
+    a.tokens += usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+    MODEL_TOKENS.inc("prompt", a.ptype, a.lang, amount=usage.get("prompt_tokens", 0))
+    MODEL_TOKENS.inc("completion", a.ptype, a.lang, amount=usage.get("completion_tokens", 0))
+    record_completion(a, req["max_tokens"], usage.get("completion_tokens", 0), finish)
+    return sanitize_output(text.strip())
+
+def stream_with_openai(a: RequestAnalysis):
+    """Yield sanitized text pieces as the model produces them."""
+    if not model_ready():
+        yield "Server misconfigured: OPENAI_API_KEY is missing."
+        return
+
+    san = StreamSanitizer()
+    tier = route_model(a)
+    req = _chat_request(a, tier)
+    pieces, finish = 0, None
+    for piece, reason in model_stream(req, tier):
+        finish = reason or finish
+        if piece:
+            pieces += 1  # البث لا يُرجع usage؛ كل قطعة ≈ توكن واحد
+            out = san.feed(piece)
+            if out:
+                yield out
+    record_completion(a, req["max_tokens"], pieces, finish)
+    a.tokens += pieces
+    tail = san.flush()
+    if tail:
+        yield tail
+
+# ------------ Admission Control (model calls only) ------------
+# سقف لاستدعاءات النموذج المتزامنة مع طابور انتظار محدود؛ القواعد وضربات الكاش لا تمر من هنا أبدًا.
+# إن كان الانتظار المتوقع يتجاوز ADMIT_WAIT_MAX نرفض فورًا بـ 503 + Retry-After بدل حجز خيط.
+ADMIT_MAX_INFLIGHT = int(os.getenv("ADMIT_MAX_INFLIGHT", "16"))   # concurrent model generations per process
+ADMIT_QUEUE_MAX = int(os.getenv("ADMIT_QUEUE_MAX", "32"))         # requests allowed to wait for a slot
+ADMIT_WAIT_MAX = float(os.getenv("ADMIT_WAIT_MAX", "2.0"))        # longest queue wait before shedding (s)
+
+ADMIT_INFLIGHT = Gauge("pg_admission_inflight", "Model generations holding an admission slot.")
+ADMIT_QUEUED = Gauge("pg_admission_queued", "Requests waiting for an admission slot.")
+ADMIT_SHED = Counter("pg_admission_shed_total", "Requests shed by admission control (queue_full/deadline/timeout).",
+                     ("reason",))
+ADMIT_WAIT_SECONDS = Histogram("pg_admission_wait_seconds", "Time spent waiting for an admission slot.")
+METRICS.extend([ADMIT_INFLIGHT, ADMIT_QUEUED, ADMIT_SHED, ADMIT_WAIT_SECONDS])
+
+class Overloaded(Exception):
+    """No model slot within the admission deadline; answered as 503 with Retry-After."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"overloaded ({reason})")
+        self.reason, self.retry_after = reason, retry_after
+
+class _Slot:
+    __slots__ = ("_ctl", "_t0", "_done")
+
+    def __init__(self, ctl):
+        self._ctl, self._t0, self._done = ctl, time.monotonic(), False
+
+    def release(self):
+        # آمن للاستدعاء أكثر من مرة (مثل call_on_close بعد انتهاء البث)
+        if not self._done:
+            self._done = True
+            self._ctl._release(time.monotonic() - self._t0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class AdmissionController:
+    """Counting semaphore with a bounded FIFO-ish wait queue and predicted-wait shedding."""
+
+    def __init__(self, max_inflight: int, queue_max: int, wait_max: float):
+        self.max_inflight, self.queue_max, self.wait_max = max_inflight, queue_max, wait_max
+        self.inflight = 0
+        self.waiting = 0
+        self.service_time = 1.0  # EWMA of slot hold time (s)
+        self._cond = threading.Condition()
+
+    def _expected_wait(self) -> float:
+        return (self.waiting + 1) * self.service_time / max(1, self.max_inflight)
+
+    def _shed(self, reason: str):
+        ADMIT_SHED.inc(reason)
+        raise Overloaded(reason, max(1, math.ceil(self._expected_wait())))
+
+    def slot(self, wait: bool = True) -> _Slot:
+        """Acquire a model slot (use as a context manager); raises Overloaded instead of waiting too long."""
+        t0 = time.monotonic()
+        with self._cond:
+            if self.inflight >= self.max_inflight:
+                if not wait:
+                    self._shed("busy")
+                if self.waiting >= self.queue_max:
+                    self._shed("queue_full")
+                if self._expected_wait() > self.wait_max:
+                    self._shed("deadline")
+                self.waiting += 1
+                ADMIT_QUEUED.set(self.waiting)
+                try:
+                    deadline = t0 + self.wait_max
+                    while self.inflight >= self.max_inflight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._shed("timeout")
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    ADMIT_QUEUED.set(self.waiting)
+            self.inflight += 1
+            ADMIT_INFLIGHT.set(self.inflight)
+        ADMIT_WAIT_SECONDS.observe(time.monotonic() - t0)
+        return _Slot(self)
+
+    def _release(self, held: float):
+        with self._cond:
+            self.inflight -= 1
+            self.service_time = 0.8 * self.service_time + 0.2 * held
+            ADMIT_INFLIGHT.set(self.inflight)
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "queued": self.waiting,
+            "queue_max": self.queue_max,
+            "wait_max_s": self.wait_max,
+            "service_time_s": round(self.service_time, 4),
+            "shed": {r: int(ADMIT_SHED.value(r)) for r in ("busy", "queue_full", "deadline", "timeout")},
+        }
+
+admission = AdmissionController(ADMIT_MAX_INFLIGHT, ADMIT_QUEUE_MAX, ADMIT_WAIT_MAX)
+
+# ------------ Quotas (distributed token bucket, per API key or IP) ------------
+# دلو توكنز واحد لكل عميل في Redis المشترك (سكربت Lua ذري) بدل عدّادات كل عملية على حدة.
+# كل عملية تستأجر دفعة صغيرة من التوكنز وتصرفها محليًا، فمعظم الطلبات لا تلمس Redis؛
+# والرفض يُحفظ محليًا حتى موعد Retry-After. ضربات القواعد/الكاش أرخص من استدعاء النموذج.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_PER_MIN = float(os.getenv("RATE_LIMIT_PER_MIN", "20"))     # model calls per minute per IP
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", str(RATE_LIMIT_PER_MIN)))
+RATE_LIMIT_KEYS = json.loads(os.getenv("RATE_LIMIT_KEYS", "") or "{}")  # {"<api key>": {"per_min": .., "burst": ..}}
+RATE_LIMIT_HEADER = os.getenv("RATE_LIMIT_HEADER", "X-API-Key")
+RATE_COST_MODEL = float(os.getenv("RATE_COST_MODEL", "1.0"))
+RATE_COST_HIT = float(os.getenv("RATE_COST_HIT", "0.25"))            # rule / cache hits
+RATE_LEASE_SHARE = float(os.getenv("RATE_LEASE_SHARE", "0.2"))        # share of a client's burst leased per process
+RATE_LEASE_SECS = float(os.getenv("RATE_LEASE_SECS", "1.0"))          # unspent lease tokens go back after this
+RATE_STATE_MAX = 10000                   # clients tracked locally (LRU)
+RATE_BUCKET_PREFIX = f"{CACHE_NS}:rl:"
+
+QUOTA_CHECKS = Counter("pg_quota_checks_total", "Quota checks by where they were decided (local/redis/fallback).",
+                       ("source",))
+QUOTA_DENIED = Counter("pg_quota_denied_total", "Requests rejected by quota (429) by client scope (key/ip).",
+                       ("scope",))
+METRICS.extend([QUOTA_CHECKS, QUOTA_DENIED])
+
+# يعيد ما مُنح (0 أو بين need وwant) وما تبقى في الدلو؛ الأرقام كنصوص كي لا تُقتطع الكسور
+# الوقت من ساعة Redis (TIME) لا من العمليات، كي لا يختلّ الدلو المشترك بانحراف ساعات المضيفين
+_QUOTA_TAKE_LUA = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local want, need = tonumber(ARGV[3]), tonumber(ARGV[4])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local b = redis.call('hmget', KEYS[1], 't', 'ts')
+local t = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+t = math.min(burst, t + math.max(0, now - ts) * rate + tonumber(ARGV[5]))
+local got = 0
+if t >= need then
+  got = math.min(want, t)
+  t = t - got
+end
+redis.call('hset', KEYS[1], 't', tostring(t), 'ts', tostring(now))
+redis.call('pexpire', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {tostring(got), tostring(t)}
+"""
+
+class RateLimited(Exception):
+    """Client quota exhausted; answered as 429 with Retry-After."""
+
+    def __init__(self, scope: str, retry_after: int):
+        super().__init__(f"rate limited ({scope})")
+        self.scope, self.retry_after = scope, retry_after
+
+def _quota(spec: dict) -> dict:
+    per_min = float(spec.get("per_min", RATE_LIMIT_PER_MIN))
+    return {"rate": per_min / 60.0, "burst": float(spec.get("burst", per_min))}
+
+_DEFAULT_QUOTA = _quota({"per_min": RATE_LIMIT_PER_MIN, "burst": RATE_LIMIT_BURST})
+# المفاتيح تُخزَّن مُجزّأة؛ مفتاح غير معروف يُعامل كعنوان IP كي لا يصنع كل طلب دلوًا جديدًا
+_KEY_QUOTAS = {sha1(k): _quota(v or {}) for k, v in RATE_LIMIT_KEYS.items()}
+
+def quota_client(headers=None, addr: str = None):
+    """
+    (bucket id, scope, quota) for a request: a configured API key, else the client IP.
+    Defaults to the current Flask request; asgi.py passes its own headers and peer address.
+    """
+    if headers is None:
+        headers, addr = request.headers, get_remote_address()
+    key = headers.get(RATE_LIMIT_HEADER, "")
+    auth = headers.get("Authorization", "")
+    if not key and auth.startswith("Bearer "):
+        key = auth[7:]
+    h = sha1(key.strip()) if key else None
+    if h in _KEY_QUOTAS:
+        return "k:" + h[:16], "key", _KEY_QUOTAS[h]
+    return "ip:" + (addr or "unknown"), "ip", _DEFAULT_QUOTA
+
+class _Lease:
+    __slots__ = ("tokens", "expires", "denied_until")
+
+    def __init__(self):
+        self.tokens, self.expires, self.denied_until = 0.0, 0.0, 0.0
+
+class QuotaLimiter:
+    """
+    Token bucket per client shared through Redis. Each process leases RATE_LEASE_SHARE
+    of the client's burst and spends it locally; tokens left when a lease expires
+    (RATE_LEASE_SECS) are returned with the next take. While Redis is down an
+    in-process bucket with the same quota is used instead.
+    """
+
+    def __init__(self, lease_secs: float, enabled: bool = True, lease_share: float = RATE_LEASE_SHARE):
+        self.lease_secs, self.enabled, self.lease_share = lease_secs, enabled, lease_share
+        self._lock = threading.Lock()
+        self._leases = OrderedDict()    # bucket id -> _Lease
+        self._fallback = OrderedDict()  # bucket id -> [tokens, ts] while Redis is unavailable
+
+    def _lease(self, bucket: str) -> _Lease:
+        st = self._leases.get(bucket)
+        if st is None:
+            st = self._leases[bucket] = _Lease()
+            if len(self._leases) > RATE_STATE_MAX:
+                self._leases.popitem(last=False)
+        else:
+            self._leases.move_to_end(bucket)
+        return st
+
+    def _take_fallback(self, bucket: str, quota: dict, want: float, need: float, refund: float):
+        now = time.time()
+        with self._lock:
+            b = self._fallback.pop(bucket, None) or [quota["burst"], now]
+            self._fallback[bucket] = b
+            if len(self._fallback) > RATE_STATE_MAX:
+                self._fallback.popitem(last=False)
+            b[0] = min(quota["burst"], b[0] + max(0.0, now - b[1]) * quota["rate"] + refund)
+            b[1] = now
+            got = min(want, b[0]) if b[0] >= need else 0.0
+            b[0] -= got
+            return got, b[0]
+
+    def charge(self, client, cost: float):
+        """Spend `cost` tokens from the client's bucket or raise RateLimited."""
+        if self.spend_local(client, cost):
+            return
+        refund = self.reclaim(client)
+        got = None
+        cache = redis_client()
+        if cache:
+            try:
+                got, left = map(float, cache.eval(*self.take_args(client, cost, refund)))
+                QUOTA_CHECKS.inc("redis")
+            except redis.RedisError as e:
+                redis_error("quota", e)
+        if got is None:
+            got, left = self.take_fallback(client, cost, refund)
+        self.settle(client, cost, got, left)
+
+    def spend_local(self, client, cost: float) -> bool:
+        """True if the local lease covers `cost`; raises RateLimited while a denial is cached."""
+        if not self.enabled or cost <= 0:
+            return True
+        bucket, scope, _ = client
+        now = time.monotonic()
+        with self._lock:
+            st = self._lease(bucket)
+            if st.denied_until > now:
+                QUOTA_CHECKS.inc("local")
+                QUOTA_DENIED.inc(scope)
+                raise RateLimited(scope, max(1, math.ceil(st.denied_until - now)))
+            if st.expires > now and st.tokens >= cost:
+                st.tokens -= cost
+                QUOTA_CHECKS.inc("local")
+                return True
+        return False
+
+    def reclaim(self, client) -> float:
+        """Tokens of the client's expired lease, handed back to the bucket by the next take."""
+        now = time.monotonic()
+        with self._lock:
+            st = self._lease(client[0])
+            if st.expires > now:
+                return 0.0
+            left, st.tokens = st.tokens, 0.0
+            return left
+
+    def _want(self, quota: dict, cost: float) -> float:
+        return min(quota["burst"], max(cost, quota["burst"] * self.lease_share))
+
+    def take_args(self, client, cost: float, refund: float = 0.0):
+        """EVAL arguments that lease tokens for `client` from its Redis bucket (sync or asyncio client)."""
+        bucket, _, quota = client
+        return (_QUOTA_TAKE_LUA, 1, RATE_BUCKET_PREFIX + bucket, quota["rate"], quota["burst"],
+                self._want(quota, cost), cost, repr(refund))
+
+    def take_fallback(self, client, cost: float, refund: float = 0.0):
+        QUOTA_CHECKS.inc("fallback")
+        return self._take_fallback(client[0], client[2], self._want(client[2], cost), cost, refund)
+
+    def settle(self, client, cost: float, got: float, left: float):
+        """Keep a granted lease (minus `cost`) or cache the denial and raise RateLimited."""
+        bucket, scope, quota = client
+        now = time.monotonic()
+        with self._lock:
+            st = self._lease(bucket)
+            if got >= cost:
+                st.tokens = (st.tokens if st.expires > now else 0.0) + got - cost
+                st.expires = now + self.lease_secs
+                return
+            retry = (cost - left) / quota["rate"]
+            st.denied_until = now + retry
+        QUOTA_DENIED.inc(scope)
+        raise RateLimited(scope, max(1, math.ceil(retry)))
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "per_min": RATE_LIMIT_PER_MIN,
+            "burst": RATE_LIMIT_BURST,
+            "api_keys": len(_KEY_QUOTAS),
+            "cost": {"model": RATE_COST_MODEL, "hit": RATE_COST_HIT},
+            "lease_s": self.lease_secs,
+            "lease_share": self.lease_share,
+            "tracked_clients": len(self._leases),
+            "checks": {s: int(QUOTA_CHECKS.value(s)) for s in ("local", "redis", "fallback")},
+            "denied": {s: int(QUOTA_DENIED.value(s)) for s in ("key", "ip")},
+        }
+
+quotas = QuotaLimiter(RATE_LEASE_SECS, RATE_LIMIT_ENABLED)
+
+# ------------ Stale-while-revalidate (background refresh) ------------
+# بعد CACHE_SOFT_TTL نعيد القيمة القديمة فورًا ونجدّدها في الخلفية على مجمّع صغير محدود؛
+# فقط المفقود أو المنتهي فعلًا (CACHE_TTL_DEFAULT) ينتظر النموذج. التجديد مقيّد بميزانية توكنز بالساعة.
+REFRESH_WORKERS = int(os.getenv("REFRESH_WORKERS", "2"))
+REFRESH_QUEUE_MAX = int(os.getenv("REFRESH_QUEUE_MAX", "64"))              # pending refreshes per process
+REFRESH_TOKEN_BUDGET = int(os.getenv("REFRESH_TOKEN_BUDGET", "100000"))    # tokens/hour, shared via Redis
+CACHE_REFRESH_BUDGET_PREFIX = f"{CACHE_NS}:refresh:tokens:"
+
+REFRESHES = Counter("pg_cache_refreshes_total",
+                    "Background refreshes by result (scheduled/done/coalesced/deduped/busy/over_budget/shed/failed).",
+                    ("result",))
+REFRESH_TOKENS = Counter("pg_cache_refresh_tokens_total", "Tokens reserved from the refresh budget.")
+CACHE_STALE_SERVED = Counter("pg_cache_stale_served_total", "Stale cache entries served while refreshing.", ("tier",))
+METRICS.extend([REFRESHES, REFRESH_TOKENS, CACHE_STALE_SERVED])
+
+_refresh_pool = ThreadPoolExecutor(max_workers=max(1, REFRESH_WORKERS), thread_name_prefix="pg-refresh")
+_refresh_lock = threading.Lock()
+_refresh_pending = set()  # cache keys queued or running in this process
+
+def schedule_refresh(key: str, norm_text: str, ptype: str, lang: str) -> bool:
+    """Queue a background regeneration of one cache entry; False if deduped, busy or disabled."""
+    if not model_ready() or REFRESH_WORKERS <= 0:
+        return False
+    with _refresh_lock:
+        if key in _refresh_pending:
+            REFRESHES.inc("deduped")
+            return False
+        if len(_refresh_pending) >= REFRESH_QUEUE_MAX:
+            REFRESHES.inc("busy")
+            return False
+        _refresh_pending.add(key)
+    REFRESHES.inc("scheduled")
+    _refresh_pool.submit(_refresh_entry, key, norm_text, ptype, lang)
+    return True
+
+def _refresh_cost(a: RequestAnalysis) -> int:
+    """Upper bound on tokens one refresh may use: completion cap + rough prompt size."""
+    req = _chat_request(a)
+    chars = sum(len(m["content"]) for m in req["messages"])
+    return req["max_tokens"] + chars // 3 + 1
+
+def _refresh_budget(tokens: int) -> bool:
+    """Reserve (tokens > 0) or give back (tokens < 0) this hour's refresh budget; True if reserved."""
+    cache = redis_client()
+    if cache is None:
+        return False
+    k = CACHE_REFRESH_BUDGET_PREFIX + str(int(time.time() // 3600))
+    pipe = cache.pipeline(transaction=False)
+    pipe.incrby(k, tokens)
+    pipe.expire(k, 2 * 3600)
+    spent = pipe.execute()[0]
+    if tokens > 0 and spent > REFRESH_TOKEN_BUDGET:
+        cache.decrby(k, tokens)
+        return False
+    return True
+
+def _refresh_entry(key: str, norm_text: str, ptype: str, lang: str):
+    try:
+        # لا نملك النص الأصلي؛ النص المطبَّع يكفي لإعادة التوليد
+        a = analyze_request(norm_text, ptype, lang)
+        cost = _refresh_cost(a)
+        if not _refresh_budget(cost):
+            REFRESHES.inc("over_budget")
+            return
+
+        def regenerate():
+            with admission.slot(wait=False):  # التجديد لا ينتظر دور الطلبات الحية
+                out = generate_with_openai(a, background=True)  # محاولة واحدة = تكلفة محجوزة واحدة
+            cache_store(norm_text, ptype, lang, out)
+            return out
+
+        try:
+            _, coalesced = single_flight(key, regenerate)
+        except Overloaded:
+            _refresh_budget(-cost)
+            REFRESHES.inc("shed")
+            return
+        if coalesced:
+            _refresh_budget(-cost)  # غيرنا ولّدها
+        else:
+            REFRESH_TOKENS.inc(amount=cost)
+        REFRESHES.inc("coalesced" if coalesced else "done")
+    except Exception as e:
+        REFRESHES.inc("failed")
+        logging.warning(f"⚠️ Cache refresh failed for {key}: {e}")
+    finally:
+        with _refresh_lock:
+            _refresh_pending.discard(key)
+
+def refresh_stats() -> dict:
+    return {
+        "soft_ttl": CACHE_SOFT_TTL,
+        "hard_ttl": CACHE_TTL_DEFAULT,
+        "pending": len(_refresh_pending),
+        "workers": REFRESH_WORKERS,
+        "token_budget_per_hour": REFRESH_TOKEN_BUDGET,
+    }
+
+# ------------ Request Log (append-only JSONL, written off the request thread) ------------
+# سطر لكل طلب بنفس شكل requests.jsonl (prompt/type/language) مع مسار النتيجة والزمن والتوكنز؛
+# الطلب يضع السجل في طابور فقط، وخيط واحد يكتبه دفعات. mine_log.py يستخرج منه قواعد وبذور كاش.
+REQUEST_LOG_PATH = os.getenv("REQUEST_LOG_PATH", "")                   # empty = disabled
+REQUEST_LOG_QUEUE_MAX = int(os.getenv("REQUEST_LOG_QUEUE_MAX", "10000"))
+REQUEST_LOG_FLUSH_SECS = float(os.getenv("REQUEST_LOG_FLUSH_SECS", "1.0"))
+REQUEST_LOG_SAMPLE = float(os.getenv("REQUEST_LOG_SAMPLE", "1.0"))     # share of requests logged
+REQUEST_LOG_BATCH = 512
+
+REQUEST_LOG_LINES = Counter("pg_request_log_lines_total", "Request log lines by result (written/dropped/failed).",
+                            ("result",))
+METRICS.append(REQUEST_LOG_LINES)
+
+class RequestLog:
+    """
+    log() only enqueues (dropping when the queue is full); one writer thread turns
+    entries into JSON lines and appends each batch with a single write(), so
+    workers sharing the file never interleave partial lines.
+    """
+
+    def __init__(self, path: str, queue_max: int, flush_secs: float, sample: float):
+        self.path, self.flush_secs, self.sample = path, flush_secs, sample
+        self._queue = queue.Queue(maxsize=queue_max)
+        if path:
+            threading.Thread(target=self._writer_loop, name="request-log", daemon=True).start()
+
+    def log(self, a: RequestAnalysis, outcome: str, t0: float, endpoint: str):
+        """Record one served request (a: its analysis, t0: perf_counter() at arrival)."""
+        if not self.path or (self.sample < 1.0 and random.random() >= self.sample):
+            return
+        try:
+            self._queue.put_nowait((time.time(), a, outcome, time.perf_counter() - t0, endpoint))
+        except queue.Full:
+            REQUEST_LOG_LINES.inc("dropped")
+
+    @staticmethod
+    def _record(item) -> bytes:
+        ts, a, outcome, elapsed, endpoint = item
+        # a.norm يُحسب هنا إن لم يُحسب (مسار القواعد)، خارج خيط الطلب
+        rec = {"ts": round(ts, 3), "prompt": a.norm, "type": a.ptype, "language": a.lang,
+               "text": a.low,  # ما تراه القواعد فعلًا؛ mine_log يبني منه عبارات القواعد
+               "outcome": outcome, "latency_ms": round(elapsed * 1000, 2), "tokens": a.tokens,
+               "endpoint": endpoint}
+        return json.dumps(rec, ensure_ascii=False).encode("utf-8") + b"\n"
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_secs
+            while len(batch) < REQUEST_LOG_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                data = b"".join(self._record(item) for item in batch)
+                with open(self.path, "ab", buffering=0) as f:
+                    f.write(data)
+                REQUEST_LOG_LINES.inc("written", amount=len(batch))
+            except Exception as e:
+                REQUEST_LOG_LINES.inc("failed", amount=len(batch))
+                logging.warning(f"⚠️ request log write failed ({self.path}): {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until queued lines are written (tests/benchmarks/shutdown)."""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path or None,
+            "sample": self.sample,
+            "queued": self._queue.qsize(),
+            "lines": {r: int(REQUEST_LOG_LINES.value(r)) for r in ("written", "dropped", "failed")},
+        }
+
+request_log = RequestLog(REQUEST_LOG_PATH, REQUEST_LOG_QUEUE_MAX, REQUEST_LOG_FLUSH_SECS, REQUEST_LOG_SAMPLE)
+
+# ------------ Cache Seeding (from mine_log.py output) ------------
+# ملف بذور (JSONL: prompt/type/language و answer اختياري) يُحمَّل مرة لكل محتوى ملف ولكل بيانات Redis:
+# ما له answer يُخزَّن مباشرة، وما ليس له يُولَّد عبر التجديد الخلفي ضمن ميزانية التوكنز.
+# طابور التجديد محدود (REFRESH_QUEUE_MAX)، فخيط واحد يغذّيه على دفعات حتى تصل كل البذور للكاش؛
+# العلامة تُكتب بعد ذلك فقط، فإعادة التشغيل في المنتصف تُكمل ما بقي.
+CACHE_SEED_FILE = os.getenv("CACHE_SEED_FILE", "")
+CACHE_SEED_PREFIX = f"{CACHE_NS}:seeded:"
+SEED_RETRY_SECS = float(os.getenv("SEED_RETRY_SECS", "5"))   # between feeder passes (doubles while stuck, max 300)
+
+def seed_cache(path: str = CACHE_SEED_FILE) -> dict:
+    """
+    Warm the cache from a seed file; entries already cached are left alone. Returns counts:
+    stored (answers written), present, refresh (scheduled now) and pending (left to the feeder thread).
+    """
+    counts = {"stored": 0, "refresh": 0, "present": 0, "pending": 0}
+    cache = redis_client()
+    if not path or not cache:
+        return counts
+    with open(path, "rb") as f:
+        raw = f.read()
+    marker = CACHE_SEED_PREFIX + hashlib.sha1(raw).hexdigest()
+    # علامة "تم" + مطالبة مؤقتة كي لا تغذّي كل العمليات نفس الملف معًا
+    if cache.exists(marker) or not cache.set(marker + ":run", "1", nx=True, ex=60):
+        return counts
+    rows = {}
+    for line in raw.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        norm = normalize_text(row.get("prompt") or "")
+        if norm and row.get("type") in KNOWN_TYPES and row.get("language") in ("ar", "en"):
+            rows[cache_key(norm, row["type"], row["language"])] = (norm, row["type"], row["language"], row.get("answer"))
+    keys = list(rows)
+    todo = {}  # cache key -> (norm, type, lang) still to be generated
+    for i in range(0, len(keys), 200):
+        chunk = keys[i:i + 200]
+        found = read_entries(cache, chunk, {k: rows[k][0] for k in chunk})
+        for k in chunk:
+            norm, ptype, lang, answer = rows[k]
+            if k in found:
+                counts["present"] += 1
+            elif answer:
+                cache_store(norm, ptype, lang, answer)
+                counts["stored"] += 1
+            else:
+                todo[k] = (norm, ptype, lang)
+    if todo and not model_ready():
+        cache.delete(marker + ":run")  # يُعاد المحاولة عند الاتصال التالي
+        logging.warning(f"⚠️ Cache seeding deferred ({path}): model not ready for {len(todo)} seeds")
+        return counts
+    sent = {}
+    counts["refresh"] = _seed_pass(cache, todo, sent)
+    counts["pending"] = len(todo)
+    if todo:
+        threading.Thread(target=_seed_feeder, args=(marker, todo, sent), name="cache-seed", daemon=True).start()
+    else:
+        _seed_done(cache, marker)
+    logging.info(f"✅ Cache seeded from {path}: {counts}")
+    return counts
+
+def _seed_pass(cache, todo: dict, sent: dict) -> int:
+    """
+    Drop seeds that reached the cache, then schedule refreshes for the rest while the queue has room.
+    sent (key -> time scheduled) holds a seed back for a minute: its write may still be queued,
+    or the refresh was dropped (over budget) and is retried after that.
+    """
+    keys = list(todo)
+    for i in range(0, len(keys), 200):
+        chunk = keys[i:i + 200]
+        for k in read_entries(cache, chunk, {k: todo[k][0] for k in chunk}):
+            del todo[k]
+            sent.pop(k, None)
+    scheduled, now = 0, time.time()
+    for k, (norm, ptype, lang) in list(todo.items()):
+        if now - sent.get(k, 0) < 60:
+            continue
+        with _refresh_lock:
+            if k in _refresh_pending:
+                continue
+            if len(_refresh_pending) >= REFRESH_QUEUE_MAX:
+                break
+        if schedule_refresh(k, norm, ptype, lang):
+            sent[k] = now
+            scheduled += 1
+    return scheduled
+
+def _seed_done(cache, marker: str):
+    pipe = cache.pipeline()
+    pipe.set(marker, "1", ex=CACHE_TTL_DEFAULT)
+    pipe.delete(marker + ":run")
+    pipe.execute()
+
+def _seed_feeder(marker: str, todo: dict, sent: dict):
+    """Keep feeding unanswered seeds into the refresh queue until all of them are cached, then mark the file."""
+    delay = SEED_RETRY_SECS
+    while True:
+        time.sleep(delay)
+        cache = redis_client()
+        if cache is None or not model_ready():
+            continue
+        try:
+            before = len(todo)
+            cache.set(marker + ":run", "1", ex=int(2 * delay) + 60)
+            scheduled = _seed_pass(cache, todo, sent)
+            if not todo:
+                _seed_done(cache, marker)
+                logging.info(f"✅ Cache seeding finished ({marker})")
+                return
+            # لا تقدّم (مثلًا ميزانية التجديد نفدت): خفّف المحاولات
+            delay = SEED_RETRY_SECS if scheduled or len(todo) < before else min(300.0, delay * 2)
+        except redis.RedisError as e:
+            redis_error("seed", e)
+
+def _seed_cache_hook():
+    try:
+        seed_cache()
+    except Exception as e:
+        logging.warning(f"⚠️ Cache seeding skipped ({CACHE_SEED_FILE}): {e}")
+
+if CACHE_SEED_FILE:
+    backend.on_connect(_seed_cache_hook)
 
 # ------------ API Endpoint ------------
+def _result(intent: str, lang: str, prompt: str, cached=False, coalesced=False, rule_based=False) -> dict:
+    return {
+        "intent": intent,
+        "language": lang,
+        "prompt": prompt,
+        "cached": cached,
+        "coalesced": coalesced,
+        "rule_based": rule_based
+    }
+
+def parse_generate_input(data: dict):
+    """
+    Return (analysis, language); analysis is None when the input text is missing
+    (language is the requested one, for the error message).
+    """
+    # ✅ يدعم prompt/text/input كلها
+    user_input = (data.get("prompt") or data.get("text") or data.get("input") or "").strip()
+    req_type = (data.get("type") or "").strip()
+    language = (data.get("language") or "").strip().lower()
+
+    if not user_input:
+        return None, language
+    return analyze_request(user_input, req_type, language), language
+
+def _invalid_input(language: str):
+    msg = "الرجاء إدخال نص صحيح" if (language.startswith("ar")) else "Please enter valid text"
+    return jsonify({"error": msg}), 400
+
+def model_error_body(e):
+    """(body, status) for a failed model call: Overloaded -> 503 + retry_after, Timeout -> 504, else 503."""
+    if isinstance(e, Overloaded):
+        return {"error": "Server busy, please retry", "retry_after": e.retry_after}, 503
+    logging.warning(f"⚠️ Model call failed: {type(e).__name__}: {e}")
+    status = 504 if isinstance(e, openai.error.Timeout) else 503
+    return {"error": "Model temporarily unavailable, please retry"}, status
+
+@app.errorhandler(openai.error.OpenAIError)
+def _model_error(e):
+    """Model still failing after retries / past the deadline: 504 or 503 instead of a bare 500."""
+    body, status = model_error_body(e)
+    return jsonify(body), status
+
+@app.errorhandler(Overloaded)
+def _overloaded(e):
+    body, status = model_error_body(e)
+    resp = jsonify(body)
+    resp.status_code = status
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+@app.errorhandler(RateLimited)
+def _rate_limited(e):
+    resp = jsonify({"error": "Rate limit exceeded, please retry later", "retry_after": e.retry_after})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+def resolve_without_model(a: RequestAnalysis):
+    """
+    Quick rules, then smart cache. Returns (result_or_None, outcome).
+    """
+    # -------- PreGPT Quick Rules (no OpenAI call) --------
+    t = time.perf_counter()
+    rule_prompt, rule_type = apply_quick_rules(a)
+    t = observe_stage("rules", a.ptype, a.lang, t)
+    if rule_prompt:
+        intent = rule_type if rule_type else a.ptype
+        OUTCOMES.inc("rule", metric_type(intent), a.lang)
+        return _result(intent, a.lang, rule_prompt, rule_based=True), "rule"
+
+    # -------- Smart Cache Lookup --------
+    norm = a.norm
+    observe_stage("normalize", a.ptype, a.lang, t)
+    cached, tier = cache_lookup_ex(norm, a.ptype, a.lang)
+    if cached:
+        OUTCOMES.inc(tier, a.ptype, a.lang)
+        return _result(a.ptype, a.lang, cached, cached=True), tier
+    return None, "miss"
+
+def generate_and_store(a: RequestAnalysis):
+    """Coalesced model call + cache write for one miss. Returns (prompt, coalesced)."""
+    def _generate_and_store():
+        t = time.perf_counter()
+        with admission.slot():
+            t = observe_stage("admission", a.ptype, a.lang, t)
+            out = generate_with_openai(a)
+        t = observe_stage("model", a.ptype, a.lang, t)
+        # -------- Store in Cache --------
+        cache_store(a.norm, a.ptype, a.lang, out)
+        observe_stage("store", a.ptype, a.lang, t)
+        return out
+
+    prompt_text, coalesced = single_flight(a.key, _generate_and_store)
+    OUTCOMES.inc("coalesced" if coalesced else "miss", a.ptype, a.lang)
+    return prompt_text, coalesced
+
 @app.route("/generate", methods=["POST"])
-@limiter.limit("20 per minute")
+@limiter.exempt
 def generate():
     """
     Request JSON:
@@ -424,86 +2968,267 @@ def generate():
         "language": "ar|en",
         "prompt": "generated prompt text",
         "cached": true|false,
+        "coalesced": true|false,   # reused a concurrent identical request's result
         "rule_based": true|false
       }
     """
+    t0 = time.perf_counter()
     data = request.get_json(force=True, silent=True) or {}
+    a, language = parse_generate_input(data)
+    if a is None:
+        return _invalid_input(language)
+    observe_stage("analyze", a.ptype, a.lang, t0)
+    client = quota_client()
+    quotas.charge(client, RATE_COST_HIT)
+
+    hit, outcome = resolve_without_model(a)
+    if hit:
+        REQUEST_SECONDS.observe(time.perf_counter() - t0, "generate", outcome)
+        request_log.log(a, outcome, t0, "generate")
+        return jsonify(hit)
+
+    # -------- OpenAI Generation (coalesced per cache key) --------
+    quotas.charge(client, RATE_COST_MODEL - RATE_COST_HIT)
+    prompt_text, coalesced = generate_and_store(a)
+    outcome = "coalesced" if coalesced else "miss"
+    REQUEST_SECONDS.observe(time.perf_counter() - t0, "generate", outcome)
+    request_log.log(a, outcome, t0, "generate")
+    return jsonify(_result(a.ptype, a.lang, prompt_text, coalesced=coalesced))
+
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route("/generate/stream", methods=["POST"])
+@limiter.exempt
+def generate_stream():
+    """
+    Same request JSON as /generate, answered as Server-Sent Events:
+      event: delta   data: {"text": "..."}          # zero or more, model path only
+      event: done    data: {<same JSON as /generate>}
+      event: error   data: {<same JSON as a /generate error>, "status": 503|504}   # instead of "done"
+    Rule and cache hits send only the "done" event. A model failure after the 200 has gone out
+    ends the stream with "error"; nothing is cached.
+    """
+    t0 = time.perf_counter()
+    data = request.get_json(force=True, silent=True) or {}
+    a, language = parse_generate_input(data)
+    if a is None:
+        return _invalid_input(language)
+    observe_stage("analyze", a.ptype, a.lang, t0)
+    client = quota_client()
+    quotas.charge(client, RATE_COST_HIT)
+
+    hit, outcome = resolve_without_model(a)
+    if not hit:
+        quotas.charge(client, RATE_COST_MODEL - RATE_COST_HIT)
+    # يُحجز قبل بدء الاستجابة كي نستطيع الرد بـ 503؛ ويُحرَّر عند إغلاقها حتى لو لم يُستهلك المولِّد
+    slot = None if hit else admission.slot()
+
+    def events():
+        if hit:
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, "stream", outcome)
+            request_log.log(a, outcome, t0, "stream")
+            yield _sse("done", hit)
+            return
+        parts = []
+        t = time.perf_counter()
+        try:
+            for piece in stream_with_openai(a):
+                parts.append(piece)
+                yield _sse("delta", {"text": piece})
+        except (openai.error.OpenAIError, Overloaded) as e:
+            body, status = model_error_body(e)
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, "stream", "error")
+            yield _sse("error", dict(body, status=status))
+            return
+        finally:
+            slot.release()
+        t = observe_stage("model", a.ptype, a.lang, t)
+        prompt_text = "".join(parts).strip()
+        cache_store(a.norm, a.ptype, a.lang, prompt_text)
+        observe_stage("store", a.ptype, a.lang, t)
+        OUTCOMES.inc("miss", a.ptype, a.lang)
+        REQUEST_SECONDS.observe(time.perf_counter() - t0, "stream", "miss")
+        request_log.log(a, "miss", t0, "stream")
+        yield _sse("done", _result(a.ptype, a.lang, prompt_text))
+
+    resp = Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    if slot is not None:
+        resp.call_on_close(slot.release)
+    return resp
+
+# ------------ Batch ------------
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))   # concurrent model calls per batch
+
+def _batch_rate_limited(e: RateLimited) -> dict:
+    return {"error": "Rate limit exceeded, please retry later", "retry_after": e.retry_after}
+
+def _batch_generate_one(a: RequestAnalysis, client) -> dict:
+    """Similarity lookup, then a coalesced model call for one unique miss (charged to the client's quota)."""
+    t = time.perf_counter()
+    try:
+        similar = similarity_lookup(a.norm, a.ptype, a.lang)
+    except redis.RedisError as e:
+        redis_error("similarity", e)
+        similar = None
+    observe_stage("similarity", a.ptype, a.lang, t)
+    if similar is not None:
+        quotas.charge(client, RATE_COST_HIT)
+        OUTCOMES.inc("similarity", a.ptype, a.lang)
+        local_cache.put(a.key, similar)
+        return _result(a.ptype, a.lang, similar, cached=True)
+
+    quotas.charge(client, RATE_COST_MODEL)
+    prompt_text, coalesced = generate_and_store(a)
+    return _result(a.ptype, a.lang, prompt_text, coalesced=coalesced)
+
+@app.route("/generate/batch", methods=["POST"])
+@limiter.limit("5 per minute")
+def generate_batch():
+    """
+    Request JSON:
+      {
+        "items": [{"prompt": ..., "type": ..., "language": ...}, ...],  # same fields as /generate
+        "stream": false   # true => NDJSON, one {"index": i, ...} line per item as it completes
+      }
+    Response JSON (stream=false):
+      {"results": [<same JSON as /generate, or {"error": ...}>, ...]}   # input order
+    Identical items (same type|lang|normalized text) are generated once.
+    Each unique item is charged like one /generate call (RATE_COST_HIT for a rule/cache hit,
+    RATE_COST_MODEL for a model call); repeats inside the batch are free. Items over quota get
+    {"error": ..., "retry_after": ...}.
+    """
+    t0 = time.perf_counter()
+    data = request.get_json(force=True, silent=True) or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"too many items (max {BATCH_MAX_ITEMS})"}), 413
+
+    client = quota_client()
+    results = [None] * len(items)
+    pending = {}  # cache key -> (analysis, [indices])
+    rule_charged = set()
+    for i, item in enumerate(items):
+        a, language = parse_generate_input(item if isinstance(item, dict) else {})
+        if a is None:
+            results[i] = {"error": "الرجاء إدخال نص صحيح" if language.startswith("ar") else "Please enter valid text"}
+            continue
+        rule_prompt, rule_type = apply_quick_rules(a)
+        if rule_prompt:
+            if a.key not in rule_charged:
+                try:
+                    quotas.charge(client, RATE_COST_HIT)
+                except RateLimited as e:
+                    results[i] = _batch_rate_limited(e)
+                    continue
+                rule_charged.add(a.key)
+            OUTCOMES.inc("rule", metric_type(rule_type or a.ptype), a.lang)
+            results[i] = _result(rule_type or a.ptype, a.lang, rule_prompt, rule_based=True)
+            request_log.log(a, "rule", t0, "batch")
+            continue
+        if a.key in pending:
+            pending[a.key][1].append(i)
+        else:
+            pending[a.key] = (a, [i])
 
-    # ✅ يدعم prompt/text/input كلها
-    user_input = (data.get("prompt") or data.get("text") or data.get("input") or "").strip()
-
-    req_type = (data.get("type") or "").strip()
-    language = (data.get("language") or "").strip().lower()
-
-    if not user_input:
-        msg = "الرجاء إدخال نص صحيح" if (language.startswith("ar")) else "Please enter valid text"
-        return jsonify({"error": msg}), 400
-
-    # Detect language if not provided
-    if not language:
-        language = "ar" if is_arabic_text(user_input) else "en"
-
-    # Canonicalize type or infer
-    ptype = TYPE_ALIASES.get(req_type, req_type.lower()) if req_type else heuristic_intent(user_input)
-
-    # -------- PreGPT Quick Rules (no OpenAI call) --------
-    rule_prompt, rule_type = quick_rules(user_input, language)
-    if rule_prompt:
-        intent = rule_type if rule_type else ptype
-        return jsonify({
-            "intent": intent,
-            "language": "ar" if language.startswith("ar") else "en",
-            "prompt": rule_prompt,
-            "cached": False,
-            "rule_based": True
-        })
-
-    # -------- Smart Cache Lookup --------
-    norm = normalize_text(user_input)
-    cached = cache_lookup(norm, ptype, "ar" if language.startswith("ar") else "en")
-    if cached:
-        return jsonify({
-            "intent": ptype,
-            "language": "ar" if language.startswith("ar") else "en",
-            "prompt": cached,
-            "cached": True,
-            "rule_based": False
-        })
-
-    # -------- OpenAI Generation --------
-    prompt_text = generate_with_openai(user_input, language, ptype)
-
-    # -------- Store in Cache --------
-    cache_store(norm, ptype, "ar" if language.startswith("ar") else "en", prompt_text)
-
-    return jsonify({
-        "intent": ptype,
-        "language": "ar" if language.startswith("ar") else "en",
-        "prompt": prompt_text,
-        "cached": False,
-        "rule_based": False
-    })
+    for k, (v, tier) in cache_lookup_many(list(pending), {k: a.norm for k, (a, _) in pending.items()}).items():
+        a, idxs = pending.pop(k)
+        try:
+            quotas.charge(client, RATE_COST_HIT)
+        except RateLimited as e:
+            for i in idxs:
+                results[i] = _batch_rate_limited(e)
+            continue
+        OUTCOMES.inc(tier, a.ptype, a.lang, amount=len(idxs))
+        hit = _result(a.ptype, a.lang, v, cached=True)
+        for i in idxs:
+            results[i] = hit
+            request_log.log(a, tier, t0, "batch")
+
+    def run_misses():
+        """Yield (indices, result) as the bounded pool finishes each unique miss."""
+        if not pending:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(pending)))) as pool:
+            futures = {pool.submit(_batch_generate_one, a, client): (a, idxs) for a, idxs in pending.values()}
+            for fut in as_completed(futures):
+                a, idxs = futures[fut]
+                try:
+                    res = fut.result()
+                    outcome = "similarity" if res["cached"] else "coalesced" if res["coalesced"] else "miss"
+                    for j, _ in enumerate(idxs):  # نسخ مكررة داخل الدفعة لا تكلف توكنز
+                        request_log.log(a, "coalesced" if j and outcome == "miss" else outcome, t0, "batch")
+                except Overloaded as e:
+                    res = {"error": "Server busy, please retry", "retry_after": e.retry_after}
+                except RateLimited as e:
+                    res = _batch_rate_limited(e)
+                except Exception as e:
+                    logging.warning(f"⚠️ batch item failed: {e}")
+                    res = {"error": "generation failed"}
+                yield idxs, res
+
+    if not data.get("stream"):
+        for idxs, res in run_misses():
+            for i in idxs:
+                results[i] = res
+        return jsonify({"results": results})
+
+    def ndjson():
+        for i, res in enumerate(results):
+            if res is not None:
+                yield json.dumps({"index": i, **res}, ensure_ascii=False) + "\n"
+        for idxs, res in run_misses():
+            for i in idxs:
+                yield json.dumps({"index": i, **res}, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(ndjson()), mimetype="application/x-ndjson")
 
 # ------------ Health ------------
 @app.route("/health", methods=["GET"])
 def health():
-    ok = bool(OPENAI_API_KEY)
     redis_ok = False
+    cache = redis_client()
     try:
         if cache:
             cache.ping()
             redis_ok = True
-    except Exception:
+    except redis.RedisError as e:
+        redis_error("ping", e)
         redis_ok = False
-    return jsonify({
-        "status": "ok" if ok else "missing_api_key",
+    return jsonify(health_report(redis_ok))
+
+def health_report(redis_ok: bool) -> dict:
+    """/health body (shared with asgi.py)."""
+    return {
+        "status": "ok" if model_ready() else "missing_api_key",
         "redis": redis_ok,
-        "lru_size": len(local_lru),
-        "window_keys": CACHE_KEYS_MAX
-    })
+        "redis_backend": backend.stats(),
+        "lru_size": len(local_cache),
+        "local_cache": local_cache.stats(),
+        "cache_encoding": encoding_stats(),
+        "cache_refresh": refresh_stats(),
+        "l2_cache": l2_cache.stats() if l2_cache is not None else None,
+        "max_tokens": token_stats(),
+        "model": model_stats(),
+        "admission": admission.stats(),
+        "quotas": quotas.stats(),
+        "request_log": request_log.stats(),
+        "window_keys": CACHE_KEYS_MAX,
+        "max_entries": CACHE_MAX_ENTRIES
+    }
+
+# ------------ Metrics ------------
+@app.route("/metrics", methods=["GET"])
+@limiter.exempt
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 # ------------ Run ------------
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=5000)  # debug=False تلقائيًا
+    app.run(host="0.0.0.0", port=port)  # debug=False تلقائيًا
 
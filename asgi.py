@@ -0,0 +1,570 @@
+# asgi.py
+# ============================================================
+# Async serving path for app.py under an ASGI server (uvicorn / hypercorn)
+# - POST /generate, GET /health and GET /metrics with the same JSON contract as the Flask app
+# - Same pipeline: quotas → rules → L1 → L2 → Redis exact (SWR) → similarity → admission → model
+# - Request-path Redis reads use redis.asyncio; writes still go through app.py's background writer
+# - Model calls use ModelBackend.acomplete (openai ChatCompletion.acreate / stub), so one process
+#   holds thousands of in-flight calls without a thread each
+# - /generate/stream and /generate/batch stay on the Flask app
+# ------------------------------------------------------------
+# Run:
+#   uvicorn asgi:app --host 0.0.0.0 --port $PORT
+# Env (in addition to app.py's):
+#   ASGI_MAX_INFLIGHT, ASGI_QUEUE_MAX, ASGI_MAX_BODY, REDIS_ASYNC_MAX_CONNECTIONS
+# ============================================================
+
+import os
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import contextlib
+from collections import deque
+
+import openai
+import redis
+import redis.asyncio as aioredis
+
+import app as pg
+
+# ------------ Config ------------
+# لا خيط لكل طلب هنا، فالسقف أعلى بكثير من ADMIT_MAX_INFLIGHT في Flask
+ASGI_MAX_INFLIGHT = int(os.getenv("ASGI_MAX_INFLIGHT", "2000"))   # concurrent model generations per process
+ASGI_QUEUE_MAX = int(os.getenv("ASGI_QUEUE_MAX", "4000"))
+ASGI_MAX_BODY = int(os.getenv("ASGI_MAX_BODY", str(1024 * 1024)))
+REDIS_ASYNC_MAX_CONNECTIONS = int(os.getenv("REDIS_ASYNC_MAX_CONNECTIONS", "256"))
+
+_background = set()  # strong refs to fire-and-forget tasks
+
+def _spawn(coro):
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+# ------------ Async Redis (shares app.py's circuit breaker) ------------
+_aredis = None
+
+def aredis_client():
+    """asyncio Redis client, or None while app.py's breaker is open."""
+    global _aredis
+    if pg.redis_client() is None:
+        return None
+    if _aredis is None:
+        pool = aioredis.ConnectionPool.from_url(
+            pg.REDIS_URL,
+            max_connections=REDIS_ASYNC_MAX_CONNECTIONS,
+            socket_timeout=pg.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=pg.REDIS_CONNECT_TIMEOUT,
+        )
+        _aredis = aioredis.Redis(connection_pool=pool)
+    return _aredis
+
+async def aread_entries(cache, keys, norms=None):
+    pipe = cache.pipeline(transaction=False)
+    pg.queue_entry_reads(pipe, keys, norms)
+    return pg.parse_entries(keys, await pipe.execute(), norms)
+
+# ------------ Quotas ------------
+async def acharge(client, cost: float):
+    """pg.quotas.charge with the Redis round trip awaited."""
+    q = pg.quotas
+    if q.spend_local(client, cost):
+        return
+    refund = q.reclaim(client)
+    got = None
+    cache = aredis_client()
+    if cache:
+        try:
+            got, left = map(float, await cache.eval(*q.take_args(client, cost, refund)))
+            pg.QUOTA_CHECKS.inc("redis")
+        except redis.RedisError as e:
+            pg.redis_error("quota", e)
+    if got is None:
+        got, left = q.take_fallback(client, cost, refund)
+    q.settle(client, cost, got, left)
+
+# ------------ Smart Cache (async reads, same tiers as cache_lookup_ex) ------------
+async def asimilarity_lookup(cache, norm_text: str, ptype: str, lang: str, similarity_threshold: float = 0.86):
+    pipe = cache.pipeline()
+    pg.queue_bucket_reads(pipe, norm_text, ptype, lang)
+    top = pg.similarity_candidates(await pipe.execute())
+    if not top:
+        return None
+    entries = await aread_entries(cache, top)
+    return pg.similarity_pick(norm_text, ptype, lang, top, entries, similarity_threshold)
+
+async def acache_lookup_ex(norm_text: str, ptype: str, lang: str, similarity_threshold: float = 0.86):
+    """Async twin of pg.cache_lookup_ex -> (prompt_or_None, tier)."""
+    key = pg.cache_key(norm_text, ptype, lang)
+    t = time.perf_counter()
+    v = pg.local_cache.get(key)
+    t = pg.observe_stage("l1", ptype, lang, t)
+    if v is not None:
+        pg.cache_touch(key, norm_text=norm_text)
+        return v, "l1"
+
+    # L2 قد يحجب (قفل WAL، تحديث atime، قرص بارد)؛ خارج حلقة الأحداث مثل الكتابة
+    stale = None
+    if pg.l2_cache is not None:
+        ent = await asyncio.to_thread(pg.l2_cache.get, key)
+        t = pg.observe_stage("l2", ptype, lang, t)
+        if ent is not None:
+            age = time.time() - ent[2]
+            if age < pg.CACHE_SOFT_TTL:
+                pg.local_cache.put(key, ent[1], ttl=pg.CACHE_SOFT_TTL - age)
+                pg.cache_touch(key, norm_text=norm_text)
+                return ent[1], "l2"
+            stale = ent[1]
+
+    cache = aredis_client()
+    if cache:
+        try:
+            ent = (await aread_entries(cache, [key], {key: norm_text})).get(key)
+        except redis.RedisError as e:
+            pg.redis_error("get", e)
+            return (stale, "l2") if stale is not None else (None, "miss")
+        t = pg.observe_stage("redis_exact", ptype, lang, t)
+        if ent is not None:
+            v, age = ent[1], time.time() - ent[2]
+            if age >= pg.CACHE_SOFT_TTL:
+                pg.CACHE_STALE_SERVED.inc("redis_exact")
+                pg.schedule_refresh(key, norm_text, ptype, lang)
+            else:
+                pg.local_cache.put(key, v, ttl=pg.CACHE_SOFT_TTL - age)
+            if pg.l2_cache is not None:
+                # الكتابة في SQLite تحجب؛ خارج حلقة الأحداث
+                await asyncio.to_thread(pg.l2_cache.put, key, pg.encode_entry(norm_text, v, ent[2]),
+                                        ent[2] + pg.CACHE_TTL_DEFAULT)
+            pg.cache_touch(key, norm_text=norm_text)
+            return v, "redis_exact"
+
+        if stale is not None:
+            pg.CACHE_STALE_SERVED.inc("l2")
+            pg.schedule_refresh(key, norm_text, ptype, lang)
+            return stale, "l2"
+
+        try:
+            v2 = await asimilarity_lookup(cache, norm_text, ptype, lang, similarity_threshold)
+        except redis.RedisError as e:
+            pg.redis_error("similarity", e)
+            v2 = None
+        pg.observe_stage("similarity", ptype, lang, t)
+        if v2 is not None:
+            pg.local_cache.put(key, v2)
+            return v2, "similarity"
+
+    if stale is not None:
+        pg.CACHE_STALE_SERVED.inc("l2")
+        return stale, "l2"
+    return None, "miss"
+
+async def aresolve_without_model(a: pg.RequestAnalysis):
+    """Quick rules, then smart cache. Returns (result_or_None, outcome)."""
+    t = time.perf_counter()
+    rule_prompt, rule_type = pg.apply_quick_rules(a)
+    t = pg.observe_stage("rules", a.ptype, a.lang, t)
+    if rule_prompt:
+        intent = rule_type if rule_type else a.ptype
+        pg.OUTCOMES.inc("rule", pg.metric_type(intent), a.lang)
+        return pg._result(intent, a.lang, rule_prompt, rule_based=True), "rule"
+
+    norm = a.norm
+    pg.observe_stage("normalize", a.ptype, a.lang, t)
+    cached, tier = await acache_lookup_ex(norm, a.ptype, a.lang)
+    if cached:
+        pg.OUTCOMES.inc(tier, a.ptype, a.lang)
+        return pg._result(a.ptype, a.lang, cached, cached=True), tier
+    return None, "miss"
+
+# ------------ Single-flight (in-process futures + the same Redis lease as app.py) ------------
+_flights = {}  # cache key -> asyncio.Future with the leader's result (None if it failed)
+
+async def _aget(cache, key: str):
+    raw = await cache.get(pg.CACHE_ENTRY_PREFIX + key)
+    try:
+        return pg.decode_entry(raw)[1] if raw else None
+    except ValueError:
+        return None
+
+async def _await_remote(cache, key: str, lock_key: str):
+    """pg._sf_wait_remote on the event loop: poll until the result lands or the lease goes away."""
+    deadline = time.time() + pg.sf_wait_max()
+    while time.time() < deadline:
+        v = await _aget(cache, key)
+        if v is not None:
+            return v
+        if not await cache.exists(lock_key):
+            return await _aget(cache, key)  # القفل يُحرَّر بعد الكتابة: أعد القراءة مرة أخيرة
+        await asyncio.sleep(pg.SF_POLL_SECS)
+    return None
+
+async def asingle_flight(key: str, fn):
+    """Await fn() once per key across tasks and workers -> (value, coalesced)."""
+    flight = _flights.get(key)
+    if flight is not None:
+        try:
+            v = await asyncio.wait_for(asyncio.shield(flight), pg.sf_wait_max())
+        except asyncio.TimeoutError:
+            v = None
+        if v is not None:
+            return v, True
+        return await fn(), False  # القائد فشل أو تأخر كثيرًا
+
+    flight = _flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        token, lock_key = None, pg.CACHE_LOCK_PREFIX + key
+        cache = aredis_client()
+        if cache:
+            try:
+                token = pg.sha1(f"{os.getpid()}:{id(flight)}:{time.time()}")
+                if not await cache.set(lock_key, token, nx=True, px=pg.sf_lease_ms()):
+                    token = None
+                    v = await _await_remote(cache, key, lock_key)
+                    if v is not None:
+                        flight.set_result(v)
+                        return v, True
+            except redis.RedisError as e:
+                pg.redis_error("lock", e)
+                token = None
+        try:
+            v = await fn()
+        finally:
+            if token:
+                # نفس طابور الكتابة الذي يحمل قيمة الكاش، فيُحرَّر القفل بعد وصولها
+                pg.backend.submit(lambda pipe: pipe.eval(pg._SF_RELEASE_LUA, 1, lock_key, token))
+        flight.set_result(v)
+        return v, False
+    finally:
+        _flights.pop(key, None)
+        if not flight.done():
+            flight.set_result(None)
+
+# ------------ Admission Control (asyncio twin of pg.AdmissionController) ------------
+class AsyncAdmission:
+    """Same shedding rules as pg.AdmissionController; waiters are futures, not threads."""
+
+    def __init__(self, max_inflight: int, queue_max: int, wait_max: float):
+        self.max_inflight, self.queue_max, self.wait_max = max_inflight, queue_max, wait_max
+        self.inflight = 0
+        self.waiting = 0
+        self.service_time = 1.0
+        self._waiters = deque()
+
+    def _expected_wait(self) -> float:
+        return (self.waiting + 1) * self.service_time / max(1, self.max_inflight)
+
+    def _shed(self, reason: str):
+        pg.ADMIT_SHED.inc(reason)
+        raise pg.Overloaded(reason, max(1, math.ceil(self._expected_wait())))
+
+    async def _acquire(self):
+        if self.inflight < self.max_inflight:
+            self.inflight += 1
+            pg.ADMIT_INFLIGHT.set(self.inflight)
+            return
+        if self.waiting >= self.queue_max:
+            self._shed("queue_full")
+        if self._expected_wait() > self.wait_max:
+            self._shed("deadline")
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        self.waiting += 1
+        pg.ADMIT_QUEUED.set(self.waiting)
+        try:
+            await asyncio.wait_for(fut, self.wait_max)  # _release يسلّم المقعد مباشرة (inflight لا يتغير)
+        except asyncio.TimeoutError:
+            self._shed("timeout")
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release(0.0)
+            raise
+        finally:
+            self.waiting -= 1
+            pg.ADMIT_QUEUED.set(self.waiting)
+
+    def _release(self, held: float):
+        self.service_time = 0.8 * self.service_time + 0.2 * held
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.inflight -= 1
+        pg.ADMIT_INFLIGHT.set(self.inflight)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold a model slot for the body of `async with`; raises pg.Overloaded instead of waiting too long."""
+        t0 = time.monotonic()
+        await self._acquire()
+        t1 = time.monotonic()
+        pg.ADMIT_WAIT_SECONDS.observe(t1 - t0)
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - t1)
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "queued": self.waiting,
+            "queue_max": self.queue_max,
+            "wait_max_s": self.wait_max,
+            "service_time_s": round(self.service_time, 4),
+            "shed": {r: int(pg.ADMIT_SHED.value(r)) for r in ("busy", "queue_full", "deadline", "timeout")},
+        }
+
+admission = AsyncAdmission(ASGI_MAX_INFLIGHT, ASGI_QUEUE_MAX, pg.ADMIT_WAIT_MAX)
+
+# ------------ Model Calls (deadline, retries, hedging on the event loop) ------------
+_tokens_loading = set()
+
+async def _reload_tokens(key: str, static: int):
+    est = None
+    try:
+        cache = aredis_client()
+        if cache:
+            est = pg.tokens_estimate(await cache.hgetall(key), static)
+    except redis.RedisError as e:
+        pg.redis_error("tokens", e)
+    finally:
+        pg.tokens_set(key, est)
+        _tokens_loading.discard(key)
+
+def max_tokens_for(a: pg.RequestAnalysis) -> int:
+    """pg.adaptive_max_tokens without blocking; stale estimates are reloaded in the background."""
+    if not pg.TOKENS_PIN_STATIC:
+        key = pg._tokens_key(a)
+        if key not in _tokens_loading and pg.tokens_stale(key):
+            _tokens_loading.add(key)
+            _spawn(_reload_tokens(key, pg.scaled_max_tokens(a.lang, a.ptype, a.complexity)))
+    return pg.adaptive_max_tokens(a, reload=False)
+
+async def _atimed_complete(req: dict, tier: dict, timeout: float):
+    t = time.perf_counter()
+    try:
+        out = await asyncio.wait_for(pg.model_backend.acomplete(req, timeout), timeout)
+    except asyncio.TimeoutError:
+        pg.record_model_call(tier, time.perf_counter() - t, False)
+        raise openai.error.Timeout("model call timed out")
+    except Exception:
+        pg.record_model_call(tier, time.perf_counter() - t, False)
+        raise
+    pg.record_model_call(tier, time.perf_counter() - t, True)
+    return out
+
+async def _ahedged_complete(req: dict, tier: dict, timeout: float):
+    """Like pg._hedged_complete, but the losing call is cancelled instead of left running."""
+    hedge_after = pg._latency_percentile(tier, pg.MODEL_HEDGE_PERCENTILE) if pg.MODEL_HEDGE else None
+    if hedge_after is None or hedge_after >= timeout:
+        return await _atimed_complete(req, tier, timeout)
+    first = asyncio.ensure_future(_atimed_complete(req, tier, timeout))
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done:
+        return first.result()
+    name = pg._tier_name(tier)
+    pg.MODEL_HEDGES.inc(name, "sent")
+    second = asyncio.ensure_future(_atimed_complete(req, tier, timeout - hedge_after))
+    pending, err = {first, second}, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    pg.MODEL_HEDGES.inc(name, "won" if f is second else "lost")
+                    return f.result()
+                err = f.exception()
+    finally:
+        for f in pending:
+            f.cancel()
+    raise err or openai.error.Timeout("model call timed out")
+
+async def amodel_complete(req: dict, tier: dict):
+    """pg.model_complete on the event loop: per-call timeouts, hedging, jittered retries within MODEL_DEADLINE."""
+    deadline = time.monotonic() + pg.MODEL_DEADLINE
+    for attempt in range(pg.MODEL_RETRIES + 1):
+        timeout = min(tier.get("timeout", pg.MODEL_TIMEOUT), deadline - time.monotonic())
+        if timeout <= 0:
+            raise openai.error.Timeout("model deadline exceeded")
+        try:
+            return await _ahedged_complete(req, tier, timeout)
+        except Exception as e:
+            if not pg._transient(e) or attempt == pg.MODEL_RETRIES:
+                raise
+            pg.MODEL_RETRIES_TOTAL.inc(pg._tier_name(tier), type(e).__name__)
+            logging.warning(f"⚠️ Model call failed ({type(e).__name__}), retrying: {e}")
+            await asyncio.sleep(min(random.uniform(0, pg.MODEL_BACKOFF * 2 ** attempt),
+                                    max(0.0, deadline - time.monotonic())))
+
+async def agenerate(a: pg.RequestAnalysis) -> str:
+    if not pg.model_ready():
+        return "Server misconfigured: OPENAI_API_KEY is missing."
+    tier = pg.route_model(a)
+    req = pg._chat_request(a, tier, max_tokens_for(a))
+    return pg.finish_completion(a, req, *await amodel_complete(req, tier))
+
+async def agenerate_and_store(a: pg.RequestAnalysis):
+    """Coalesced model call + cache write for one miss. Returns (prompt, coalesced)."""
+    async def _generate_and_store():
+        t = time.perf_counter()
+        async with admission.slot():
+            t = pg.observe_stage("admission", a.ptype, a.lang, t)
+            out = await agenerate(a)
+        t = pg.observe_stage("model", a.ptype, a.lang, t)
+        # L2 كتابة SQLite قد تنتظر قفل الملف: خارج الحلقة
+        await asyncio.to_thread(pg.cache_store, a.norm, a.ptype, a.lang, out)
+        pg.observe_stage("store", a.ptype, a.lang, t)
+        return out
+
+    prompt_text, coalesced = await asingle_flight(a.key, _generate_and_store)
+    pg.OUTCOMES.inc("coalesced" if coalesced else "miss", a.ptype, a.lang)
+    return prompt_text, coalesced
+
+# ------------ Endpoints ------------
+class _Headers(dict):
+    """Case-insensitive ASGI request headers (enough for pg.quota_client)."""
+
+    def __init__(self, raw):
+        super().__init__((k.decode("latin-1").lower(), v.decode("latin-1")) for k, v in raw)
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+async def generate(scope, body: bytes):
+    """POST /generate — same request/response JSON as the Flask endpoint."""
+    t0 = time.perf_counter()
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = {}
+    a, language = pg.parse_generate_input(data if isinstance(data, dict) else {})
+    if a is None:
+        msg = "الرجاء إدخال نص صحيح" if language.startswith("ar") else "Please enter valid text"
+        return 400, {"error": msg}, {}
+    pg.observe_stage("analyze", a.ptype, a.lang, t0)
+    client = pg.quota_client(_Headers(scope.get("headers", ())), (scope.get("client") or ("",))[0])
+    await acharge(client, pg.RATE_COST_HIT)
+
+    hit, outcome = await aresolve_without_model(a)
+    if hit:
+        pg.REQUEST_SECONDS.observe(time.perf_counter() - t0, "generate", outcome)
+        pg.request_log.log(a, outcome, t0, "generate")
+        return 200, hit, {}
+
+    await acharge(client, pg.RATE_COST_MODEL - pg.RATE_COST_HIT)
+    prompt_text, coalesced = await agenerate_and_store(a)
+    outcome = "coalesced" if coalesced else "miss"
+    pg.REQUEST_SECONDS.observe(time.perf_counter() - t0, "generate", outcome)
+    pg.request_log.log(a, outcome, t0, "generate")
+    return 200, pg._result(a.ptype, a.lang, prompt_text, coalesced=coalesced), {}
+
+async def health(scope, body: bytes):
+    redis_ok = False
+    cache = aredis_client()
+    if cache:
+        try:
+            await cache.ping()
+            redis_ok = True
+        except redis.RedisError as e:
+            pg.redis_error("ping", e)
+    report = await asyncio.to_thread(pg.health_report, redis_ok)  # إحصاءات L2/Redis تلمس SQLite والشبكة
+    report["admission"] = admission.stats()
+    report["server"] = "asgi"
+    return 200, report, {}
+
+async def metrics(scope, body: bytes):
+    return 200, pg.render_metrics(), {"content-type": "text/plain; version=0.0.4"}
+
+ROUTES = {
+    ("POST", "/generate"): generate,
+    ("GET", "/health"): health,
+    ("GET", "/metrics"): metrics,
+}
+
+def _error(e: Exception):
+    """Same status codes and bodies as app.py's error handlers."""
+    if isinstance(e, pg.RateLimited):
+        return 429, {"error": "Rate limit exceeded, please retry later", "retry_after": e.retry_after}, \
+            {"retry-after": str(e.retry_after)}
+    if isinstance(e, pg.Overloaded):
+        return 503, {"error": "Server busy, please retry", "retry_after": e.retry_after}, \
+            {"retry-after": str(e.retry_after)}
+    if isinstance(e, openai.error.OpenAIError):
+        logging.warning(f"⚠️ Model call failed: {type(e).__name__}: {e}")
+        status = 504 if isinstance(e, openai.error.Timeout) else 503
+        return status, {"error": "Model temporarily unavailable, please retry"}, {}
+    logging.exception("request failed")
+    return 500, {"error": "Internal server error"}, {}
+
+# ------------ ASGI ------------
+async def _send(send, status: int, payload, headers: dict):
+    if isinstance(payload, str):
+        body = payload.encode("utf-8")
+    else:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {"content-type": "application/json", **headers}
+    headers = {"access-control-allow-origin": "*", "content-length": str(len(body)), **headers}
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _read_body(receive):
+    """Request body, or None if it exceeds ASGI_MAX_BODY."""
+    chunks, size = [], 0
+    while True:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            break
+        chunk = msg.get("body", b"")
+        size += len(chunk)
+        if size > ASGI_MAX_BODY:
+            return None
+        chunks.append(chunk)
+        if not msg.get("more_body"):
+            break
+    return b"".join(chunks)
+
+async def _lifespan(receive, send):
+    global _aredis
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            if _aredis is not None:
+                await _aredis.aclose()
+                _aredis = None
+            aio = getattr(pg.model_backend, "_aio", None)
+            if aio is not None and not aio.closed:
+                await aio.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    method, path = scope["method"], scope["path"].rstrip("/") or "/"
+    if method == "OPTIONS":  # CORS preflight (مثل flask_cors الافتراضي)
+        req_headers = _Headers(scope.get("headers", ())).get("access-control-request-headers", "*")
+        return await _send(send, 200, "", {"access-control-allow-methods": "GET, POST, OPTIONS",
+                                           "access-control-allow-headers": req_headers})
+    handler = ROUTES.get((method, path))
+    if handler is None:
+        known = any(p == path for _, p in ROUTES)
+        return await _send(send, 405 if known else 404,
+                           {"error": "Method not allowed" if known else "Not found"}, {})
+    body = await _read_body(receive)
+    if body is None:
+        return await _send(send, 413, {"error": "Request body too large"}, {})
+    try:
+        status, payload, headers = await handler(scope, body)
+    except Exception as e:
+        status, payload, headers = _error(e)
+    await _send(send, status, payload, headers)
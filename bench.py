@@ -0,0 +1,662 @@
+# bench.py
+# ============================================================
+# Offline benchmark + load replay for app.py (no network needed)
+# - Local stand-ins: in-memory Redis + app.StubBackend model with configurable latency
+# - Replays a corpus in requests.jsonl shape (+ synthetic AR/EN mixes) through /generate
+# - Reports p50/p95/p99 + throughput per path: rule / exact / similarity / model
+# - Microbenchmarks: normalize_text, request analysis, quick_rules, cache_lookup latency + hit rate at 2k..200k entries
+# - Cache policy replay: hit rate of LRU vs TinyLFU (L1) and recent-list vs decayed-LFU (Redis) per capacity
+# - Cache entry encoding: encode/decode cost; bytes per entry (packed vs legacy) under health.cache_encoding
+# - JSON output; --compare prints ratios against a previous run
+# ------------------------------------------------------------
+# Usage:
+#   python bench.py                          # synthetic corpus, JSON to stdout
+#   python bench.py --corpus requests.jsonl --out run.json
+#   python bench.py --quick --compare run.json
+#   python bench.py --redis-url redis://localhost:6379/15   # real Redis instead of the stand-in
+#   python bench.py --quick --l2 /tmp/pg_l2.sqlite3                 # include the shared L2 tier
+# ============================================================
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import fnmatch
+import argparse
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("MODEL_BACKEND", "stub")
+os.environ.setdefault("REDIS_URL", "redis://127.0.0.1:1")  # fail fast; replaced below
+
+import app as pg  # noqa: E402
+
+# ------------ In-memory Redis stand-in ------------
+class FakePipeline:
+    def __init__(self, r):
+        self._r = r
+        self._ops = []
+
+    def __getattr__(self, name):
+        def queue(*a, **k):
+            self._ops.append((name, a, k))
+            return self
+        return queue
+
+    def execute(self):
+        with self._r.lock:
+            out = [getattr(self._r, n)(*a, **k) for n, a, k in self._ops]
+        self._ops = []
+        return out
+
+class FakeRedis:
+    """The subset of redis-py used by app.py; values are bytes like the real client."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.d = {}
+        self.exp = {}
+
+    @staticmethod
+    def _b(v):
+        if isinstance(v, bytes):
+            return v
+        if isinstance(v, float) and v.is_integer():
+            v = int(v)
+        return str(v).encode("utf-8")
+
+    def _live(self, k):
+        e = self.exp.get(k)
+        if e is not None and e <= time.time():
+            self.d.pop(k, None)
+            self.exp.pop(k, None)
+        return k in self.d
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def ping(self):
+        return True
+
+    def flushdb(self):
+        with self.lock:
+            self.d.clear()
+            self.exp.clear()
+
+    # strings
+    def get(self, k):
+        with self.lock:
+            return self.d.get(k) if self._live(k) else None
+
+    def mget(self, keys):
+        return [self.get(k) for k in keys]
+
+    def set(self, k, v, nx=False, ex=None, px=None):
+        with self.lock:
+            if nx and self._live(k):
+                return None
+            self.d[k] = self._b(v)
+            self.exp.pop(k, None)
+            if ex:
+                self.exp[k] = time.time() + ex
+            if px:
+                self.exp[k] = time.time() + px / 1000.0
+            return True
+
+    def setex(self, k, ttl, v):
+        return self.set(k, v, ex=ttl)
+
+    def incrby(self, k, amount=1):
+        with self.lock:
+            v = int(self.d[k]) + amount if self._live(k) else amount
+            self.d[k] = self._b(v)
+            return v
+
+    def decrby(self, k, amount=1):
+        return self.incrby(k, -amount)
+
+    # hashes
+    def _h(self, k):
+        if not self._live(k):
+            self.d[k] = {}
+        return self.d[k]
+
+    def hincrby(self, k, field, amount=1):
+        with self.lock:
+            h = self._h(k)
+            f = self._b(field)
+            h[f] = self._b(int(h.get(f, b"0")) + amount)
+            return int(h[f])
+
+    def hget(self, k, field):
+        with self.lock:
+            return self.d[k].get(self._b(field)) if self._live(k) else None
+
+    def hset(self, k, field=None, value=None, mapping=None):
+        with self.lock:
+            h = self._h(k)
+            items = dict(mapping or {})
+            if field is not None:
+                items[field] = value
+            new = sum(1 for f in items if self._b(f) not in h)
+            h.update({self._b(f): self._b(v) for f, v in items.items()})
+            return new
+
+    def hgetall(self, k):
+        with self.lock:
+            return dict(self.d[k]) if self._live(k) else {}
+
+    def exists(self, *keys):
+        with self.lock:
+            return sum(1 for k in keys if self._live(k))
+
+    def delete(self, *keys):
+        with self.lock:
+            n = 0
+            for k in keys:
+                n += self.d.pop(k, None) is not None
+                self.exp.pop(k, None)
+            return n
+
+    def expire(self, k, ttl):
+        with self.lock:
+            if not self._live(k):
+                return False
+            self.exp[k] = time.time() + ttl
+            return True
+
+    def pttl(self, k):
+        with self.lock:
+            if not self._live(k):
+                return -2
+            e = self.exp.get(k)
+            return -1 if e is None else int((e - time.time()) * 1000)
+
+    def keys(self, pattern="*"):
+        with self.lock:
+            return [k.encode("utf-8") for k in list(self.d) if self._live(k) and fnmatch.fnmatchcase(k, pattern)]
+
+    # lists
+    def lpush(self, k, *vals):
+        with self.lock:
+            self._live(k)
+            lst = self.d.setdefault(k, [])
+            for v in vals:
+                lst.insert(0, self._b(v))
+            return len(lst)
+
+    def ltrim(self, k, start, stop):
+        with self.lock:
+            if self._live(k):
+                lst = self.d[k]
+                self.d[k] = lst[start:None if stop == -1 else stop + 1]
+            return True
+
+    def lrange(self, k, start, stop):
+        with self.lock:
+            if not self._live(k):
+                return []
+            return list(self.d[k][start:None if stop == -1 else stop + 1])
+
+    # sorted sets
+    def _z(self, k):
+        if not self._live(k):
+            self.d[k] = {}
+        return self.d[k]
+
+    def _zsorted(self, k):
+        return sorted(self._z(k).items(), key=lambda x: (x[1], x[0]))
+
+    def zadd(self, k, mapping):
+        with self.lock:
+            z = self._z(k)
+            new = sum(1 for m in mapping if self._b(m) not in z)
+            z.update({self._b(m): float(s) for m, s in mapping.items()})
+            return new
+
+    def zremrangebyrank(self, k, start, stop):
+        with self.lock:
+            items = self._zsorted(k)
+            n = len(items)
+            start = start + n if start < 0 else start
+            stop = stop + n if stop < 0 else stop
+            gone = items[max(start, 0):stop + 1]
+            for m, _ in gone:
+                del self.d[k][m]
+            return len(gone)
+
+    def zscore(self, k, m):
+        with self.lock:
+            return self._z(k).get(self._b(m))
+
+    def zcard(self, k):
+        with self.lock:
+            return len(self._z(k))
+
+    def zpopmin(self, k, count=1):
+        with self.lock:
+            gone = self._zsorted(k)[:count]
+            for m, _ in gone:
+                del self.d[k][m]
+            return gone
+
+    def zrevrange(self, k, start, stop, withscores=False):
+        with self.lock:
+            items = self._zsorted(k)[::-1][start:None if stop == -1 else stop + 1]
+            return items if withscores else [m for m, _ in items]
+
+    def zscan_iter(self, k, count=None):
+        with self.lock:
+            items = list(self._z(k).items())
+        return iter(items)
+
+    # scripts used by app.py (matched by shape, not executed as Lua)
+    def eval(self, script, numkeys, *args):
+        keys, argv = args[:numkeys], args[numkeys:]
+        with self.lock:
+            if "redis.call('del'" in script and "redis.call('get'" in script:
+                if self.get(keys[0]) == self._b(argv[0]):
+                    return self.delete(keys[0])
+                return 0
+            if "'hincrby', KEYS[1], 'n'" in script:  # completion-usage histogram
+                self.hincrby(keys[0], argv[0])
+                if str(argv[1]) == "1":
+                    self.hincrby(keys[0], "length")
+                if self.hincrby(keys[0], "n") > int(argv[2]):
+                    h = self._h(keys[0])
+                    for f, v in list(h.items()):
+                        if int(v) // 2:
+                            h[f] = self._b(int(v) // 2)
+                        else:
+                            del h[f]
+                return 1
+            if "'hmget', KEYS[1], 't', 'ts'" in script:  # quota token bucket
+                rate, burst, want, need, refund = (float(x) for x in argv)
+                now = time.time()  # redis.call('TIME')
+                h = self._h(keys[0])
+                t = float(h.get(b"t", burst))
+                t = min(burst, t + max(0.0, now - float(h.get(b"ts", now))) * rate + refund)
+                got = min(want, t) if t >= need else 0
+                t -= got
+                h[b"t"], h[b"ts"] = self._b(repr(t)), self._b(repr(now))
+                self.expire(keys[0], (math.ceil(burst / rate * 1000) + 1000) / 1000.0)
+                return [self._b(repr(got)), self._b(repr(t))]
+            if "zpopmin" in script:  # popularity touch (log-space decayed frequency, bounded) + LSH buckets
+                x, s = float(argv[1]), self.zscore(keys[0], argv[0])
+                part = str(argv[0]).rsplit("|", 1)[0]
+                if s is not None:
+                    hi, lo = max(s, x), min(s, x)
+                    x = hi + math.log2(1 + 2 ** (lo - hi))
+                else:
+                    self.hincrby(keys[1], part)
+                self.zadd(keys[0], {argv[0]: x})
+                if len(keys) > 2:
+                    n = int(self.hget(keys[1], part) or 0)
+                    cap = max(int(argv[4]), math.ceil(n * float(argv[5])))
+                    for bk in keys[2:]:
+                        self.zadd(bk, {argv[0]: x})
+                        self.zremrangebyrank(bk, 0, -(cap + 1))
+                        self.expire(bk, int(argv[6]))
+                over = self.zcard(keys[0]) - int(argv[2])
+                if over > 0:
+                    for m, _ in self.zpopmin(keys[0], over):
+                        m = m.decode("utf-8")
+                        self.delete(str(argv[3]) + m)
+                        self.hincrby(keys[1], m.rsplit("|", 1)[0], -1)
+                return repr(x).encode("ascii")
+        raise NotImplementedError("FakeRedis.eval: unknown script")
+
+def install_standins(redis_url: str = "", latency: float = 0.0, jitter: float = 0.0, l2_path: str = ""):
+    """Point app.py at the stand-ins (or a real Redis) and disable the rate limiter and quotas; L2 only if l2_path."""
+    if redis_url:
+        import redis
+        client = redis.from_url(redis_url)
+        client.flushdb()
+    else:
+        client = FakeRedis()
+    pg.backend.attach(client)
+    pg.model_backend = pg.StubBackend(latency, jitter)
+    pg.limiter.enabled = False
+    pg.quotas.enabled = False
+    pg.local_cache.clear()
+    pg.l2_cache = pg.SharedCache(l2_path, pg.L2_MAX_BYTES) if l2_path else None
+    if pg.l2_cache is not None:
+        pg.l2_cache.clear()
+
+# ------------ Corpus ------------
+EN_SUBJECTS = ["a lighthouse", "a desert caravan", "a cyberpunk street", "an old library", "a mountain village",
+               "a coral reef", "a space station", "a rainy cafe", "a medieval market", "a bamboo forest"]
+EN_TWISTS = ["at sunset", "in heavy fog", "under neon lights", "in winter", "from a drone view", "in watercolor style"]
+AR_SUBJECTS = ["منارة قديمة", "قافلة في الصحراء", "شارع مستقبلي", "مكتبة عتيقة", "قرية جبلية",
+               "شعاب مرجانية", "محطة فضائية", "مقهى ممطر", "سوق شعبي", "غابة خيزران"]
+AR_TWISTS = ["عند الغروب", "في ضباب كثيف", "تحت أضواء النيون", "في الشتاء", "من زاوية علوية", "بأسلوب ألوان مائية"]
+RULE_INPUTS = ["give me a motivational quote", "اكتب تغريدة عن القراءة", "javascript sum two numbers",
+               "html dropdown menu", "job interview question", "عنوان يوتيوب عن الطبخ"]
+TYPES = ["image", "video", "text", "code", ""]
+
+def synthetic_corpus(n: int, seed: int = 7, ar_share: float = 0.4, rule_share: float = 0.15,
+                     repeat_share: float = 0.35, near_share: float = 0.15, zipf: float = 0.0):
+    """
+    Mixed AR/EN requests with exact repeats, near-duplicates and rule hits.
+    zipf > 0 skews repeats towards a few popular inputs (Pareto shape; smaller = heavier head).
+    """
+    rnd = random.Random(seed)
+    seen = []
+    out = []
+    for i in range(n):
+        r = rnd.random()
+        if r < rule_share:
+            out.append({"prompt": rnd.choice(RULE_INPUTS)})
+            continue
+        if seen and r < rule_share + repeat_share:
+            if zipf > 0:
+                out.append(dict(seen[min(len(seen), int(rnd.paretovariate(zipf))) - 1]))
+            else:
+                out.append(dict(rnd.choice(seen)))
+            continue
+        if seen and r < rule_share + repeat_share + near_share:
+            base = dict(rnd.choice(seen))
+            base["prompt"] = base["prompt"] + ("!" if rnd.random() < 0.5 else "s")
+            out.append(base)
+            continue
+        if rnd.random() < ar_share:
+            text = f"{rnd.choice(AR_SUBJECTS)} {rnd.choice(AR_TWISTS)} رقم {i}"
+        else:
+            text = f"{rnd.choice(EN_SUBJECTS)} {rnd.choice(EN_TWISTS)} number {i}"
+        item = {"prompt": text, "type": rnd.choice(TYPES)}
+        seen.append(item)
+        out.append(item)
+    return out
+
+def load_corpus(path: str):
+    """requests.jsonl shape: one JSON object per line; uses prompt/text/input, else title + body."""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            text = row.get("prompt") or row.get("text") or row.get("input") \
+                or " ".join(x for x in (row.get("title"), row.get("body")) if x)
+            if text:
+                items.append({"prompt": text, "type": row.get("type", ""), "language": row.get("language", "")})
+    return items
+
+# ------------ Stats ------------
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = (len(sorted_vals) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+def summarize(samples_ms):
+    s = sorted(samples_ms)
+    total = sum(s)
+    return {
+        "n": len(s),
+        "mean_ms": round(total / len(s), 4) if s else None,
+        "p50_ms": round(percentile(s, 50), 4) if s else None,
+        "p95_ms": round(percentile(s, 95), 4) if s else None,
+        "p99_ms": round(percentile(s, 99), 4) if s else None,
+        "max_ms": round(s[-1], 4) if s else None,
+        # single-thread service rate for this path
+        "throughput_rps": round(len(s) / (total / 1000.0), 2) if total else None,
+    }
+
+def timeit_us(fn, n: int):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return round((time.perf_counter() - t0) / n * 1e6, 3)
+
+# ------------ Replay ------------
+_path_tls = threading.local()
+_orig_similarity_lookup = pg.similarity_lookup
+
+def _tracking_similarity_lookup(*a, **k):
+    v = _orig_similarity_lookup(*a, **k)
+    if v is not None:
+        _path_tls.similar = True
+    return v
+
+def classify(resp: dict) -> str:
+    if resp.get("rule_based"):
+        return "rule"
+    if resp.get("cached"):
+        return "similarity" if getattr(_path_tls, "similar", False) else "exact"
+    if resp.get("coalesced"):
+        return "coalesced"
+    return "model"
+
+def replay(items, concurrency: int = 1):
+    """Drive /generate with every item; returns per-path latency summaries + wall throughput."""
+    pg.similarity_lookup = _tracking_similarity_lookup
+    per_path = {}
+    lock = threading.Lock()
+
+    def one(item):
+        client = pg.app.test_client()
+        _path_tls.similar = False
+        t0 = time.perf_counter()
+        r = client.post("/generate", json=item)
+        dt = (time.perf_counter() - t0) * 1000.0
+        path = classify(r.get_json() or {}) if r.status_code == 200 else f"http_{r.status_code}"
+        with lock:
+            per_path.setdefault(path, []).append(dt)
+
+    t0 = time.perf_counter()
+    try:
+        if concurrency <= 1:
+            for item in items:
+                one(item)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(one, items))
+    finally:
+        pg.similarity_lookup = _orig_similarity_lookup
+    wall = time.perf_counter() - t0
+    pg.backend.flush()
+
+    health = pg.app.test_client().get("/health")
+    return {
+        "requests": len(items),
+        "concurrency": concurrency,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(items) / wall, 2) if wall else None,
+        "model_calls": pg.model_backend.calls,
+        "paths": {p: summarize(v) for p, v in sorted(per_path.items())},
+        "health": health.get_json(),
+    }
+
+# ------------ Microbenchmarks ------------
+def micro(sizes, reps: int = 2000, l2_path: str = ""):
+    rnd = random.Random(11)
+    en = "A cinematic shot of a lone astronaut walking through a neon-lit Tokyo alley at night, rain reflections!"
+    ar = "مشهد سينمائي لرائد فضاء يمشي وحيدًا في زقاق مضاء بالنيون في طوكيو ليلًا، مع انعكاسات المطر!"
+    a_miss = pg.analyze_request(en)
+    a_hit = pg.analyze_request("give me a motivational quote")
+    blob = pg.encode_entry(pg.normalize_text(ar), ar * 4)
+    out = {
+        "normalize_text_en_us": timeit_us(lambda: pg.normalize_text(en), reps),
+        "normalize_text_ar_us": timeit_us(lambda: pg.normalize_text(ar), reps),
+        "analyze_request_en_us": timeit_us(lambda: pg.analyze_request(en), reps),
+        "analyze_request_ar_us": timeit_us(lambda: pg.analyze_request(ar), reps),
+        "quick_rules_miss_us": timeit_us(lambda: pg.apply_quick_rules(a_miss), reps),
+        "quick_rules_hit_us": timeit_us(lambda: pg.apply_quick_rules(a_hit), reps),
+        "heuristic_intent_us": timeit_us(lambda: pg.heuristic_intent(en), reps),
+        "minhash_signature_us": timeit_us(lambda: pg.minhash_signature(pg.normalize_text(en)), reps),
+        "encode_entry_us": timeit_us(lambda: pg.encode_entry(pg.normalize_text(en), en * 4), reps),
+        "decode_entry_us": timeit_us(lambda: pg.decode_entry(blob), reps),
+        "cache_lookup": {},
+    }
+
+    words = (" ".join(EN_SUBJECTS + EN_TWISTS)).split()
+    for n in sizes:
+        install_standins(l2_path=l2_path)
+        cached = []  # (normalized text, stored prompt)
+        for i in range(n):
+            t = pg.normalize_text(" ".join(rnd.choice(words) for _ in range(8)) + f" {i}")
+            pg.cache_store(t, "image", "en", f"prompt {i}")
+            if i % max(1, n // 200) == 0:
+                cached.append((t, f"prompt {i}"))
+            if i % 1000 == 999:
+                pg.backend.flush(60)  # keep the async write queue from dropping
+        pg.backend.flush(60)
+        pg.local_cache.clear()
+        probes_exact = cached[:100]
+        probes_near = [(t + "s", v) for t, v in cached[:100]]
+        probes_miss = [(pg.normalize_text(f"zebra quantum violin {i} orchard"), None) for i in range(100)]
+
+        def run(probes):
+            """Latency plus hit_rate (the stored prompt came back); for misses hit_rate is false positives."""
+            samples, hits = [], 0
+            for p, want in probes:
+                pg.local_cache.clear()
+                t0 = time.perf_counter()
+                got = pg.cache_lookup(p, "image", "en")
+                samples.append((time.perf_counter() - t0) * 1000.0)
+                hits += got is not None and (want is None or got == want)
+            return dict(summarize(samples), hit_rate=round(hits / max(1, len(probes)), 3))
+
+        out["cache_lookup"][str(n)] = {
+            "exact": run(probes_exact),
+            "similar": run(probes_near),
+            "miss": run(probes_miss),
+        }
+    return out
+
+# ------------ Cache policy replay ------------
+def policy_replay(items, fractions=(0.1, 0.25, 0.5), value_bytes: int = 400):
+    """
+    Hit rates of cache policies over the request sequence (rule hits excluded), at capacities
+    given as fractions of the distinct cache keys:
+      l1_lru / l1_tinylfu: LocalCache without / with TinyLFU admission (byte budget)
+      redis_recent_list:   the old pg:keys window (LPUSH on every store, LTRIM to N, duplicates kept)
+      redis_decayed_lfu:   the pg:pop zset (decayed frequency, least popular evicted beyond N)
+    """
+    keys = []
+    for item in items:
+        a = pg.analyze_request(item.get("prompt", ""), item.get("type", ""), item.get("language", ""))
+        if a.text and not pg.apply_quick_rules(a)[0]:
+            keys.append(a.key)
+    distinct = len(set(keys))
+    value = "x" * value_bytes
+    out = {"requests": len(keys), "distinct_keys": distinct, "capacities": {}}
+    for frac in fractions:
+        n = max(1, int(distinct * frac))
+        entry = len(keys[0].encode("utf-8")) + value_bytes + pg.LocalCache.ENTRY_OVERHEAD if keys else 1
+        rates = {}
+        for name, admission in (("l1_lru", False), ("l1_tinylfu", True)):
+            lc, hits = pg.LocalCache(n * entry, 1e9, admission), 0
+            for k in keys:
+                if lc.get(k) is not None:
+                    hits += 1
+                else:
+                    lc.put(k, value)
+            rates[name] = round(hits / (len(keys) or 1), 4)
+
+        recent, hits = [], 0
+        for k in keys:
+            if k in recent:
+                hits += 1
+            else:
+                recent.insert(0, k)
+                del recent[n:]
+        rates["redis_recent_list"] = round(hits / (len(keys) or 1), 4)
+
+        scores, hits = {}, 0
+        for i, k in enumerate(keys):
+            x = pg.popularity_score(1, now=float(i))  # one request per simulated second
+            if k in scores:
+                hits += 1
+                s = scores[k]
+                hi, lo = max(s, x), min(s, x)
+                scores[k] = hi + math.log2(1 + 2 ** (lo - hi))
+            else:
+                scores[k] = x
+                if len(scores) > n:
+                    del scores[min(scores, key=scores.get)]
+        rates["redis_decayed_lfu"] = round(hits / (len(keys) or 1), 4)
+        out["capacities"][f"{frac:g}"] = {"entries": n, **rates}
+    return out
+
+# ------------ Compare ------------
+def _flatten(d, prefix=""):
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            yield from _flatten(v, key + ".")
+        elif isinstance(v, (int, float)) and not isinstance(v, bool) and (key.endswith("_ms") or key.endswith("_us")
+                                                                          or key.endswith("_rps")
+                                                                          or key.endswith("hit_rate")):
+            yield key, v
+
+def compare(old: dict, new: dict):
+    """Print new/old ratio for every latency/throughput/hit-rate metric present in both runs."""
+    old_f = dict(_flatten(old))
+    for k, v in _flatten(new):
+        o = old_f.get(k)
+        if o:
+            print(f"{k:70s} {o:>12.4f} -> {v:>12.4f}  x{v / o:.3f}", file=sys.stderr)
+
+# ------------ Main ------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Offline benchmark for app.py")
+    ap.add_argument("--corpus", help="requests.jsonl-shaped file to replay (default: synthetic)")
+    ap.add_argument("--synthetic", type=int, default=2000, help="synthetic requests when no corpus is given")
+    ap.add_argument("--ar-share", type=float, default=0.4)
+    ap.add_argument("--zipf", type=float, default=0.0, help="skew synthetic repeats (e.g. 1.2); 0 = uniform")
+    ap.add_argument("--latency", type=float, default=0.05, help="stub model latency (s)")
+    ap.add_argument("--jitter", type=float, default=0.01)
+    ap.add_argument("--concurrency", type=int, default=1)
+    ap.add_argument("--sizes", default="2000,20000,200000", help="cache_lookup window sizes")
+    ap.add_argument("--quick", action="store_true", help="small run: 300 requests, sizes 2000,20000")
+    ap.add_argument("--skip-micro", action="store_true")
+    ap.add_argument("--skip-policy", action="store_true")
+    ap.add_argument("--redis-url", default="", help="use a real Redis (it will be FLUSHDB'd)")
+    ap.add_argument("--l2", default="", help="enable the shared L2 tier at this SQLite path (it will be cleared)")
+    ap.add_argument("--out", help="write JSON here instead of stdout")
+    ap.add_argument("--compare", help="previous JSON run to compare against")
+    args = ap.parse_args(argv)
+
+    if args.quick:
+        args.synthetic = min(args.synthetic, 300)
+        args.sizes = "2000,20000"
+
+    items = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.synthetic, ar_share=args.ar_share, zipf=args.zipf)
+    install_standins(args.redis_url, args.latency, args.jitter, args.l2)
+
+    result = {
+        "meta": {
+            "ts": time.time(),
+            "python": platform.python_version(),
+            "corpus": args.corpus or f"synthetic:{len(items)}",
+            "latency_s": args.latency,
+            "redis": "real" if args.redis_url else "fake",
+            "l2": bool(args.l2),
+        },
+        "replay": replay(items, args.concurrency),
+    }
+    if not args.skip_policy:
+        result["policy"] = policy_replay(items)
+    if not args.skip_micro:
+        result["micro"] = micro([int(x) for x in args.sizes.split(",") if x], l2_path=args.l2)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# mine_log.py
+# ============================================================
+# Offline analyzer for the request log (REQUEST_LOG_PATH in app.py)
+# - Groups logged inputs by (type, lang), clusters near-duplicate normalized texts with the
+#   same MinHash/LSH + SequenceMatcher test the similarity cache uses
+# - Ranks clusters by model spend (tokens of real misses), then by frequency
+# - Writes candidate quick rules in RULES_FILE format (built-in rules first, mined ones after)
+#   and a cache-seed JSONL for CACHE_SEED_FILE (answers taken from Redis when reachable)
+# - A mined rule is limited to its cluster's type and language, and its phrases are the raw
+#   lowercased inputs the rule engine sees (the log's "text"); older lines without it only seed
+# ------------------------------------------------------------
+# Usage:
+#   python mine_log.py requests.log.jsonl                          # JSON report to stdout
+#   python mine_log.py logs/*.jsonl --rules-out mined_rules.json --seeds-out seeds.jsonl
+#   REDIS_URL=redis://cache:6379 python mine_log.py log.jsonl --min-count 10 --rules 50
+# Mined rules answer by substring match without calling the model — review them before shipping.
+# ============================================================
+
+import os
+import sys
+import json
+import argparse
+from difflib import SequenceMatcher
+from collections import Counter as Tally
+
+pg = None  # app.py، يُستورد في main() فقط: استيراده يشغّل خيوط Redis والسجل
+
+# ------------ Load ------------
+def load_log(paths):
+    """{(type, lang, norm): stats} aggregated over all log lines; malformed lines are skipped."""
+    groups, bad = {}, 0
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                    k = (row["type"], row["language"], row["prompt"])
+                except (ValueError, KeyError, TypeError):
+                    bad += 1
+                    continue
+                if not k[2]:
+                    continue
+                g = groups.setdefault(k, {"count": 0, "model_calls": 0, "tokens": 0, "latency_ms": 0.0,
+                                          "outcomes": Tally(), "texts": Tally()})
+                g["count"] += 1
+                if row.get("text"):
+                    g["texts"][row["text"]] += 1
+                g["outcomes"][row.get("outcome", "unknown")] += 1
+                g["latency_ms"] += row.get("latency_ms") or 0.0
+                if row.get("outcome") == "miss":  # فقط الاستدعاء الفعلي يكلّف (لا المدمج ولا الضربات)
+                    g["model_calls"] += 1
+                    g["tokens"] += row.get("tokens") or 0
+    return groups, bad
+
+# ------------ Cluster ------------
+def cluster(groups, threshold: float):
+    """Union near-duplicates that share an LSH bucket and pass the SequenceMatcher threshold."""
+    parent = {k: k for k in groups}
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    buckets = {}
+    for k in sorted(groups, key=lambda k: -groups[k]["count"]):
+        ptype, lang, norm = k
+        for bk in pg.lsh_bucket_keys(norm, ptype, lang):
+            buckets.setdefault(bk, []).append(k)
+    for members in buckets.values():
+        head = members[0]  # الأكثر تكرارًا في الحزمة
+        for k in members[1:]:
+            if find(k) == find(head):
+                continue
+            sm = SequenceMatcher(a=head[2], b=k[2])
+            if sm.quick_ratio() >= threshold and sm.ratio() >= threshold:
+                parent[find(k)] = find(head)
+
+    clusters = {}
+    for k in groups:
+        clusters.setdefault(find(k), []).append(k)
+    out = []
+    for members in clusters.values():
+        members.sort(key=lambda k: -groups[k]["count"])
+        ptype, lang, rep = members[0]
+        c = {"type": ptype, "language": lang, "prompt": rep, "variants": [m[2] for m in members],
+             "count": 0, "model_calls": 0, "tokens": 0, "latency_ms": 0.0, "outcomes": Tally(), "texts": Tally()}
+        for m in members:
+            g = groups[m]
+            for f in ("count", "model_calls", "tokens", "latency_ms"):
+                c[f] += g[f]
+            c["outcomes"].update(g["outcomes"])
+            c["texts"].update(g["texts"])
+        out.append(c)
+    out.sort(key=lambda c: (-c["tokens"], -c["count"]))
+    return out
+
+def attach_answers(clusters):
+    """Cached prompt for each cluster (representative first, then variants) when Redis is reachable."""
+    cache = pg.redis_client()
+    if cache is None:
+        return 0
+    n = 0
+    for c in clusters:
+        keys = {pg.cache_key(v, c["type"], c["language"]): v for v in c["variants"][:8]}
+        found = pg.read_entries(cache, list(keys), keys)
+        for k in keys:
+            if k in found:
+                c["answer"] = found[k][1]
+                n += 1
+                break
+    return n
+
+# ------------ Outputs ------------
+def candidate_rules(clusters, limit: int, min_count: int, min_phrase: int):
+    """
+    Quick-rule entries for the hottest clusters that have a cached answer, answering only
+    the cluster's type and language. Phrases are the most common raw lowercased inputs.
+    """
+    rules = []
+    for c in clusters:
+        if len(rules) >= limit:
+            break
+        phrases = [t for t, _ in c["texts"].most_common(5) if len(t) >= min_phrase]
+        if c["count"] < min_count or not c.get("answer") or not phrases:
+            continue
+        rules.append({
+            "name": f"mined_{c['type']}_{c['language']}_{pg.sha1(c['prompt'])[:8]}",
+            "type": c["type"],
+            "types": [c["type"]],
+            "languages": [c["language"]],
+            "match": [phrases],
+            c["language"]: c["answer"],
+            "mined": {"count": c["count"], "model_calls": c["model_calls"], "tokens": c["tokens"]},
+        })
+    return rules
+
+def seed_rows(clusters, limit: int, min_count: int):
+    rows = []
+    for c in clusters:
+        if len(rows) >= limit:
+            break
+        if c["count"] < min_count:
+            continue
+        row = {"prompt": c["prompt"], "type": c["type"], "language": c["language"],
+               "count": c["count"], "tokens": c["tokens"]}
+        if c.get("answer"):
+            row["answer"] = c["answer"]
+        rows.append(row)
+    return rows
+
+def report(groups, clusters, bad: int, top: int) -> dict:
+    total = sum(g["count"] for g in groups.values())
+    outcomes = Tally()
+    for g in groups.values():
+        outcomes.update(g["outcomes"])
+    tokens = sum(c["tokens"] for c in clusters)
+    repeated = sum(c["tokens"] for c in clusters if c["count"] > 1)
+    return {
+        "lines": total,
+        "bad_lines": bad,
+        "distinct_inputs": len(groups),
+        "clusters": len(clusters),
+        "outcomes": dict(outcomes.most_common()),
+        "model_tokens": tokens,
+        "model_tokens_on_repeated": repeated,  # ما يمكن توفيره بالقواعد/البذور
+        "top": [{"prompt": c["prompt"][:120], "type": c["type"], "language": c["language"], "count": c["count"],
+                 "model_calls": c["model_calls"], "tokens": c["tokens"], "variants": len(c["variants"]),
+                 "answer": bool(c.get("answer"))} for c in clusters[:top]],
+    }
+
+# ------------ Main ------------
+def main(argv=None):
+    global pg
+    os.environ.setdefault("MODEL_BACKEND", "stub")  # لا استدعاءات نموذج هنا
+    import app as pg
+
+    ap = argparse.ArgumentParser(description="Mine the request log for quick-rule candidates and cache seeds.")
+    ap.add_argument("logs", nargs="+", help="request log JSONL file(s)")
+    ap.add_argument("--threshold", type=float, default=0.86, help="near-duplicate SequenceMatcher ratio")
+    ap.add_argument("--min-count", type=int, default=5, help="min requests per cluster for a rule")
+    ap.add_argument("--min-phrase", type=int, default=12, help="shortest raw input used as a rule phrase")
+    ap.add_argument("--rules", type=int, default=20, help="max mined rules")
+    ap.add_argument("--seeds", type=int, default=500, help="max cache seeds")
+    ap.add_argument("--seed-min-count", type=int, default=2)
+    ap.add_argument("--top", type=int, default=20, help="clusters listed in the report")
+    ap.add_argument("--base-rules", default=pg.RULES_FILE, help="RULES_FILE to extend (default: built-in rules)")
+    ap.add_argument("--rules-out", default="", help="write RULES_FILE JSON here")
+    ap.add_argument("--seeds-out", default="", help="write CACHE_SEED_FILE JSONL here")
+    args = ap.parse_args(argv)
+
+    groups, bad = load_log(args.logs)
+    clusters = cluster(groups, args.threshold)
+    answered = attach_answers(clusters)
+    out = report(groups, clusters, bad, args.top)
+    out["answers_found"] = answered
+
+    if args.rules_out:
+        base = {}
+        if args.base_rules:
+            with open(args.base_rules, "r", encoding="utf-8") as f:
+                base = json.load(f)
+        mined = candidate_rules(clusters, args.rules, args.min_count, args.min_phrase)
+        spec = {"quick_rules": base.get("quick_rules", pg.QUICK_RULES) + mined,
+                "intent_keywords": base.get("intent_keywords", pg.INTENT_KEYWORDS)}
+        pg.KeywordEngine(spec["quick_rules"], spec["intent_keywords"])  # يرفض ملفًا لا يمكن تحميله
+        with open(args.rules_out, "w", encoding="utf-8") as f:
+            json.dump(spec, f, ensure_ascii=False, indent=1)
+        out["rules_written"] = len(mined)
+    if args.seeds_out:
+        rows = seed_rows(clusters, args.seeds, args.seed_min_count)
+        with open(args.seeds_out, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        out["seeds_written"] = len(rows)
+
+    json.dump(out, sys.stdout, ensure_ascii=False, indent=1)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# tests/conftest.py — app.py with the stub model and bench.py's in-memory Redis (no network needed)
+import os
+import sys
+
+os.environ.setdefault("MODEL_BACKEND", "stub")
+os.environ.setdefault("REDIS_URL", "redis://127.0.0.1:1")  # يُستبدل بـ FakeRedis في كل اختبار
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import app as pg
+import bench
+
+@pytest.fixture
+def standins():
+    """Fresh FakeRedis + StubBackend per test; returns the FakeRedis."""
+    bench.install_standins()
+    yield pg.redis_client()
+    pg.local_cache.clear()
+
+@pytest.fixture(params=["emulated", "lua"])
+def scripted(request):
+    """
+    Redis for the Lua scripts: bench.FakeRedis's emulation, then a server that really runs them
+    (REDIS_TEST_URL, else fakeredis + lupa). The "lua" run is skipped when neither is available.
+    """
+    if request.param == "emulated":
+        yield bench.FakeRedis()
+        return
+    url = os.getenv("REDIS_TEST_URL")
+    if url:
+        import redis
+        client = redis.from_url(url)
+    else:
+        pytest.importorskip("lupa")
+        client = pytest.importorskip("fakeredis").FakeRedis()
+    client.flushdb()
+    yield client
+    client.flushdb()
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+import app as pg
+
+def test_busy_slot_is_shed_without_waiting():
+    ctl = pg.AdmissionController(1, 4, 2.0)
+    with ctl.slot():
+        with pytest.raises(pg.Overloaded) as e:
+            ctl.slot(wait=False)
+    assert e.value.reason == "busy" and e.value.retry_after >= 1
+    assert ctl.inflight == 0
+
+def test_full_queue_is_shed():
+    ctl = pg.AdmissionController(1, 0, 2.0)
+    with ctl.slot():
+        with pytest.raises(pg.Overloaded) as e:
+            ctl.slot()
+    assert e.value.reason == "queue_full"
+
+def test_predicted_wait_over_the_limit_is_shed():
+    ctl = pg.AdmissionController(1, 4, 2.0)
+    ctl.service_time = 5.0
+    with ctl.slot():
+        with pytest.raises(pg.Overloaded) as e:
+            ctl.slot()
+    assert e.value.reason == "deadline" and e.value.retry_after == 5
+
+def test_waiter_times_out():
+    ctl = pg.AdmissionController(1, 4, 0.05)
+    ctl.service_time = 0.01
+    with ctl.slot():
+        with pytest.raises(pg.Overloaded) as e:
+            ctl.slot()
+    assert e.value.reason == "timeout" and ctl.waiting == 0
+
+def test_waiter_gets_the_released_slot():
+    ctl = pg.AdmissionController(1, 4, 2.0)
+    ctl.service_time = 0.01
+    first = ctl.slot()
+    got = []
+    t = threading.Thread(target=lambda: got.append(ctl.slot()))
+    t.start()
+    time.sleep(0.05)
+    assert ctl.waiting == 1 and not got
+    first.release()
+    first.release()  # idempotent
+    t.join(1)
+    assert got and ctl.inflight == 1
+    got[0].release()
+    assert ctl.inflight == 0
+
+def test_generate_answers_503_when_shed(standins, monkeypatch):
+    monkeypatch.setattr(pg, "admission", pg.AdmissionController(0, 0, 1.0))
+    r = pg.app.test_client().post("/generate", json={"prompt": "a bamboo forest from a drone view"})
+    assert r.status_code == 503 and int(r.headers["Retry-After"]) >= 1
+    assert pg.model_backend.calls == 0
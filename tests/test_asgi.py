@@ -0,0 +1,38 @@
+import asyncio
+import threading
+
+import app as pg
+import asgi
+
+class _RacingCache:
+    """The leader writes its result and drops the lock between the follower's get and exists."""
+
+    def __init__(self, blob):
+        self.blob, self.gets = blob, 0
+
+    async def get(self, key):
+        self.gets += 1
+        return self.blob if self.gets > 1 else None
+
+    async def exists(self, key):
+        return 0
+
+def test_await_remote_rereads_after_lock_release():
+    cache = _RacingCache(pg.encode_entry("norm", "leader result"))
+    assert asyncio.run(asgi._await_remote(cache, "k", "lock")) == "leader result"
+
+def test_l2_hit_is_read_off_the_event_loop(standins, monkeypatch, tmp_path):
+    l2 = pg.SharedCache(str(tmp_path / "l2.sqlite"), 1 << 20)
+    monkeypatch.setattr(pg, "l2_cache", l2)
+    norm = pg.normalize_text("an old library in winter")
+    key = pg.cache_key(norm, "image", "en")
+    l2.put(key, pg.encode_entry(norm, "from l2"), pg.time.time() + 60)
+    loop_threads = []
+    get = l2.get
+    monkeypatch.setattr(l2, "get", lambda k: loop_threads.append(threading.get_ident()) or get(k))
+
+    async def lookup():
+        return threading.get_ident(), await asgi.acache_lookup_ex(norm, "image", "en")
+    loop_thread, found = asyncio.run(lookup())
+    assert found == ("from l2", "l2")
+    assert loop_threads and loop_thread not in loop_threads
@@ -0,0 +1,68 @@
+import queue
+
+import redis
+
+import app as pg
+import bench
+
+class _FlakyRedis(bench.FakeRedis):
+    """FakeRedis whose ping fails until `up` is set."""
+    up = False
+
+    def ping(self):
+        if not self.up:
+            raise redis.ConnectionError("down")
+        return True
+
+def test_breaker_opens_after_repeated_failures_and_drops_writes(monkeypatch):
+    monkeypatch.setattr(pg, "REDIS_BREAKER_FAILURES", 3)
+    b = pg.CacheBackend("redis://unused")
+    b.attach(bench.FakeRedis())
+    assert b.state == "closed" and b.client() is not None
+    for _ in range(2):
+        b.failure()
+    assert b.state == "closed"
+    b.failure()
+    assert b.state == "open" and b.client() is None and b.trips == 1
+    dropped = pg.REDIS_WRITES.value("dropped")
+    assert b.submit(lambda pipe: pipe.set("k", "v")) is False
+    assert pg.REDIS_WRITES.value("dropped") == dropped + 1
+
+def test_reconnect_closes_the_breaker_and_runs_hooks():
+    fake = _FlakyRedis()
+    b = pg.CacheBackend("redis://unused")
+    b.attach(fake)
+    assert b.state == "open"
+    hooks = []
+    b.on_connect(lambda: hooks.append(1))
+    assert hooks == []
+    fake.up = True
+    assert b._try_connect() and b.state == "closed" and hooks == [1]
+
+def test_writes_are_batched_in_fifo_order():
+    fake = bench.FakeRedis()
+    b = pg.CacheBackend("redis://unused")
+    b.attach(fake)
+    for i in range(200):
+        assert b.submit(lambda pipe, i=i: pipe.set("k", str(i)))
+    assert b.flush()
+    assert fake.get("k") == b"199"
+    assert b.stats()["write_queue"] == 0
+
+def test_failed_write_batch_is_counted():
+    b = pg.CacheBackend("redis://unused")
+    b.attach(bench.FakeRedis())
+    failed = pg.REDIS_WRITES.value("failed")
+
+    def boom(pipe):
+        raise redis.TimeoutError("slow")
+    b.submit(boom)
+    assert b.flush()
+    assert pg.REDIS_WRITES.value("failed") == failed + 1
+
+def test_full_write_queue_drops_instead_of_blocking():
+    b = pg.CacheBackend("redis://unused")
+    b._queue = queue.Queue(maxsize=1)
+    b.state = "closed"  # no writer thread: the queue stays full
+    assert b.submit(lambda pipe: None) is True
+    assert b.submit(lambda pipe: None) is False
@@ -0,0 +1,71 @@
+import json
+
+import app as pg
+
+def _post(items, **extra):
+    return pg.app.test_client().post("/generate/batch", json={"items": items, **extra})
+
+def test_identical_items_are_generated_once(standins):
+    items = [{"prompt": "a desert caravan at sunset", "type": "image"}] * 3 + \
+            [{"prompt": "A  Desert caravan at sunset!", "type": "image"}]
+    r = _post(items)
+    results = r.get_json()["results"]
+    assert r.status_code == 200 and len(results) == 4
+    assert pg.model_backend.calls == 1
+    assert len({res["prompt"] for res in results}) == 1
+
+def test_results_keep_input_order_and_mark_invalid_items(standins):
+    items = [{"prompt": "a coral reef in winter"}, {"prompt": ""}, "not an object",
+             {"prompt": "", "language": "ar"}, {"prompt": "a space station in heavy fog"}]
+    results = _post(items).get_json()["results"]
+    assert "coral reef" in results[0]["prompt"] and "space station" in results[4]["prompt"]
+    assert results[1] == {"error": "Please enter valid text"} and results[2] == results[1]
+    assert results[3] == {"error": "الرجاء إدخال نص صحيح"}
+
+def test_cached_items_skip_the_model(standins):
+    _post([{"prompt": "an old library under neon lights"}])
+    pg.backend.flush()
+    pg.local_cache.clear()
+    calls = pg.model_backend.calls
+    res = _post([{"prompt": "an old library under neon lights"}]).get_json()["results"][0]
+    assert res["cached"] is True and pg.model_backend.calls == calls
+
+def test_model_failure_is_a_per_item_error(standins):
+    pg.model_backend = pg.StubBackend(0.0, 0.0, fail_rate=1.0)
+    results = _post([{"prompt": "a bamboo forest in watercolor style"}, {"prompt": ""}]).get_json()["results"]
+    assert "error" in results[0] and results[1] == {"error": "Please enter valid text"}
+    assert pg.admission.stats()["inflight"] == 0
+
+def test_rejects_bad_payloads(standins):
+    c = pg.app.test_client()
+    assert c.post("/generate/batch", json={"items": []}).status_code == 400
+    assert c.post("/generate/batch", json={"items": {"prompt": "x"}}).status_code == 400
+    assert c.post("/generate/batch", data="not json").status_code == 400
+    assert _post([{"prompt": "a rainy cafe"}] * (pg.BATCH_MAX_ITEMS + 1)).status_code == 413
+
+def test_stream_returns_one_line_per_item(standins):
+    r = _post([{"prompt": "a mountain village from a drone view"}, {"prompt": ""},
+               {"prompt": "a mountain village from a drone view"}], stream=True)
+    lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines() if line]
+    assert sorted(line["index"] for line in lines) == [0, 1, 2]
+    assert pg.model_backend.calls == 1
+
+def test_every_unique_item_is_charged(standins, monkeypatch):
+    charged = []
+    monkeypatch.setattr(pg.quotas, "charge", lambda client, cost: charged.append(cost))
+    pg.cache_store(pg.normalize_text("a coral reef in heavy fog"), "image", "en", "cached prompt")
+    pg.backend.flush()
+    pg.local_cache.clear()
+    items = [{"prompt": "give me a motivational quote"}] * 2 + \
+            [{"prompt": "a coral reef in heavy fog", "type": "image"}] * 2 + [{"prompt": "a space station at sunset"}]
+    results = _post(items).get_json()["results"]
+    assert results[0]["rule_based"] and results[2]["cached"] and not results[4]["cached"]
+    assert sorted(charged) == [pg.RATE_COST_HIT, pg.RATE_COST_HIT, pg.RATE_COST_MODEL]
+
+def test_items_over_quota_get_a_rate_limit_error(standins, monkeypatch):
+    def deny(client, cost):
+        raise pg.RateLimited("ip", 7)
+    monkeypatch.setattr(pg.quotas, "charge", deny)
+    results = _post([{"prompt": "give me a motivational quote"}, {"prompt": "a desert caravan"}]).get_json()["results"]
+    assert all(r == {"error": "Rate limit exceeded, please retry later", "retry_after": 7} for r in results)
+    assert pg.model_backend.calls == 0
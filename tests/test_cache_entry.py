@@ -0,0 +1,44 @@
+import json
+import time
+
+import pytest
+
+import app as pg
+
+@pytest.mark.parametrize("norm,prompt", [
+    ("", ""),
+    ("a lighthouse at sunset", "Create a detailed prompt for a lighthouse at sunset, golden light"),
+    ("منارة قديمة عند الغروب", "أنشئ وصفًا بصريًا غنيًا لمنارة قديمة عند الغروب"),
+    ("x" * 3, "y" * 5000),  # compressed body
+])
+def test_encode_decode_round_trip(norm, prompt):
+    raw = pg.encode_entry(norm, prompt, ts=1700000000)
+    assert pg.decode_entry(raw) == (norm, prompt, 1700000000)
+
+def test_decode_rejects_bad_records():
+    raw = pg.encode_entry("norm", "prompt " * 50)
+    with pytest.raises(ValueError):
+        pg.decode_entry(raw[:3])
+    with pytest.raises(ValueError):
+        pg.decode_entry(bytes([255]) + raw[1:])
+
+def test_legacy_exact_read_keeps_age_and_ttl(standins, monkeypatch):
+    refreshed = []
+    monkeypatch.setattr(pg, "schedule_refresh", lambda key, *a: refreshed.append(key) or True)
+    norm = pg.normalize_text("an old legacy prompt about boats")
+    key = pg.cache_key(norm, "image", "en")
+    standins.setex(pg.CACHE_VAL_PREFIX + key, 12 * 3600, "legacy prompt")  # written 6.5 days ago
+    assert pg.cache_lookup_ex(norm, "image", "en") == ("legacy prompt", "redis_exact")
+    pg.backend.flush()
+    assert refreshed == [key]
+    assert 11 * 3600 < standins.pttl(pg.CACHE_ENTRY_PREFIX + key) / 1000 <= 12 * 3600
+    assert abs(time.time() - pg.decode_entry(standins.get(pg.CACHE_ENTRY_PREFIX + key))[2] - 6.5 * 86400) < 60
+
+@pytest.mark.parametrize("norm", ["a lighthouse at sunset", "منارة قديمة عند الغروب"])
+def test_legacy_size_estimate_matches_json_meta(norm, monkeypatch):
+    monkeypatch.setattr(pg, "_encode_stats", {"entries": 0, "stored_bytes": 0, "legacy_bytes": 0})
+    key, prompt = pg.cache_key(norm, "image", "en"), "a detailed prompt"
+    pg.record_entry_bytes(key, norm, "image", "en", prompt, pg.encode_entry(norm, prompt))
+    meta = json.dumps({"norm": norm, "type": "image", "lang": "en", "ts": 1700000000.123456})
+    expected = len(pg.CACHE_VAL_PREFIX + key) + len(prompt) + len(pg.CACHE_META_PREFIX + key) + len(meta)
+    assert pg._encode_stats["legacy_bytes"] == expected
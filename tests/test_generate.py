@@ -0,0 +1,18 @@
+import app as pg
+
+def test_generate_miss_then_exact_hit(standins):
+    c = pg.app.test_client()
+    first = c.post("/generate", json={"prompt": "a lighthouse in heavy fog", "type": "image"}).get_json()
+    assert first["cached"] is False
+    pg.backend.flush()
+    second = c.post("/generate", json={"prompt": "a lighthouse in heavy fog", "type": "image"}).get_json()
+    assert second["cached"] is True and second["prompt"] == first["prompt"]
+
+def test_stream_model_failure_sends_error_event(standins):
+    pg.model_backend = pg.StubBackend(0.0, 0.0, fail_rate=1.0)
+    r = pg.app.test_client().post("/generate/stream", json={"prompt": "a wolf in the snow"})
+    body = r.get_data(as_text=True)
+    assert r.status_code == 200
+    assert body.startswith("event: error\n") and '"status": 503' in body
+    assert "event: done" not in body
+    assert pg.admission.stats()["inflight"] == 0
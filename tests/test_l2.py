@@ -0,0 +1,45 @@
+import os
+import time
+
+import app as pg
+
+def _l2(tmp_path, max_bytes=16 * 1024 * 1024):
+    return pg.SharedCache(str(tmp_path / "l2.sqlite"), max_bytes)
+
+def test_put_get_round_trip_and_expiry(tmp_path):
+    l2 = _l2(tmp_path)
+    l2.put("image|en|a", pg.encode_entry("a fox", "prompt a", ts=1700000000), time.time() + 60)
+    l2.put("image|en|b", pg.encode_entry("a bear", "prompt b"), time.time() - 1)
+    assert l2.get("image|en|a") == ("a fox", "prompt a", 1700000000)
+    assert l2.get("image|en|b") is None and l2.get("image|en|c") is None
+    assert l2.hits == 1 and l2.misses == 2
+
+def test_workers_share_the_file(tmp_path):
+    _l2(tmp_path).put("k", pg.encode_entry("n", "p"), time.time() + 60)
+    assert _l2(tmp_path).get("k")[1] == "p"
+
+def test_evict_drops_expired_then_least_recently_read(tmp_path, monkeypatch):
+    l2 = _l2(tmp_path, max_bytes=64 * 1024)
+    monkeypatch.setattr(l2, "EVICT_EVERY", 10 ** 9)  # only the explicit evict() below
+    now = time.time()
+    for i in range(200):
+        monkeypatch.setattr(pg.time, "time", lambda i=i: now + i)
+        body = os.urandom(500).hex()  # incompressible, ~1 KB per row
+        l2.put(f"k{i}", pg.encode_entry(f"n{i}", body), now + (5 if i < 10 else 3600))
+    monkeypatch.setattr(pg.time, "time", lambda: now + 300)
+    assert l2.evict() > 10
+    assert l2.used_bytes() <= l2.max_bytes and l2.stats()["size"] == l2.rows < 190
+    assert l2.get("k0") is None and l2.get("k50") is None
+    assert l2.get("k199")[0] == "n199"
+
+def test_put_hands_eviction_to_the_background(tmp_path, monkeypatch):
+    l2 = _l2(tmp_path)
+    monkeypatch.setattr(l2, "EVICT_EVERY", 4)
+    swept = []
+    monkeypatch.setattr(l2, "evict", lambda: swept.append(1))
+    for i in range(4):
+        l2.put(f"k{i}", pg.encode_entry("n", "p"), time.time() + 60)
+    deadline = time.time() + 5
+    while not swept and time.time() < deadline:
+        time.sleep(0.01)
+    assert swept and l2._evict_pid is not None
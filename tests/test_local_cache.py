@@ -0,0 +1,80 @@
+import time
+
+import app as pg
+
+def _size(key, val):
+    return len(key.encode("utf-8")) + len(val.encode("utf-8")) + pg.LocalCache.ENTRY_OVERHEAD
+
+def test_lru_keeps_bytes_under_budget():
+    cache = pg.LocalCache(3 * _size("k0", "v" * 100), ttl=60, admission=False)
+    for i in range(4):
+        cache.put(f"k{i}", "v" * 100)
+    assert cache.bytes <= cache.max_bytes
+    assert len(cache) == 3 and cache.evictions == 1
+    assert cache.get("k0") is None  # oldest went first
+    assert cache.get("k3") == "v" * 100
+
+def test_get_refreshes_recency():
+    cache = pg.LocalCache(2 * _size("a", "x" * 50), ttl=60, admission=False)
+    cache.put("a", "x" * 50)
+    cache.put("b", "x" * 50)
+    cache.get("a")
+    cache.put("c", "x" * 50)
+    assert cache.get("a") == "x" * 50 and cache.get("b") is None
+
+def test_multibyte_values_count_as_utf8_bytes():
+    cache = pg.LocalCache(10_000, ttl=60, admission=False)
+    cache.put("ar", "منارة")
+    assert cache.bytes == _size("ar", "منارة") > len("ar") + len("منارة") + cache.ENTRY_OVERHEAD
+
+def test_oversized_entry_is_not_stored():
+    cache = pg.LocalCache(200, ttl=60, admission=False)
+    cache.put("small", "ok")
+    cache.put("big", "x" * 500)
+    assert cache.get("big") is None and cache.get("small") == "ok"
+
+def test_overwrite_replaces_size():
+    cache = pg.LocalCache(10_000, ttl=60, admission=False)
+    cache.put("k", "x" * 1000)
+    cache.put("k", "y")
+    assert len(cache) == 1 and cache.bytes == _size("k", "y")
+
+def test_entries_expire(monkeypatch):
+    cache = pg.LocalCache(10_000, ttl=5, admission=False)
+    now = time.time()
+    monkeypatch.setattr(pg.time, "time", lambda: now)
+    cache.put("k", "v")
+    cache.put("short", "v", ttl=1)
+    monkeypatch.setattr(pg.time, "time", lambda: now + 2)
+    assert cache.get("short") is None and cache.get("k") == "v"
+    monkeypatch.setattr(pg.time, "time", lambda: now + 6)
+    assert cache.get("k") is None
+    assert cache.expirations == 2 and cache.bytes == 0
+
+def test_admission_keeps_popular_entries_from_one_off_keys():
+    cache = pg.LocalCache(2 * _size("hot0", "v" * 100), ttl=60, admission=True)
+    for key in ("hot0", "hot1"):
+        cache.put(key, "v" * 100)
+        for _ in range(5):
+            cache.get(key)
+    cache.put("once", "v" * 100)
+    assert cache.rejections == 1 and cache.get("once") is None
+    assert cache.get("hot0") and cache.get("hot1")
+
+def test_admission_lets_a_frequent_newcomer_replace_the_victim():
+    cache = pg.LocalCache(2 * _size("old0", "v" * 100), ttl=60, admission=True)
+    cache.put("old0", "v" * 100)
+    cache.put("old1", "v" * 100)
+    for _ in range(3):
+        cache.get("new")  # misses still count as requests
+    cache.put("new", "v" * 100)
+    assert cache.get("new") and cache.get("old0") is None and cache.rejections == 0
+
+def test_sketch_counts_are_capped_and_halved():
+    sketch = pg.FrequencySketch(16)
+    for _ in range(40):
+        sketch.increment("k")
+    assert sketch.estimate("k") == sketch.CAP
+    for i in range(sketch.sample):
+        sketch.increment(f"other{i}")
+    assert sketch.estimate("k") < sketch.CAP
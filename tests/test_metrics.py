@@ -0,0 +1,36 @@
+import re
+
+import app as pg
+
+def test_histogram_buckets_are_cumulative():
+    h = pg.Histogram("t_seconds", "test.", ("stage",), buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 0.5, 5.0):
+        h.observe(v, "a")
+    lines = list(h.render())
+    assert lines[:2] == ["# HELP t_seconds test.", "# TYPE t_seconds histogram"]
+    assert 't_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{stage="a",le="1.0"} 3' in lines
+    assert 't_seconds_bucket{stage="a",le="+Inf"} 4' in lines
+    assert 't_seconds_count{stage="a"} 4' in lines and 't_seconds_sum{stage="a"} 6.05' in lines
+
+def test_label_values_are_escaped():
+    c = pg.Counter("t_total", "test.", ("op",))
+    c.inc('a"b\\c\nd')
+    assert list(c.render())[-1] == 't_total{op="a\\"b\\\\c\\nd"} 1.0'
+
+def test_metrics_endpoint_reports_stages_and_outcomes(standins):
+    c = pg.app.test_client()
+    c.post("/generate", json={"prompt": "a medieval market in winter", "type": "image"})
+    r = c.get("/metrics")
+    body = r.get_data(as_text=True)
+    assert r.status_code == 200 and r.mimetype == "text/plain"
+    assert re.search(r'^pg_outcomes_total\{outcome="miss",ptype="image",lang="en"\} [1-9]', body, re.M)
+    assert re.search(r'^pg_stage_seconds_count\{stage="model",ptype="image",lang="en"\} [1-9]', body, re.M)
+    for m in pg.METRICS:
+        assert f"# TYPE {m.name} " in body
+
+def test_prefiltered_candidates_are_counted_apart_from_scores():
+    before = pg.SIMILARITY_PREFILTERED.value("length")
+    entries = {"k": ("a much much longer stored prompt text about a lighthouse", "v", 0)}
+    assert pg.similarity_pick("a lighthouse", "image", "en", ["k"], entries, 0.86) is None
+    assert pg.SIMILARITY_PREFILTERED.value("length") == before + 1
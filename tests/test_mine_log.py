@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import app as pg
+import mine_log
+
+@pytest.fixture
+def mined(monkeypatch, tmp_path):
+    """Write a request log through RequestLog, then load and cluster it with mine_log."""
+    monkeypatch.setattr(mine_log, "pg", pg)
+    path = tmp_path / "requests.log.jsonl"
+    log = pg.RequestLog(str(path), 100, 0.01, 1.0)
+    for text in ["A Lighthouse at sunset, please"] * 6 + ["a lighthouse at sunset please!"] * 2:
+        log.log(pg.analyze_request(text, "image", "en"), "miss", time.perf_counter(), "generate")
+    deadline = time.time() + 5
+    while (not path.exists() or len(path.read_text().splitlines()) < 8) and time.time() < deadline:
+        time.sleep(0.01)
+    groups, bad = mine_log.load_log([str(path)])
+    clusters = mine_log.cluster(groups, 0.86)
+    clusters[0]["answer"] = "a cached lighthouse prompt"
+    return clusters
+
+def test_import_does_not_load_the_app():
+    code = "import sys, mine_log; assert 'app' not in sys.modules and mine_log.pg is None"
+    subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(mine_log.__file__), check=True)
+
+def test_log_lines_carry_the_raw_text(mined):
+    assert len(mined) == 1
+    assert mined[0]["texts"]["a lighthouse at sunset, please"] == 6
+
+def test_mined_rule_is_limited_to_its_type_and_language(mined):
+    rules = mine_log.candidate_rules(mined, 5, 5, 12)
+    assert len(rules) == 1
+    r = rules[0]
+    assert r["types"] == ["image"] and r["languages"] == ["en"]
+    assert "ar" not in r and r["en"] == "a cached lighthouse prompt"
+    assert r["match"] == [["a lighthouse at sunset, please", "a lighthouse at sunset please!"]]
+
+    engine = pg.KeywordEngine(pg.QUICK_RULES + rules, pg.INTENT_KEYWORDS)
+    hits = engine.scan("a lighthouse at sunset, please")
+    assert engine.match_rule(hits, "image", "en")["name"] == r["name"]
+    assert engine.match_rule(hits, "video", "en") is None
+    assert engine.match_rule(hits, "image", "ar") is None
+
+def test_rule_needs_answers_for_its_languages():
+    rule = {"name": "x", "type": "text", "match": [["hello there"]], "languages": ["ar"], "en": "hi"}
+    with pytest.raises(ValueError):
+        pg.KeywordEngine([rule], {})
+    pg.KeywordEngine([dict(rule, ar="مرحبا")], {})
+
+def test_rules_out_file_loads(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(mine_log, "attach_answers", lambda clusters: 0)
+    log = tmp_path / "requests.log.jsonl"
+    log.write_text("".join(json.dumps({"prompt": "a lighthouse at sunset please", "type": "image",
+                                       "language": "en", "text": "a lighthouse at sunset, please",
+                                       "outcome": "miss"}) + "\n" for _ in range(3)))
+    out = tmp_path / "rules.json"
+    mine_log.main([str(log), "--rules-out", str(out), "--base-rules", ""])
+    assert json.loads(capsys.readouterr().out)["rules_written"] == 0  # no cached answer, so seed only
+    pg._load_rules_file(str(out))
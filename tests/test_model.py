@@ -0,0 +1,81 @@
+import threading
+import time
+
+import openai
+import pytest
+
+import app as pg
+
+TIER = {"name": "test", "model": "stub"}
+REQ = {"messages": [{"role": "user", "content": "a fox"}], "max_tokens": 50}
+
+class _Scripted(pg.ModelBackend):
+    """Plays back one entry of `plan` per call: an exception to raise or seconds to sleep before answering."""
+    name = "scripted"
+
+    def __init__(self, *plan):
+        self.plan, self.calls = list(plan), 0
+        self._lock = threading.Lock()
+
+    def complete(self, req, timeout):
+        with self._lock:
+            step = self.plan[min(self.calls, len(self.plan) - 1)]
+            self.calls += 1
+            n = self.calls
+        if isinstance(step, Exception):
+            raise step
+        time.sleep(step)
+        return f"answer {n}", {"prompt_tokens": 1, "completion_tokens": 2}, "stop"
+
+    def stream(self, req, timeout):
+        yield self.complete(req, timeout)[0], "stop"
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setattr(pg, "MODEL_BACKOFF", 0.0)
+    monkeypatch.setattr(pg, "MODEL_RETRIES", 2)
+    monkeypatch.setattr(pg, "_model_latency", {})
+
+    def use(*plan):
+        b = _Scripted(*plan)
+        monkeypatch.setattr(pg, "model_backend", b)
+        return b
+    return use
+
+def test_backend_must_implement_complete_and_stream():
+    with pytest.raises(TypeError):
+        pg.ModelBackend()
+
+def test_transient_errors_are_retried(backend):
+    b = backend(openai.error.ServiceUnavailableError("busy"), openai.error.Timeout("slow"), 0.0)
+    retries = pg.MODEL_RETRIES_TOTAL.value("test", "Timeout")
+    assert pg.model_complete(REQ, TIER)[0] == "answer 3" and b.calls == 3
+    assert pg.MODEL_RETRIES_TOTAL.value("test", "Timeout") == retries + 1
+
+def test_retries_stop_at_the_limit(backend):
+    b = backend(openai.error.APIConnectionError("reset"))
+    with pytest.raises(openai.error.APIConnectionError):
+        pg.model_complete(REQ, TIER)
+    assert b.calls == pg.MODEL_RETRIES + 1
+
+def test_client_errors_are_not_retried(backend):
+    b = backend(openai.error.InvalidRequestError("bad request", "messages"))
+    with pytest.raises(openai.error.InvalidRequestError):
+        pg.model_complete(REQ, TIER)
+    assert b.calls == 1
+
+def test_slow_call_is_hedged_and_the_fast_one_wins(backend, monkeypatch):
+    monkeypatch.setattr(pg, "MODEL_HEDGE", True)
+    for _ in range(pg.MODEL_HEDGE_MIN_SAMPLES):
+        pg.record_model_call(TIER, 0.01, True)
+    b = backend(0.5, 0.0)
+    won = pg.MODEL_HEDGES.value("test", "won")
+    t = time.perf_counter()
+    assert pg.model_complete(REQ, TIER)[0] == "answer 2"
+    assert time.perf_counter() - t < 0.4 and b.calls == 2
+    assert pg.MODEL_HEDGES.value("test", "won") == won + 1
+
+def test_no_hedge_without_latency_history(backend, monkeypatch):
+    monkeypatch.setattr(pg, "MODEL_HEDGE", True)
+    b = backend(0.05)
+    assert pg.model_complete(REQ, TIER)[0] == "answer 1" and b.calls == 1
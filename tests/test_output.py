@@ -0,0 +1,17 @@
+import random
+
+import app as pg
+
+def test_stream_sanitizer_matches_sanitize_output():
+    rnd = random.Random(1)
+    words = ["chatgpt", "openai", "gpt", "dall", "google", "midjourney", "claude", "bard", "x", "  ",
+             "hello ", "GPT-4 ", " ChatGPT", "\n"]
+    for _ in range(2000):
+        s = " " + "".join(rnd.choice(words) for _ in range(rnd.randint(0, 20))) + " "
+        san, out, i = pg.StreamSanitizer(), "", 0
+        while i < len(s):
+            n = rnd.randint(1, 6)
+            out += san.feed(s[i:i + n])
+            i += n
+        out += san.flush()
+        assert out == pg.sanitize_output(s), repr(s)
@@ -0,0 +1,47 @@
+import math
+
+import pytest
+
+import app as pg
+
+def _touch(r, key, uses=1, norm_text=None):
+    pipe = r.pipeline(transaction=False)
+    pg._pop_touch(pipe, key, uses, norm_text)
+    pipe.execute()
+
+@pytest.fixture
+def frozen(monkeypatch):
+    monkeypatch.setattr(pg.time, "time", lambda: 1_700_000_000.0)
+
+def test_repeat_touches_add_in_log_space(scripted, frozen):
+    _touch(scripted, "image|en|a")
+    x = pg.popularity_score(1)
+    assert scripted.zscore(pg.CACHE_POP_ZSET, "image|en|a") == pytest.approx(x)
+    _touch(scripted, "image|en|a", uses=3)
+    assert scripted.zscore(pg.CACHE_POP_ZSET, "image|en|a") == pytest.approx(pg.popularity_score(4))
+    assert int(scripted.hget(pg.CACHE_LSH_SIZES, "image|en")) == 1
+
+def test_overflow_pops_the_least_popular_and_drops_its_entry(scripted, frozen, monkeypatch):
+    monkeypatch.setattr(pg, "CACHE_MAX_ENTRIES", 3)
+    for i, uses in enumerate([5, 1, 4, 3]):
+        scripted.set(pg.CACHE_ENTRY_PREFIX + f"text|ar|{i}", b"x")
+        _touch(scripted, f"text|ar|{i}", uses)
+    assert scripted.zcard(pg.CACHE_POP_ZSET) == 3
+    assert scripted.zscore(pg.CACHE_POP_ZSET, "text|ar|1") is None
+    assert not scripted.exists(pg.CACHE_ENTRY_PREFIX + "text|ar|1")
+    assert scripted.exists(pg.CACHE_ENTRY_PREFIX + "text|ar|0")
+    assert int(scripted.hget(pg.CACHE_LSH_SIZES, "text|ar")) == 3
+
+def test_buckets_follow_the_entry_score_and_stay_capped(scripted, frozen, monkeypatch):
+    monkeypatch.setattr(pg, "SIM_BUCKET_MIN", 2)
+    monkeypatch.setattr(pg, "SIM_BUCKET_SHARE", 0.0)
+    norm = "a lighthouse at sunset"
+    buckets = pg.lsh_bucket_keys(norm, "image", "en")
+    for i, uses in enumerate([1, 8, 2]):
+        _touch(scripted, f"image|en|{i}", uses, norm_text=norm)
+    for bk in buckets:
+        assert scripted.zcard(bk) == 2
+        assert scripted.zscore(bk, "image|en|0") is None
+        assert scripted.zscore(bk, "image|en|1") == pytest.approx(pg.popularity_score(8))
+        assert 0 < scripted.pttl(bk) <= pg.CACHE_TTL_DEFAULT * 1000
+    assert math.isclose(scripted.zscore(pg.CACHE_POP_ZSET, "image|en|2"), pg.popularity_score(2))
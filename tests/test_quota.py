@@ -0,0 +1,74 @@
+import time
+
+import pytest
+import redis
+
+import app as pg
+
+CLIENT = ("ip:test", "ip", pg._quota({"per_min": 6}))
+
+class _DownRedis:
+    def eval(self, *args):
+        raise redis.ConnectionError("down")
+
+@pytest.mark.parametrize("cache", [None, _DownRedis()])
+def test_fallback_bucket_when_redis_unavailable(monkeypatch, cache):
+    monkeypatch.setattr(pg, "redis_client", lambda: cache)
+    q = pg.QuotaLimiter(1.0)
+    for _ in range(6):
+        q.charge(CLIENT, 1.0)
+    with pytest.raises(pg.RateLimited) as e:
+        q.charge(CLIENT, 1.0)
+    assert e.value.scope == "ip" and e.value.retry_after >= 1
+
+def test_shared_bucket_through_redis(standins):
+    q = pg.QuotaLimiter(1.0)
+    for _ in range(6):
+        q.charge(CLIENT, 1.0)
+    with pytest.raises(pg.RateLimited):
+        q.charge(CLIENT, 1.0)
+    assert standins.hgetall(pg.RATE_BUCKET_PREFIX + CLIENT[0])
+
+def test_hits_spend_a_burst_sized_lease_locally(standins):
+    q = pg.QuotaLimiter(1.0)
+    client = ("ip:hits", "ip", pg._quota({"per_min": 20}))
+    before = pg.QUOTA_CHECKS.value("redis")
+    for _ in range(15):
+        q.charge(client, pg.RATE_COST_HIT)
+    assert pg.QUOTA_CHECKS.value("redis") - before <= 4
+
+def test_expired_lease_tokens_go_back_to_the_bucket(standins, monkeypatch):
+    q = pg.QuotaLimiter(1.0)
+    client = ("ip:idle", "ip", pg._quota({"per_min": 6, "burst": 6}))
+    clock = [1000.0]
+    monkeypatch.setattr(pg.time, "monotonic", lambda: clock[0])
+    for _ in range(6):  # each call leases more than it spends; leftovers must not be lost
+        q.charge(client, 1.0)
+        clock[0] += 5.0
+    left = float(standins.hgetall(pg.RATE_BUCKET_PREFIX + client[0])[b"t"])
+    assert left == pytest.approx(0.0, abs=0.05)  # all 6 tokens spent, every leftover returned
+    with pytest.raises(pg.RateLimited):
+        q.charge(client, 1.0)
+
+def _take(r, cost, refund=0.0, client=CLIENT):
+    got, left = r.eval(*pg.QuotaLimiter(1.0).take_args(client, cost, refund))
+    return float(got), float(left)
+
+def test_take_script_leases_and_denies(scripted):
+    want = CLIENT[2]["burst"] * pg.RATE_LEASE_SHARE
+    assert _take(scripted, 1.0) == pytest.approx((want, 6.0 - want), abs=0.01)
+    assert _take(scripted, 5.0) == pytest.approx((0.0, 6.0 - want), abs=0.01)  # need > t: nothing granted
+    h = scripted.hgetall(pg.RATE_BUCKET_PREFIX + CLIENT[0])
+    assert float(h[b"ts"]) == pytest.approx(time.time(), abs=5)  # the server's clock
+    assert 0 < scripted.pttl(pg.RATE_BUCKET_PREFIX + CLIENT[0]) <= 61_000
+
+def test_take_script_refunds_up_to_the_burst(scripted):
+    _take(scripted, 1.0)
+    assert _take(scripted, 1.0, refund=100.0)[1] == pytest.approx(6.0 - 1.2, abs=0.01)
+
+def test_take_script_refills_at_the_rate(scripted):
+    fast = ("ip:fast", "ip", pg._quota({"per_min": 600, "burst": 2}))
+    assert _take(scripted, 2.0, client=fast)[0] == pytest.approx(2.0)
+    time.sleep(0.15)
+    got, left = _take(scripted, 1.0, client=fast)
+    assert got == pytest.approx(1.0) and left >= 0.4
@@ -0,0 +1,32 @@
+import time
+
+import app as pg
+
+def _budget_spent(r):
+    return int(r.get(pg.CACHE_REFRESH_BUDGET_PREFIX + str(int(time.time() // 3600))) or 0)
+
+def test_refresh_makes_one_call_and_stores_it(standins):
+    norm = pg.normalize_text("a desert caravan in winter")
+    key = pg.cache_key(norm, "image", "en")
+    pg._refresh_pending.add(key)
+    pg._refresh_entry(key, norm, "image", "en")
+    pg.backend.flush()
+    assert pg.model_backend.calls == 1 and key not in pg._refresh_pending
+    assert pg.read_entries(standins, [key])
+    assert _budget_spent(standins) == pg._refresh_cost(pg.analyze_request(norm, "image", "en"))
+
+def test_failed_refresh_is_not_retried_or_hedged(standins, monkeypatch):
+    monkeypatch.setattr(pg, "MODEL_RETRIES", 3)
+    monkeypatch.setattr(pg, "MODEL_HEDGE", True)
+    pg.model_backend = pg.StubBackend(0.0, 0.0, fail_rate=1.0)
+    failed = pg.REFRESHES.value("failed")
+    norm = pg.normalize_text("a coral reef at sunset")
+    pg._refresh_entry(pg.cache_key(norm, "image", "en"), norm, "image", "en")
+    assert pg.model_backend.calls == 1
+    assert pg.REFRESHES.value("failed") == failed + 1
+
+def test_refresh_over_budget_skips_the_model(standins, monkeypatch):
+    monkeypatch.setattr(pg, "REFRESH_TOKEN_BUDGET", 10)
+    norm = pg.normalize_text("a rainy cafe under neon lights")
+    pg._refresh_entry(pg.cache_key(norm, "image", "en"), norm, "image", "en")
+    assert pg.model_backend.calls == 0 and _budget_spent(standins) == 0
@@ -0,0 +1,27 @@
+import random
+
+import app as pg
+import legacy_rules
+
+def _keywords():
+    kw = set()
+    for rule in pg.QUICK_RULES:
+        for group in rule["match"]:
+            kw |= set(group)
+    for words in pg.INTENT_KEYWORDS.values():
+        kw |= set(words)
+    return sorted(kw) + ["about ", "عن ", "Quote", "PYTHON", "x", "  ", ".py", "hello", "the ", "و ", "JS"]
+
+def test_keyword_engine_matches_legacy_chains():
+    kw = _keywords()
+    rnd = random.Random(3)
+    for _ in range(5000):
+        s = " ".join(rnd.choice(kw) for _ in range(rnd.randint(1, 5)))
+        if rnd.random() < 0.3:
+            s = s.upper()
+        lang = rnd.choice(["ar", "en"])
+        assert pg.quick_rules(s, lang) == legacy_rules.quick_rules(s, lang), s
+        assert pg.heuristic_intent(s) == legacy_rules.heuristic_intent(s), s
+
+def test_no_rule_for_plain_prompt():
+    assert pg.quick_rules("a lighthouse at sunset", "en") == (None, None)
@@ -0,0 +1,25 @@
+import hashlib
+import json
+import time
+
+import app as pg
+
+def test_unanswered_seeds_beyond_the_refresh_queue_all_get_cached(standins, monkeypatch, tmp_path):
+    monkeypatch.setattr(pg, "SEED_RETRY_SECS", 0.05)
+    path = tmp_path / "seeds.jsonl"
+    prompts = [f"a red fox number {i} in snow" for i in range(3 * pg.REFRESH_QUEUE_MAX)]
+    path.write_text("".join(json.dumps({"prompt": p, "type": "image", "language": "en"}) + "\n" for p in prompts))
+    marker = pg.CACHE_SEED_PREFIX + hashlib.sha1(path.read_bytes()).hexdigest()
+
+    counts = pg.seed_cache(str(path))
+    # a worker left running by an earlier test may drain the queue while seeding fills it
+    assert counts["refresh"] >= pg.REFRESH_QUEUE_MAX and counts["pending"] == len(prompts)
+    assert not standins.exists(marker)
+
+    deadline = time.time() + 30
+    while not standins.exists(marker) and time.time() < deadline:
+        time.sleep(0.05)
+    pg.backend.flush()
+    keys = [pg.cache_key(pg.normalize_text(p), "image", "en") for p in prompts]
+    assert len(pg.read_entries(standins, keys)) == len(prompts)
+    assert pg.seed_cache(str(path)) == {"stored": 0, "refresh": 0, "present": 0, "pending": 0}
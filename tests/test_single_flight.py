@@ -0,0 +1,66 @@
+import threading
+import time
+
+import app as pg
+
+def _run_concurrently(n, target):
+    out, threads = [None] * n, []
+    for i in range(n):
+        def run(i=i):
+            out[i] = target()
+        threads.append(threading.Thread(target=run))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return out
+
+def test_concurrent_misses_share_one_call(standins):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.1)
+        return "generated"
+
+    out = _run_concurrently(8, lambda: pg.single_flight("image|en|sf1", fn))
+    assert len(calls) == 1
+    assert all(v == "generated" for v, _ in out)
+    assert sorted(c for _, c in out) == [False] + [True] * 7
+
+def test_follower_takes_over_when_the_remote_lease_lapses(standins):
+    key = "image|en|sf2"
+    standins.set(pg.CACHE_LOCK_PREFIX + key, "other-worker", px=150)  # another worker dies mid-generation
+    t0 = time.time()
+    value, coalesced = pg.single_flight(key, lambda: "mine")
+    assert (value, coalesced) == ("mine", False)
+    assert time.time() - t0 >= 0.1
+
+def test_remote_result_is_reused(standins):
+    key = "image|en|sf3"
+    standins.set(pg.CACHE_LOCK_PREFIX + key, "other-worker", px=5000)
+
+    def other_worker_finishes():
+        time.sleep(0.1)
+        standins.set(pg.CACHE_ENTRY_PREFIX + key, pg.encode_entry("norm", "theirs"))
+        standins.delete(pg.CACHE_LOCK_PREFIX + key)
+
+    threading.Thread(target=other_worker_finishes).start()
+    assert pg.single_flight(key, lambda: "mine") == ("theirs", True)
+
+def test_release_keeps_a_lock_taken_over_by_another_worker(standins):
+    key = "image|en|sf4"
+    lock_key = pg.CACHE_LOCK_PREFIX + key
+
+    def fn():
+        standins.set(lock_key, "new-owner")  # our lease expired and someone else took the lock
+        return "mine"
+
+    assert pg.single_flight(key, fn) == ("mine", False)
+    pg.backend.flush()
+    assert standins.get(lock_key) == b"new-owner"
+
+def test_own_lock_is_released_after_the_call(standins):
+    assert pg.single_flight("image|en|sf5", lambda: "mine") == ("mine", False)
+    pg.backend.flush()
+    assert not standins.exists(pg.CACHE_LOCK_PREFIX + "image|en|sf5")
@@ -0,0 +1,50 @@
+import pytest
+
+import app as pg
+
+def test_histogram_quantile_returns_upper_bin_edge():
+    assert pg.histogram_quantile({}, 0.95) is None
+    hist = {0: 10, 5: 80, 20: 10}
+    assert pg.histogram_quantile(hist, 0.5) == 6 * pg.TOKENS_BIN
+    assert pg.histogram_quantile(hist, 0.95) == 21 * pg.TOKENS_BIN
+    assert pg.histogram_quantile(hist, 0.05) == pg.TOKENS_BIN
+
+def test_estimate_needs_samples_and_stays_within_bounds():
+    few = {b"5": str(pg.TOKENS_MIN_SAMPLES - 1).encode(), b"n": b"999"}
+    assert pg.tokens_estimate(few, 400) is None
+    many = {b"5": str(pg.TOKENS_MIN_SAMPLES).encode(), b"length": b"3"}
+    assert pg.tokens_estimate(many, 400) == int(6 * pg.TOKENS_BIN * (1 + pg.TOKENS_MARGIN))
+    assert pg.tokens_estimate({b"0": b"100"}, 400) == 60
+    assert pg.tokens_estimate({b"200": b"100"}, 400) == 800
+
+def test_record_script_counts_and_halves_past_the_window(scripted):
+    key = pg.CACHE_TOKENS_PREFIX + "test"
+    for b in (3, 3, 7):
+        scripted.eval(pg._TOKENS_RECORD_LUA, 1, key, b, "0", 10)
+    scripted.eval(pg._TOKENS_RECORD_LUA, 1, key, 9, "1", 10)
+    h = {k.decode(): int(v) for k, v in scripted.hgetall(key).items()}
+    assert h == {"3": 2, "7": 1, "9": 1, "length": 1, "n": 4}
+    scripted.eval(pg._TOKENS_RECORD_LUA, 1, key, 3, "0", 4)
+    h = {k.decode(): int(v) for k, v in scripted.hgetall(key).items()}
+    assert h == {"3": 1, "n": 2}  # odd single counts drop out
+
+def test_completions_teach_max_tokens(standins, monkeypatch):
+    monkeypatch.setattr(pg, "_tokens_est", {})
+    a = pg.analyze_request("a lighthouse at sunset", "image", "en")
+    static = pg.scaled_max_tokens(a.lang, a.ptype, a.complexity)
+    assert pg.adaptive_max_tokens(a) == static
+    for _ in range(pg.TOKENS_MIN_SAMPLES):
+        pg.record_completion(a, static, 70, "stop")
+    pg.backend.flush()
+    assert pg.adaptive_max_tokens(a) == static  # cached until TOKENS_REFRESH_SECS
+    monkeypatch.setattr(pg, "_tokens_est", {})
+    assert pg.adaptive_max_tokens(a) == max(60, min(int(80 * (1 + pg.TOKENS_MARGIN)), 2 * static))
+
+@pytest.mark.parametrize("reason,used", [("stop", 40), ("length", None)])
+def test_truncated_replies_are_recorded_above_the_cap(standins, monkeypatch, reason, used):
+    a = pg.analyze_request("a lighthouse at sunset", "image", "en")
+    pg.record_completion(a, 100, 40, reason)
+    pg.backend.flush()
+    h = standins.hgetall(pg._tokens_key(a))
+    b = (used if used is not None else int(100 * pg.TOKENS_LENGTH_BUMP)) // pg.TOKENS_BIN
+    assert int(h[str(b).encode()]) == 1 and (b"length" in h) == (reason == "length")